@@ -0,0 +1,281 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import zlib
+
+from compositor_backends import BACKENDS, create_backend
+from png_encoding import PngEncodingProfile
+from png_metadata import PNG_SIGNATURE, png_chunk
+from util import *
+
+STAGES = ['load', 'composite', 'encode', 'metadata']
+
+
+def write_rgba_png(file_path: str, pixels):
+    """
+    Write an 8-bit RGBA PNG without any imaging library (so synthetic layers don't depend on a backend).
+    :param file_path: PNG file path.
+    :param pixels: uint8 NumPy array with shape `(height, width, 4)`.
+    """
+    height, width = pixels.shape[:2]
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    # filter type 0 (none) at the start of every row
+    raw = b''.join(b'\x00' + pixels[y].tobytes() for y in range(height))
+    with open(file_path, 'wb') as png_file:
+        png_file.write(PNG_SIGNATURE)
+        png_file.write(png_chunk(b'IHDR', ihdr))
+        png_file.write(png_chunk(b'IDAT', zlib.compress(raw, 6)))
+        png_file.write(png_chunk(b'IEND', b''))
+
+
+def create_synthetic_layers(layers_dir_path: str, size: int, num_layers: int, num_traits: int, coverage: float,
+                            seed: int):
+    """
+    Create a synthetic layers directory (in the same format as a real `layers` directory).
+    The first layer is an opaque background and every other trait is an opaque ellipse (with a soft edge)
+    covering about `coverage` of the canvas at a random position over a transparent canvas.
+    :param layers_dir_path: layers directory to create.
+    :param size: width and height of every trait image.
+    :param num_layers: number of layers.
+    :param num_traits: number of traits per layer.
+    :param coverage: fraction of the canvas covered by each (non-background) trait.
+    :param seed: random seed for the trait shapes and colors.
+    """
+
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size].astype(np.float32)
+    radius = size * np.sqrt(coverage / np.pi)
+
+    for layer_index in range(num_layers):
+        layer_type = 'Background' if layer_index == 0 else f'Layer{layer_index}'
+        layer_dir_path = os.path.join(layers_dir_path, f'{layer_index:02}-{layer_type}')
+        os.makedirs(layer_dir_path)
+
+        for trait_index in range(num_traits):
+            pixels = np.zeros((size, size, 4), dtype=np.uint8)
+            pixels[..., :3] = rng.integers(0, 256, 3, dtype=np.uint8)
+            if layer_index == 0:
+                pixels[..., 3] = 255
+            else:
+                cx, cy = rng.uniform(radius, max(radius, size - radius), 2)
+                distance = np.sqrt((x - cx) ** 2 + (y - cy) ** 2)
+                pixels[..., 3] = (np.clip(radius - distance, 0, 1) * 255).astype(np.uint8)
+            write_rgba_png(os.path.join(layer_dir_path, f'{layer_type}-Trait{trait_index}.png'), pixels)
+
+
+class StageTimer:
+    """
+    Collects the latency of every operation of each stage.
+    """
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {stage: [] for stage in STAGES}
+
+    def time(self, stage: str, function, *args):
+        p_start = time.perf_counter()
+        result = function(*args)
+        self.latencies[stage].append(time.perf_counter() - p_start)
+        return result
+
+
+def percentile(values: list[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def run_backend(backend_name: str, layers_dir_path: str, tokens: list[tuple[int, ...]], use_exiftool: bool,
+                crop_traits: bool = False) -> dict:
+    """
+    Run every stage of one backend (in its own process so the peak RSS is only for that backend).
+    :param backend_name: backend name.
+    :param layers_dir_path: synthetic layers directory.
+    :param tokens: trait indices of every token to composite.
+    :param use_exiftool: use exiftool for the metadata stage; otherwise write the metadata inline.
+    :param crop_traits: crop the trait images to their bounding boxes when they are loaded.
+    :return: report of each stage.
+    """
+
+    layers = load_layers(layers_dir_path, verbose=False)
+    backend = create_backend(backend_name, crop_traits)
+    profile = PngEncodingProfile()
+    timer = StageTimer()
+
+    # the magick backend only decodes the trait images when encoding, so most of its time is in the encode stage
+    images = [[timer.time('load', backend.load, trait_image.path) for trait_image in layer.trait_images]
+              for layer in layers]
+
+    def composite(token):
+        generated = backend.copy(images[0][token[0]])
+        for layer_index in range(1, len(token)):
+            backend.composite(generated, images[layer_index][token[layer_index]])
+        return generated
+
+    def encode(generated):
+        png_bytes = backend.encode(generated, profile)
+        backend.close_image(generated)
+        return png_bytes
+
+    if use_exiftool:
+        from exif_updater import ExifUpdater
+        exif_updater = ExifUpdater()
+        png_dir_path = tempfile.mkdtemp(prefix='benchmark-')
+    else:
+        from png_metadata import PngMetadataWriter
+        metadata_writer = PngMetadataWriter()
+
+    for index, token in enumerate(tokens):
+        png_bytes = timer.time('encode', encode, timer.time('composite', composite, token))
+        if use_exiftool:
+            png_path = os.path.join(png_dir_path, f'{index:05}.png')
+            with open(png_path, 'wb') as png_file:
+                png_file.write(png_bytes)
+            timer.time('metadata', exif_updater.update_metadata,
+                       png_path, None, f'#{index}', f'NFT #{index}', '[]')
+        else:
+            timer.time('metadata', metadata_writer.add_metadata, png_bytes, f'NFT #{index}', '[]')
+
+    if use_exiftool:
+        shutil.rmtree(png_dir_path)
+
+    for layer_images in images:
+        for image in layer_images:
+            backend.close_image(image)
+
+    # ru_maxrss is KB on Linux but bytes on macOS
+    rss_scale = 1 if sys.platform == 'darwin' else 1024
+    stages = {}
+    for stage, latencies in timer.latencies.items():
+        if latencies:
+            total = sum(latencies)
+            stages[stage] = {
+                'count': len(latencies),
+                'total_s': total,
+                'throughput_per_s': len(latencies) / total if total > 0 else None,
+                'p50_ms': percentile(latencies, 50) * 1000,
+                'p95_ms': percentile(latencies, 95) * 1000
+            }
+    return {
+        'stages': stages,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_scale / 2 ** 20,
+        'peak_child_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * rss_scale / 2 ** 20
+    }
+
+
+def backend_available(backend_name: str) -> str | None:
+    """
+    :param backend_name: backend name.
+    :return: `None` if the backend can run here; otherwise the reason it can't.
+    """
+    try:
+        create_backend(backend_name)
+    except (ImportError, RuntimeError) as e:
+        return str(e).splitlines()[0]
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Benchmark Compositors',
+        description='Benchmarks the load, composite, encode, and metadata stages of each compositing backend '
+                    'using synthetic layers.',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument('--size', type=int, default=1024, help='width and height of the synthetic trait images')
+    parser.add_argument('--layers', type=int, default=4, help='number of synthetic layers')
+    parser.add_argument('--traits', type=int, default=4, help='number of synthetic traits per layer')
+    parser.add_argument('--coverage', type=float, default=0.25,
+                        help='fraction of the canvas covered by each (non-background) trait')
+    parser.add_argument('--tokens', type=int, default=20, help='number of random tokens to composite')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the synthetic layers and tokens')
+    parser.add_argument('--backends', default=','.join(BACKENDS.keys()),
+                        help='comma separated backends to benchmark')
+    parser.add_argument('--exiftool', action='store_true',
+                        help='use exiftool for the metadata stage instead of writing the metadata inline')
+    parser.add_argument('--crop-traits', action='store_true',
+                        help='crop the trait images to their bounding boxes (see generate_nfts.py --crop-traits)')
+    parser.add_argument('--layers-dir', help='existing layers directory to use instead of synthetic layers')
+    parser.add_argument('report', help='report path prefix (writes REPORT.json and REPORT.csv)')
+
+    args = parser.parse_args()
+
+    config = {k: v for k, v in vars(args).items() if k != 'report'}
+    work_dir_path = None
+    layers_dir_path = args.layers_dir
+    if layers_dir_path is None:
+        work_dir_path = tempfile.mkdtemp(prefix='benchmark-layers-')
+        layers_dir_path = os.path.join(work_dir_path, 'layers')
+        print(f'Creating synthetic layers: {layers_dir_path}')
+        create_synthetic_layers(layers_dir_path, args.size, args.layers, args.traits, args.coverage, args.seed)
+
+    layers = load_layers(layers_dir_path, verbose=False)
+    rng = random.Random(args.seed)
+    tokens = [tuple(rng.randrange(len(layer.trait_images)) for layer in layers) for _ in range(args.tokens)]
+
+    # spawn a process per backend so the peak RSS of one backend doesn't include another
+    context = multiprocessing.get_context('spawn')
+    results = {}
+    for backend in args.backends.split(','):
+        skipped = backend_available(backend)
+        if skipped is not None:
+            print(f'\nSkipping [{backend}]: {skipped}')
+            results[backend] = {'skipped': skipped}
+            continue
+
+        print(f'\nBenchmarking [{backend}]...')
+        with context.Pool(1) as pool:
+            results[backend] = pool.apply(run_backend, (backend, layers_dir_path, tokens, args.exiftool,
+                                                               args.crop_traits))
+
+        for stage, stats in results[backend]['stages'].items():
+            print(f'  {stage:10} {stats["throughput_per_s"] or 0:9.02f}/s  '
+                  f'p50: {stats["p50_ms"]:8.02f}ms  p95: {stats["p95_ms"]:8.02f}ms')
+        print(f'  peak RSS: {results[backend]["peak_rss_mb"]:.01f}MB '
+              f'(children: {results[backend]["peak_child_rss_mb"]:.01f}MB)')
+
+    if work_dir_path is not None:
+        shutil.rmtree(work_dir_path)
+
+    with open(args.report + '.json', 'w') as report_json:
+        json.dump({'config': config, 'backends': results}, report_json, indent=2)
+
+    with open(args.report + '.csv', 'w', newline='') as report_csv:
+        csvwriter = csv.writer(report_csv)
+        csvwriter.writerow(['backend', 'stage', 'count', 'total_s', 'throughput_per_s', 'p50_ms', 'p95_ms',
+                            'peak_rss_mb', 'peak_child_rss_mb'])
+        for backend, result in results.items():
+            for stage, stats in result.get('stages', {}).items():
+                csvwriter.writerow([backend, stage, stats['count'], stats['total_s'], stats['throughput_per_s'],
+                                    stats['p50_ms'], stats['p95_ms'], result['peak_rss_mb'],
+                                    result['peak_child_rss_mb']])
+
+    print(f'\nREPORT: {args.report}.json, {args.report}.csv')
+
+
+if __name__ == '__main__':
+    main()
@@ -20,28 +20,7 @@
 set -e
 set -o pipefail
 
-GEN_IMAGES_DIR="./generated/images"
+GEN_DIR="${1:-./generated}"
 
-echo "Spot check the EXIF metadata summary below"
-
-png_images=()
-while IFS= read -r -d $'\0'; do
-  png_images+=("$REPLY")
-done < <(find -s "$GEN_IMAGES_DIR" -d 1 -type f -name "*.png" -print0)
-
-echo_exif() {
-  file_path="$1"
-  echo "================="
-  echo "EXIF Summary for: $file_path"
-  echo "================="
-  exiftool -subject -title -author -CreatorWorkEmail -CreatorWorkURL -CreatorCountry -copyright -marked -keywords -description "$file_path"
-}
-
-echo
-first_png=${png_images[0]}
-echo_exif "$first_png"
-
-echo
-last_index=$(( ${#png_images[@]} - 1 ))
-last_png=${png_images[last_index]}
-echo_exif "$last_png"
+echo "Verifying the EXIF metadata of every generated image..."
+python3 "$(dirname "$0")/exif_check.py" "$GEN_DIR"
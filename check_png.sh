@@ -20,30 +20,7 @@
 set -e
 set -o pipefail
 
-GEN_IMAGES_DIR="./generated/images"
+GEN_DIR="${1:-./generated}"
 
 echo "Checking generated PNG images for corruption..."
-
-bad_pngs=""
-for file in $GEN_IMAGES_DIR/*.png
-do
-  result=$(pngcheck "$file")
-  if [[ $result == OK:* ]]
-  then
-    echo -n "."
-  else
-    echo -n "X"
-    bad_pngs+="$result"
-  fi
-done
-echo
-
-echo
-if [[ -n "$bad_pngs" ]]
-then
-  echo "Bad PNGs files were discovered:"
-  echo "$bad_pngs"
-  exit 1 
-else
-  echo "No bad PNGs files were discovered."
-fi
+python3 "$(dirname "$0")/png_check.py" "$GEN_DIR"
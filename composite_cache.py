@@ -0,0 +1,83 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+from typing import Any, Callable
+
+from compositor_backends import CompositorBackend
+from util import TraitImageInfo
+
+
+class PrefixCompositeCache:
+    """
+    Stack of intermediate composite images (one per layer depth) that is shared between consecutive composites.
+
+    Generating ALL permutations walks the layers depth-first, so consecutive images only differ in the last few
+    layers. Keeping the composite of each prefix means a new image only costs one composite per changed layer
+    (typically just the top layer) instead of one composite per layer.
+    """
+
+    def __init__(self, load_image: Callable[[TraitImageInfo], Any], backend: CompositorBackend):
+        """
+        :param load_image: function that returns the (cached) decoded image of a trait.
+        :param backend: compositor backend of the decoded images.
+        """
+        self.load_image = load_image
+        self.backend = backend
+        self.parts: list[TraitImageInfo] = []
+        self.composites: list[Any] = []
+        self.num_composites = 0
+
+    def composite(self, parts: list[TraitImageInfo]) -> Any:
+        """
+        Composite the image parts, reusing the cached composite of the longest prefix shared with the last call.
+        :param parts: image parts to use when generating image.
+        :return: a new composite image (the caller is responsible for closing it).
+        """
+
+        # the last part is never cached because it changes on every call when walking ALL permutations
+        prefix_len = len(parts) - 1
+
+        shared_len = 0
+        max_shared_len = min(len(self.parts), prefix_len)
+        while shared_len < max_shared_len and self.parts[shared_len] is parts[shared_len]:
+            shared_len += 1
+        self.truncate(shared_len)
+
+        while len(self.parts) < prefix_len:
+            part = parts[len(self.parts)]
+            self.composites.append(self._composite_over_top(part))
+            self.parts.append(part)
+
+        return self._composite_over_top(parts[-1])
+
+    def truncate(self, depth: int = 0):
+        """
+        Release the cached composites deeper than `depth` (use the default to release everything).
+        :param depth: number of cached prefix composites to keep.
+        """
+        while len(self.parts) > depth:
+            self.parts.pop()
+            self.backend.close_image(self.composites.pop())
+
+    def _composite_over_top(self, part: TraitImageInfo) -> Any:
+        if not self.composites:
+            # start with a copy of the cached image
+            return self.backend.copy(self.load_image(part))
+
+        # composite the cached image over a copy of the deepest cached prefix
+        generated = self.backend.copy(self.composites[-1])
+        self.backend.composite(generated, self.load_image(part))
+        self.num_composites += 1
+        return generated
@@ -0,0 +1,603 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import hashlib
+import io
+import shutil
+import subprocess
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from png_encoding import PNG_FILTERS, PNG_STRATEGIES, PngEncodingProfile
+from util import TraitImageInfo
+
+
+@dataclass(frozen=True)
+class SparseTrait:
+    """
+    Trait image cropped to the bounding box of its non-transparent pixels.
+    Compositing it at its offset gives the same result as compositing the whole (mostly transparent) canvas.
+    """
+    image: Any
+    left: int
+    top: int
+    canvas_width: int
+    canvas_height: int
+
+
+def pixel_buffer_digest(pixels) -> str:
+    """
+    :param pixels: raw pixel buffer (anything that supports the buffer protocol).
+    :return: hex digest of the pixels.
+    """
+    return hashlib.blake2b(pixels, digest_size=16).hexdigest()
+
+
+def alpha_bounds(alpha) -> tuple[int, int, int, int]:
+    """
+    :param alpha: 2D NumPy array of alpha values.
+    :return: `(left, top, right, bottom)` bounding box of the non-zero values (empty if all are zero).
+    """
+    import numpy as np
+    rows = np.flatnonzero(alpha.any(axis=1))
+    if rows.size == 0:
+        return 0, 0, 0, 0
+    cols = np.flatnonzero(alpha.any(axis=0))
+    return int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1
+
+
+class CompositorBackend(ABC):
+    """
+    Loads trait images, composites them in layer order, and encodes the result as a PNG.
+
+    A composite starts as a copy of the bottom trait image (`copy`) and each following trait image is
+    composited over it in place (`composite`), so the same backend works with the trait image cache and the
+    prefix composite cache. Loaded trait images are owned by the trait image cache and composites by the caller.
+
+    Backends that decode the trait images in this process extend :py:class:`PixelBackend`.
+    """
+
+    name = None
+    # whether trait images of a different size than the composite are an error
+    requires_same_size = False
+    # name of the decoder used by `decode_rgba` (backends with the same decoder share cached pixels)
+    raw_decoder = None
+    # whether `from_shared` images are views of the shared pixels (instead of copies)
+    zero_copy_shared = False
+
+    def __init__(self, crop_to_bounds: bool = False, layer_cache=None):
+        self.crop_to_bounds = crop_to_bounds
+        self.layer_cache = layer_cache if self.raw_decoder is not None else None
+
+    def load(self, path: str) -> Any:
+        """
+        Decode a trait image file.
+        :param path: image file path.
+        :return: the decoded image.
+        """
+        return self.decode(path)
+
+    @abstractmethod
+    def decode(self, path: str) -> Any:
+        """
+        :param path: image file path.
+        :return: the decoded image.
+        """
+
+    def image_bytes(self, image) -> int:
+        """
+        :param image: decoded image.
+        :return: memory used (or estimated) by the decoded image.
+        """
+        return self.unwrapped_image_bytes(image.image if isinstance(image, SparseTrait) else image)
+
+    @abstractmethod
+    def unwrapped_image_bytes(self, image) -> int:
+        pass
+
+    def close_image(self, image):
+        """
+        Release a decoded image or composite.
+        :param image: image to release.
+        """
+        if isinstance(image, SparseTrait):
+            self.close_image(image.image)
+
+    def copy(self, image) -> Any:
+        """
+        :param image: decoded trait image (or composite) to start a new composite from.
+        :return: a new composite (the caller is responsible for closing it).
+        """
+        return self.copy_image(image)
+
+    @abstractmethod
+    def copy_image(self, image) -> Any:
+        pass
+
+    @abstractmethod
+    def composite(self, generated, image):
+        """
+        Composite an image over the current composite (in place).
+        :param generated: current composite.
+        :param image: decoded trait image to composite over it.
+        """
+
+    @abstractmethod
+    def encode(self, generated, profile: PngEncodingProfile) -> bytes:
+        """
+        :param generated: composite to encode.
+        :param profile: PNG encoding options.
+        :return: encoded PNG bytes.
+        """
+
+    @abstractmethod
+    def pixel_digest(self, generated) -> str:
+        """
+        Hash the raw pixels of a composite (before encoding) to find visually identical images.
+        Digests are only comparable between images hashed by the same backend.
+        :param generated: composite to hash.
+        :return: hex digest of the pixels.
+        """
+
+    def save(self, generated, file_path: str, profile: PngEncodingProfile):
+        """
+        Encode a composite into a PNG file.
+        :param generated: composite to save.
+        :param file_path: PNG file path.
+        :param profile: PNG encoding options.
+        """
+        png_bytes = self.encode(generated, profile)
+        with open(file_path, 'wb') as png_file:
+            png_file.write(png_bytes)
+
+    def batch_compositor(self, load_image: Callable[[TraitImageInfo], Any]):
+        """
+        :param load_image: function that returns the (cached) decoded image of a trait.
+        :return: a compositor with `composite_batch` (see :py:class:`NumpyCompositor`) if this backend can
+            composite several images that share the same base at once; otherwise `None`.
+        """
+        return None
+
+
+class PixelBackend(CompositorBackend):
+    """
+    Backend that decodes the trait images into pixels in this process.
+
+    With `crop_to_bounds`, each trait image is cropped to the bounding box of its non-transparent pixels when it
+    is loaded (see :py:class:`SparseTrait`) so compositing only blends that region at its offset.
+
+    With a `layer_cache` (see :py:class:`layer_cache.LayerCache`), trait images are created from their cached
+    (memory-mapped) raw pixels instead of decoding the image files. The pixels can also be shared between
+    processes (see :py:mod:`shared_pixels`).
+    """
+
+    def load(self, path: str) -> Any:
+        """
+        Decode a trait image file (cropped to its bounding box if enabled).
+        :param path: image file path.
+        :return: the decoded image (or :py:class:`SparseTrait`).
+        """
+        image = self.decode_cached(path)
+        if not self.crop_to_bounds:
+            return image
+
+        width, height = self.size(image)
+        bounds = self.bounds(image)
+        if bounds is None or bounds == (0, 0, width, height):
+            return image
+        if bounds[2] <= bounds[0]:
+            # completely transparent, so keep a single (transparent) pixel
+            bounds = (0, 0, 1, 1)
+
+        cropped = self.crop(image, bounds)
+        self.close_image(image)
+        return SparseTrait(cropped, bounds[0], bounds[1], width, height)
+
+    def decode_cached(self, path: str) -> Any:
+        """
+        :param path: image file path.
+        :return: the decoded image (from the layer cache if the pixels are cached).
+        """
+        if self.layer_cache is not None:
+            pixels = self.layer_cache.pixels(path, self.raw_decoder)
+            if pixels is not None:
+                return self.from_rgba(pixels)
+        return self.decode(path)
+
+    @abstractmethod
+    def decode_rgba(self, path: str):
+        """
+        :param path: image file path.
+        :return: straight RGBA pixels as a NumPy array with shape `(height, width, 4)` (to cache).
+        """
+
+    @abstractmethod
+    def from_rgba(self, pixels) -> Any:
+        """
+        :param pixels: straight RGBA pixels (see `decode_rgba`).
+        :return: the decoded image.
+        """
+
+    @abstractmethod
+    def to_shared(self, image):
+        """
+        :param image: decoded image (not a :py:class:`SparseTrait`).
+        :return: NumPy array of the image pixels to put in shared memory (see :py:mod:`shared_pixels`).
+        """
+
+    def from_shared(self, pixels) -> Any:
+        """
+        :param pixels: read-only view of the shared pixels (see `to_shared`).
+        :return: the decoded image (read-only, since it may share the pixels with other processes).
+        """
+        return self.from_rgba(pixels)
+
+    @abstractmethod
+    def size(self, image) -> tuple[int, int]:
+        """
+        :param image: decoded image or composite.
+        :return: `(width, height)` of the image.
+        """
+
+    def bounds(self, image) -> tuple[int, int, int, int] | None:
+        """
+        :param image: decoded image.
+        :return: `(left, top, right, bottom)` bounding box of the non-transparent pixels
+            (`None` if it has no alpha).
+        """
+        return None
+
+    @abstractmethod
+    def crop(self, image, bounds: tuple[int, int, int, int]) -> Any:
+        """
+        :param image: decoded image.
+        :param bounds: `(left, top, right, bottom)` region to keep.
+        :return: a new image of the region.
+        """
+
+    @abstractmethod
+    def blank(self, width: int, height: int) -> Any:
+        """
+        :return: a new transparent composite.
+        """
+
+    def copy(self, image) -> Any:
+        if not isinstance(image, SparseTrait):
+            return self.copy_image(image)
+        generated = self.blank(image.canvas_width, image.canvas_height)
+        self.composite_at(generated, image.image, image.left, image.top)
+        return generated
+
+    def composite(self, generated, image):
+        if isinstance(image, SparseTrait):
+            size = (image.canvas_width, image.canvas_height)
+            image, left, top = image.image, image.left, image.top
+        else:
+            size = self.size(image)
+            left = top = 0
+
+        if self.requires_same_size and size != self.size(generated):
+            raise ValueError(f'Trait image size {size} does not match {self.size(generated)}')
+        self.composite_at(generated, image, left, top)
+
+    @abstractmethod
+    def composite_at(self, generated, image, left: int, top: int):
+        """
+        Composite an image over a region of the current composite (in place).
+        :param generated: current composite.
+        :param image: image to composite over it.
+        :param left: x offset of the image.
+        :param top: y offset of the image.
+        """
+
+
+class WandBackend(PixelBackend):
+    """
+    Composites with ImageMagick through Wand (the default).
+    """
+
+    name = 'wand'
+    raw_decoder = 'magick'
+
+    def __init__(self, crop_to_bounds: bool = False, layer_cache=None):
+        super().__init__(crop_to_bounds, layer_cache)
+        from wand.color import Color
+        from wand.image import Image
+        self.Color = Color
+        self.Image = Image
+
+    def decode(self, path: str):
+        return self.Image(filename=path)
+
+    def decode_rgba(self, path: str):
+        import numpy_compositor
+        return numpy_compositor.decode_rgba(path)
+
+    def from_rgba(self, pixels):
+        height, width = pixels.shape[:2]
+        return self.Image(blob=pixels.tobytes(), format='RGBA', width=width, height=height,
+                          depth=8 * pixels.dtype.itemsize)
+
+    def to_shared(self, image):
+        import numpy_compositor
+        with image.clone() as clone:
+            return numpy_compositor.rgba_pixels(clone)
+
+    def size(self, image) -> tuple[int, int]:
+        return image.width, image.height
+
+    def bounds(self, image) -> tuple[int, int, int, int] | None:
+        if not image.alpha_channel:
+            return None
+        import numpy as np
+        with image.clone() as alpha:
+            alpha.alpha_channel = 'extract'
+            alpha.depth = 8
+            raw = alpha.make_blob('gray')
+        return alpha_bounds(np.frombuffer(raw, dtype=np.uint8).reshape(image.height, image.width))
+
+    def crop(self, image, bounds: tuple[int, int, int, int]):
+        cropped = image.clone()
+        # the crop also resets the page offset so the crop is composited where it is told to be
+        cropped.crop(*bounds)
+        return cropped
+
+    def blank(self, width: int, height: int):
+        return self.Image(width=width, height=height, background=self.Color('transparent'))
+
+    def unwrapped_image_bytes(self, image) -> int:
+        from image_cache import wand_image_bytes
+        return wand_image_bytes(image)
+
+    def close_image(self, image):
+        if isinstance(image, SparseTrait):
+            image = image.image
+        image.close()
+
+    def copy_image(self, image):
+        return self.Image(image)
+
+    def composite_at(self, generated, image, left: int, top: int):
+        generated.composite(image, left=left, top=top)
+
+    def encode(self, generated, profile: PngEncodingProfile) -> bytes:
+        profile.apply(generated)
+        return generated.make_blob('png')
+
+    def pixel_digest(self, generated) -> str:
+        # ImageMagick computes the SHA-256 of the pixel stream natively (without exporting the pixels)
+        return generated.signature
+
+    def save(self, generated, file_path: str, profile: PngEncodingProfile):
+        profile.apply(generated)
+        generated.save(filename=file_path)
+
+
+class PillowBackend(PixelBackend):
+    """
+    Composites with Pillow. Images are always encoded as 8-bit RGBA and only the compression level of the
+    PNG encoding profile is supported (Pillow chooses the filters itself).
+    """
+
+    name = 'pillow'
+    requires_same_size = True
+    raw_decoder = 'pillow'
+    zero_copy_shared = True
+
+    def __init__(self, crop_to_bounds: bool = False, layer_cache=None):
+        super().__init__(crop_to_bounds, layer_cache)
+        # imported here so Pillow is only required when it is used
+        from PIL import Image
+        self.Image = Image
+
+    def decode(self, path: str):
+        image = self.Image.open(path)
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        image.load()
+        return image
+
+    def decode_rgba(self, path: str):
+        import numpy as np
+        with self.decode(path) as image:
+            return np.asarray(image)
+
+    def from_rgba(self, pixels):
+        height, width = pixels.shape[:2]
+        # shares the (memory-mapped or shared) pixels instead of copying them
+        return self.Image.frombuffer('RGBA', (width, height), pixels, 'raw', 'RGBA', 0, 1)
+
+    def to_shared(self, image):
+        import numpy as np
+        return np.asarray(image)
+
+    def size(self, image) -> tuple[int, int]:
+        return image.size
+
+    def bounds(self, image) -> tuple[int, int, int, int] | None:
+        return image.getchannel('A').getbbox() or (0, 0, 0, 0)
+
+    def crop(self, image, bounds: tuple[int, int, int, int]):
+        return image.crop(bounds)
+
+    def blank(self, width: int, height: int):
+        return self.Image.new('RGBA', (width, height), (0, 0, 0, 0))
+
+    def unwrapped_image_bytes(self, image) -> int:
+        return image.width * image.height * 4
+
+    def close_image(self, image):
+        if isinstance(image, SparseTrait):
+            image = image.image
+        image.close()
+
+    def copy_image(self, image):
+        return image.copy()
+
+    def composite_at(self, generated, image, left: int, top: int):
+        generated.alpha_composite(image, dest=(left, top))
+
+    def encode(self, generated, profile: PngEncodingProfile) -> bytes:
+        png_file = io.BytesIO()
+        generated.save(png_file, format='png', **self._save_options(profile))
+        return png_file.getvalue()
+
+    def pixel_digest(self, generated) -> str:
+        return pixel_buffer_digest(generated.tobytes())
+
+    def save(self, generated, file_path: str, profile: PngEncodingProfile):
+        generated.save(file_path, format='png', **self._save_options(profile))
+
+    @staticmethod
+    def _save_options(profile: PngEncodingProfile) -> dict:
+        if profile.compression_level is None:
+            return {}
+        return {'compress_level': profile.compression_level}
+
+
+class MagickCliBackend(CompositorBackend):
+    """
+    Composites by running the ImageMagick command line (`magick`, or `convert` for ImageMagick 6).
+
+    Nothing is decoded in this process: a "loaded" trait image is just its path and a composite is the list of
+    paths to flatten, so every encode runs one `magick` process that reads all of the trait image files
+    (which also means trait images are never cropped to their bounding boxes).
+    """
+
+    name = 'magick'
+
+    def __init__(self, crop_to_bounds: bool = False, layer_cache=None):
+        super().__init__(crop_to_bounds=False)
+        self.command = shutil.which('magick') or shutil.which('convert')
+        if self.command is None:
+            raise RuntimeError('ImageMagick command not found (magick or convert)')
+
+    def decode(self, path: str) -> str:
+        return path
+
+    def unwrapped_image_bytes(self, image) -> int:
+        return 0
+
+    def copy_image(self, image) -> list[str]:
+        return list(image) if isinstance(image, list) else [image]
+
+    def composite(self, generated, image):
+        generated.append(image)
+
+    def encode(self, generated, profile: PngEncodingProfile) -> bytes:
+        return subprocess.run(self._args(generated, profile, 'png:-'), check=True, capture_output=True).stdout
+
+    def pixel_digest(self, generated) -> str:
+        # the pixels only exist in the magick process so this runs one more process to export them
+        args = [self.command] + generated + ['-background', 'none', '-flatten', 'rgba:-']
+        return pixel_buffer_digest(subprocess.run(args, check=True, capture_output=True).stdout)
+
+    def save(self, generated, file_path: str, profile: PngEncodingProfile):
+        subprocess.run(self._args(generated, profile, 'png:' + file_path), check=True, capture_output=True)
+
+    def _args(self, generated: list[str], profile: PngEncodingProfile, output: str) -> list[str]:
+        args = [self.command] + generated + ['-background', 'none', '-flatten']
+        if profile.compression_level is not None:
+            args += ['-define', f'png:compression-level={profile.compression_level}']
+        if profile.compression_filter is not None:
+            args += ['-define', f'png:compression-filter={PNG_FILTERS[profile.compression_filter]}']
+        if profile.compression_strategy is not None:
+            args += ['-define', f'png:compression-strategy={PNG_STRATEGIES[profile.compression_strategy]}']
+        if profile.bit_depth is not None:
+            args += ['-depth', str(profile.bit_depth), '-define', f'png:bit-depth={profile.bit_depth}']
+        return args + [output]
+
+
+class NumpyBackend(PixelBackend):
+    """
+    Composites premultiplied RGBA NumPy arrays (see :py:mod:`numpy_compositor`).
+    Consecutive images that only differ in the top layer can be composited together as a batch.
+    """
+
+    name = 'numpy'
+    requires_same_size = True
+    raw_decoder = 'magick'
+    zero_copy_shared = True
+
+    def __init__(self, crop_to_bounds: bool = False, layer_cache=None):
+        super().__init__(crop_to_bounds, layer_cache)
+        # imported here so NumPy is only required when it is used
+        import numpy_compositor
+        self.numpy_compositor = numpy_compositor
+
+    def decode(self, path: str):
+        return self.numpy_compositor.decode_premultiplied(path)
+
+    def decode_rgba(self, path: str):
+        return self.numpy_compositor.decode_rgba(path)
+
+    def from_rgba(self, pixels):
+        return self.numpy_compositor.premultiply(pixels)
+
+    def to_shared(self, image):
+        return image
+
+    def from_shared(self, pixels):
+        # the premultiplied float32 arrays are shared as is (16 bytes per pixel, see README `--shared-traits`),
+        # since converting 8-bit pixels in every worker would recreate the per-worker copies sharing avoids
+        return pixels
+
+    def size(self, image) -> tuple[int, int]:
+        return image.shape[1], image.shape[0]
+
+    def bounds(self, image) -> tuple[int, int, int, int] | None:
+        return alpha_bounds(image[..., 3])
+
+    def crop(self, image, bounds: tuple[int, int, int, int]):
+        left, top, right, bottom = bounds
+        return image[top:bottom, left:right].copy()
+
+    def blank(self, width: int, height: int):
+        return self.numpy_compositor.np.zeros((height, width, 4), dtype=self.numpy_compositor.np.float32)
+
+    def unwrapped_image_bytes(self, image) -> int:
+        return image.nbytes
+
+    def copy_image(self, image):
+        return image.copy()
+
+    def composite_at(self, generated, image, left: int, top: int):
+        self.numpy_compositor.composite_over_region(image, generated, left, top)
+
+    def encode(self, generated, profile: PngEncodingProfile) -> bytes:
+        return self.numpy_compositor.encode_png(generated, profile)
+
+    def pixel_digest(self, generated) -> str:
+        # hash the premultiplied float pixels in place unless the array isn't contiguous (e.g., a view)
+        return pixel_buffer_digest(generated.data if generated.flags.c_contiguous else generated.tobytes())
+
+    def batch_compositor(self, load_image: Callable[[TraitImageInfo], Any]):
+        return self.numpy_compositor.NumpyCompositor(load_image, self)
+
+
+BACKENDS = {backend.name: backend for backend in [WandBackend, PillowBackend, MagickCliBackend, NumpyBackend]}
+
+
+def create_backend(name: str, crop_to_bounds: bool = False, layer_cache=None) -> CompositorBackend:
+    """
+    :param name: backend name (see `BACKENDS`).
+    :param crop_to_bounds: crop each trait image to the bounding box of its non-transparent pixels.
+    :param layer_cache: cache of the decoded trait image pixels (see :py:class:`layer_cache.LayerCache`).
+    :return: the new backend.
+    """
+    if name not in BACKENDS:
+        raise ValueError(f'Unknown compositor backend: {name}')
+    return BACKENDS[name](crop_to_bounds, layer_cache)
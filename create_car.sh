@@ -20,42 +20,11 @@
 set -e
 set -o pipefail
 
-GEN_DIR="./generated"
-GEN_IMAGES_DIR="$GEN_DIR/images"
-CAR_FILE="images.car"
+GEN_DIR="${1:-./generated}"
 
-# this script uses ipfs-car to create a CAR file
-# https://github.com/web3-storage/ipfs-car
-echo "Checking for ipfs-car installation..."
-NPX_VERSION=$(npx --yes ipfs-car --version)
-
-version_greater_equal()
-{
-    printf '%s\n%s\n' "$2" "$1" | sort --check=quiet --version-sort
-}
-
-# the version command above should install ipfs-car when prompted
-if version_greater_equal "${NPX_VERSION}" 0.9.1
-then
-  echo "ipfs-car requirement was satisfied"
-else
-  die "ipfs-car 0.9.1 or above is required"
-fi
-
-echo
-echo "Creating CAR from images directory..."
-npx --yes ipfs-car --pack "$GEN_IMAGES_DIR" --output "$GEN_DIR/$CAR_FILE"
-ls -o ./generated/images.car | cut -w -f 4-
-
-echo
-echo "Creating CAR catalog file..."
-npx --yes ipfs-car --list-full "$GEN_DIR/$CAR_FILE" > "$GEN_DIR/$CAR_FILE.cids"
-echo "Created: $GEN_DIR/$CAR_FILE.cids"
-
-echo
-echo "IPFS base URL example:"
-IPFS_BASE_DIR=$(dirname `tail -1 "$GEN_DIR/$CAR_FILE.cids" | cut -w -f 2-`)
-echo "https://ipfs.io/ipfs/$IPFS_BASE_DIR/"
+# packs the images directory into images.car (and lists the CIDs in images.car.csv)
+# the DAGs use the default parameters of "ipfs add --cid-version 1" (see README) without needing ipfs or node
+python3 "$(dirname "$0")/ipfs_car.py" "$GEN_DIR"
 
 echo
 echo "DONE"
@@ -0,0 +1,239 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+import time
+
+from exiftool import ExifTool
+
+from exif_updater import load_exif_config
+from util import *
+
+# tags that are different for every image (the title and the description with the traits)
+TOKEN_TAGS = ['Title', 'Description', 'Comment']
+
+# tags that are read as a list of comma separated values when they are a single string
+LIST_TAGS = {'Keywords'}
+
+EXIF_MISMATCH_FIELDNAMES = ['image', 'tag', 'expected', 'actual']
+
+
+def common_tags(config: dict) -> dict[str, list[str]]:
+    """
+    :param config: EXIF metadata config (see exif_metadata.yaml).
+    :return: tags that are the same for every image mapped to their expected values.
+    """
+    contact = config['contact']
+    return {
+        'Subject': [config['subject']],
+        'Author': [contact['author']],
+        'Creator': [contact['author']],
+        'Copyright': [config['copyright']],
+        'CreatorWorkEmail': [contact['email']],
+        'CreatorWorkURL': [contact['url']],
+        'CreatorCountry': [contact['country']['name']],
+        'CountryCode': [contact['country']['code']],
+        'Marked': ['True'],
+        'Keywords': sorted(config['keywords'])
+    }
+
+
+def tag_values(tag: str, value) -> list[str] | None:
+    """
+    :param tag: tag name.
+    :param value: tag value read by exiftool (a JSON string, number, boolean, or list).
+    :return: the value as a list of strings (`None` if the tag is missing).
+    """
+    if value is None:
+        return None
+    values = value if isinstance(value, list) else [value]
+    values = [str(v) for v in values]
+    if tag in LIST_TAGS:
+        return sorted(v.strip() for values_str in values for v in values_str.split(','))
+    return values
+
+
+class ExifVerifier:
+    """
+    Compares the tags read from each image with the metadata CSV row of the image and the EXIF metadata config.
+    """
+
+    def __init__(self, config: dict):
+        """
+        :param config: EXIF metadata config (see exif_metadata.yaml).
+        """
+        self.common_tags = common_tags(config)
+        self.mismatches: list[tuple[str, str, str, str]] = []
+        self.num_checked = 0
+
+    @property
+    def tags(self) -> list[str]:
+        return TOKEN_TAGS + list(self.common_tags.keys())
+
+    def verify(self, file_name: str, row: dict, metadata: dict):
+        """
+        Check the tags of one image (and remember every mismatch).
+        :param file_name: image file name.
+        :param row: metadata CSV row of the image.
+        :param metadata: tags read by exiftool.
+        """
+        image_desc = row[Const.CSV_FIELD_DESC]
+        details = image_desc + ' :: ' + row[Const.CSV_FIELD_ATTS]
+        expected_tags = {'Title': [image_desc], 'Description': [details], 'Comment': [details]}
+        expected_tags.update(self.common_tags)
+
+        for tag, expected in expected_tags.items():
+            actual = tag_values(tag, metadata.get(tag))
+            if actual != expected:
+                self.mismatches.append((
+                    file_name,
+                    tag,
+                    ', '.join(expected),
+                    '<missing>' if actual is None else ', '.join(actual)
+                ))
+        self.num_checked += 1
+
+    def missing(self, file_name: str, problem: str):
+        self.mismatches.append((file_name, '', '', problem))
+
+    def write_csv(self, csv_path: str):
+        with open(csv_path, 'w', newline='') as mismatches_csv:
+            csvwriter = csv.writer(mismatches_csv)
+            csvwriter.writerow(EXIF_MISMATCH_FIELDNAMES)
+            csvwriter.writerows(self.mismatches)
+
+
+# each worker process reads tags with its own exiftool process (kept open for every batch)
+worker_exiftool: ExifTool | None = None
+worker_tags: list[str] = []
+
+
+def init_worker(tags: list[str]):
+    global worker_exiftool, worker_tags
+    worker_exiftool = ExifTool(common_args=[])
+    worker_exiftool.run()
+    worker_tags = [f'-{tag}' for tag in tags]
+
+
+def read_tags(file_paths: list[str]) -> tuple[list[str], list[dict]]:
+    # one exiftool JSON command for the whole batch
+    return file_paths, worker_exiftool.execute_json(*worker_tags, *file_paths)
+
+
+def image_file_name(image: str) -> str:
+    # the image column is either the file name or a URL ending with it (after update_csv.py)
+    return image.rsplit('/', 1)[-1]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='EXIF Check',
+        description='Verifies the EXIF metadata of every generated image against the metadata CSV and config.',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        '-W', '--workers',
+        dest='num_workers',
+        type=int,
+        default=os.cpu_count(),
+        help='number of worker processes (each with its own exiftool process)'
+    )
+    parser.add_argument(
+        '-b', '--batch-size',
+        dest='batch_size',
+        type=int,
+        default=500,
+        help='number of images read by each exiftool command'
+    )
+    parser.add_argument(
+        '-c', '--csv',
+        dest='csv_paths',
+        action='append',
+        help='metadata CSV to read instead of the generated assets.csv (repeat to merge several CSVs in order)'
+    )
+    parser.add_argument(
+        '--config',
+        dest='config_path',
+        default='exif_metadata.yaml',
+        help='EXIF metadata config the images were generated with'
+    )
+    parser.add_argument(
+        'generated_dir',
+        default='./generated',
+        help='generated output directory to check'
+    )
+
+    args = parser.parse_args()
+
+    p_start = time.perf_counter()
+    gen_image_dir_path = os.path.join(args.generated_dir, Const.GEN_IMAGE_SUBDIR)
+    csv_paths = args.csv_paths or [os.path.join(args.generated_dir, Const.DEFAULT_CSV_FILE_NAME)]
+
+    rows: dict[str, dict] = {}
+    for csv_path in csv_paths:
+        with open(csv_path, 'r', newline='') as assets_csv:
+            for row in csv.DictReader(assets_csv):
+                rows[image_file_name(row[Const.CSV_FIELD_IMAGE])] = row
+
+    verifier = ExifVerifier(load_exif_config(args.config_path))
+    file_names = sorted(entry.name for entry in os.scandir(gen_image_dir_path)
+                        if entry.is_file() and entry.name.lower().endswith('.png'))
+    for file_name in file_names:
+        if file_name not in rows:
+            verifier.missing(file_name, 'image has no metadata CSV row')
+    for file_name in sorted(rows.keys() - set(file_names)):
+        verifier.missing(file_name, 'image file is missing')
+
+    file_paths = [os.path.join(gen_image_dir_path, file_name) for file_name in file_names if file_name in rows]
+    batches = [file_paths[i:i + args.batch_size] for i in range(0, len(file_paths), args.batch_size)]
+    num_workers = max(min(args.num_workers, len(batches)), 1)
+    print(f'Checking [{len(file_paths)}] images in [{len(batches)}] batches '
+          f'with [{num_workers}] worker processes...')
+
+    with multiprocessing.get_context('spawn').Pool(num_workers, initializer=init_worker,
+                                                   initargs=(verifier.tags,)) as pool:
+        for batch_paths, batch_metadata in pool.imap_unordered(read_tags, batches):
+            unread = set(map(os.path.basename, batch_paths))
+            for metadata in batch_metadata:
+                file_name = os.path.basename(metadata['SourceFile'])
+                verifier.verify(file_name, rows[file_name], metadata)
+                unread.discard(file_name)
+            for file_name in sorted(unread):
+                verifier.missing(file_name, 'exiftool could not read the image')
+            print('.', end='', flush=True)
+    print()
+
+    mismatches_csv_path = os.path.join(args.generated_dir, Const.EXIF_MISMATCHES_FILE_NAME)
+    verifier.write_csv(mismatches_csv_path)
+
+    print(f'\nEXIF MISMATCHES: {len(verifier.mismatches)} in [{verifier.num_checked}] images '
+          f'(see {mismatches_csv_path})')
+    for file_name, tag, expected, actual in verifier.mismatches[:20]:
+        if tag:
+            print(f'  {file_name} {tag}: expected [{expected}] but found [{actual}]')
+        else:
+            print(f'  {file_name}: {actual}')
+    print(f'TOTAL TIME: {time.perf_counter() - p_start:.03f}s')
+
+    sys.stdout.flush()
+    exit(1 if verifier.mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,10 +18,19 @@ from yaml import SafeLoader
 from exiftool import ExifTool
 
 
+def load_exif_config(config_path: str = 'exif_metadata.yaml'):
+    """
+    Load the EXIF metadata config YAML file.
+    :param config_path: path to the YAML config file.
+    :return: config data.
+    """
+    with open(config_path, 'r') as exif_config_file:
+        return yaml.load(exif_config_file, Loader=SafeLoader)
+
+
 class ExifUpdater:
     def __init__(self):
-        with open('exif_metadata.yaml', 'r') as exif_config_file:
-            self.data = yaml.load(exif_config_file, Loader=SafeLoader)
+        self.data = load_exif_config()
 
         subject = self.data['subject']
         contact = self.data['contact']
@@ -54,8 +63,13 @@ class ExifUpdater:
         self.exiftool = ExifTool(common_args=common_args)
         self.exiftool.run()
 
+    def close(self):
+        # ends the stay-open exiftool process (safe to call more than once)
+        if self.exiftool.running:
+            self.exiftool.terminate()
+
     def __del__(self):
-        self.exiftool.terminate()
+        self.close()
 
     def update_metadata(self, file_path, file_name, image_name, image_desc, traits_str):
         details = image_desc + ' :: ' + traits_str
@@ -66,3 +80,22 @@ class ExifUpdater:
             file_path
         )
         # print(self.exiftool.last_stderr)
+
+    def update_metadata_batch(self, tokens: list[tuple[str, str, str]]):
+        """
+        Update several image files with one exiftool command (a separate `-execute` per file, so only one
+        round trip to the exiftool process is needed for the whole batch).
+        :param tokens: file path, image description, and traits JSON string of each image file.
+        """
+        params = []
+        for file_path, image_desc, traits_str in tokens:
+            if params:
+                params.append('-execute')
+            details = image_desc + ' :: ' + traits_str
+            params.extend([
+                f'-comment={details}',
+                f'-title={image_desc}',
+                f'-description={details}',
+                file_path
+            ])
+        self.exiftool.execute(*params)
@@ -14,14 +14,31 @@
 #
 
 import argparse
-import csv
+import dataclasses
+import itertools
+import math
 import os
 import random
 import sys
 import time
 import datetime
 
-from exif_updater import *
+from compositor_backends import BACKENDS, create_backend
+from image_archive import ARCHIVE_FILE_NAMES, ARCHIVE_FORMATS, TokenArchiveWriter, create_archive_writer
+from ipfs_car import CarWriter, cid_string, file_dag
+from journal import GenerationJournal, journal_path
+from layer_cache import LayerCache
+from metadata_sinks import METADATA_SINKS, MetadataSink, create_metadata_sinks
+from metrics import ProgressReporter, RunMetrics
+from pixel_dupes import PixelDeduper, PixelIndex
+from rarity import trait_matrix, write_rarity_report
+from png_encoding import PNG_FILTERS, PNG_PROFILES, PNG_STRATEGIES, required_bit_depth
+from render_pipeline import RenderPipeline
+from render_pool import RenderPool
+from renderer import Renderer, RenderSettings, create_renderer
+from sampler import WeightedComboSampler
+from shared_pixels import SharedTraitPixels
+from trait_rules import DEFAULT_RULES_PATH, TraitRules
 from util import *
 
 layers_dir_path_str = Const.DEFAULT_LAYERS_DIR
@@ -42,8 +59,30 @@ num_generated = 0
 num_to_generate = -1
 max_possible = 0
 verbose = False
-
-exif_updater = ExifUpdater()
+sampler_name = 'exact'
+num_trials = 0
+progress_secs = 2.0
+
+shard_start = 0
+shard_stop = 0
+
+trait_rules: TraitRules | None = None
+weighted_sampler: WeightedComboSampler | None = None
+journal: GenerationJournal | None = None
+renderer: Renderer | None = None
+render_pool: RenderPool | None = None
+render_pipeline: RenderPipeline | None = None
+run_metrics: RunMetrics | None = None
+pixel_index: PixelIndex | None = None
+pixel_deduper: PixelDeduper | None = None
+# trait indices of every image in the CSV (only kept for the rarity report)
+generated_trait_indices: list[tuple[int, ...]] | None = None
+car_writer: CarWriter | None = None
+token_archive: TokenArchiveWriter | None = None
+
+# metadata sinks are flushed (and then the tokens journaled) after this many tokens or seconds
+METADATA_BATCH_SIZE = 256
+METADATA_BATCH_SECS = 1.0
 
 
 def main():
@@ -68,6 +107,184 @@ def main():
         default=False,
         help='verbose output at the cost of slower run time'
     )
+    parser.add_argument(
+        '--progress-secs',
+        dest='progress_secs',
+        type=float,
+        default=2.0,
+        help='seconds between progress lines (images/s and ETA) instead of a line per image (see --verbose)'
+    )
+    parser.add_argument(
+        '-P', '--prefix-cache',
+        dest='prefix_cache',
+        action='store_true',
+        help='when generating ALL, reuse the composite of shared lower layers (uses one extra image per layer)'
+    )
+    parser.add_argument(
+        '--backend', '--compositor',
+        dest='backend',
+        choices=list(BACKENDS.keys()),
+        default='wand',
+        help='load, composite, and encode with ImageMagick (Wand), Pillow, the ImageMagick command line (magick), '
+             'or vectorized NumPy math (ImageMagick is only used to encode)'
+    )
+    parser.add_argument(
+        '-B', '--crop-traits',
+        dest='crop_traits',
+        action='store_true',
+        help='crop each trait image to the bounding box of its non-transparent pixels when it is loaded and only '
+             'composite that region (not supported by the magick backend)'
+    )
+    parser.add_argument(
+        '--png-profile',
+        dest='png_profile',
+        choices=list(PNG_PROFILES.keys()),
+        default='default',
+        help='PNG encoding profile (the options below override the profile; see png_encoding.py for a benchmark)'
+    )
+    parser.add_argument(
+        '--png-level',
+        dest='png_level',
+        type=int,
+        choices=range(0, 10),
+        help='PNG zlib compression level'
+    )
+    parser.add_argument(
+        '--png-filter',
+        dest='png_filter',
+        choices=list(PNG_FILTERS.keys()),
+        help='PNG row filter type'
+    )
+    parser.add_argument(
+        '--png-strategy',
+        dest='png_strategy',
+        choices=list(PNG_STRATEGIES.keys()),
+        help='PNG zlib compression strategy'
+    )
+    parser.add_argument(
+        '--png-depth',
+        dest='png_depth',
+        choices=['8', '16', 'auto'],
+        help='PNG bit depth (auto uses 8-bit unless a trait image needs 16-bit)'
+    )
+    parser.add_argument(
+        '-C', '--cache-mb',
+        dest='cache_mb',
+        type=int,
+        default=0,
+        help='memory budget (in MB per process) for decoded trait images; otherwise all are kept once loaded'
+    )
+    parser.add_argument(
+        '-L', '--layer-cache',
+        dest='layer_cache_dir',
+        help='directory to cache the parsed layers and decoded trait image pixels in between runs (only new or '
+             'changed trait images are decoded again, in parallel)'
+    )
+    parser.add_argument(
+        '-r', '--rules',
+        dest='rules_path',
+        help=f'trait compatibility rules YAML file (default: {DEFAULT_RULES_PATH} if it exists)'
+    )
+    parser.add_argument(
+        '-S', '--sampler',
+        dest='sampler_name',
+        choices=['exact', 'trials'],
+        default='exact',
+        help='random generation strategy: exact weighted sampling or brute force random trials with memoization'
+    )
+    parser.add_argument(
+        '-W', '--workers',
+        dest='num_workers',
+        type=int,
+        default=1,
+        help='number of worker processes to render images with (each worker loads the layers once)'
+    )
+    parser.add_argument(
+        '--shared-traits',
+        dest='shared_traits',
+        action='store_true',
+        help='with --workers, decode the trait images once into shared memory that every worker composites from '
+             '(instead of each worker decoding its own copy)'
+    )
+    parser.add_argument(
+        '--pixel-dupes',
+        dest='pixel_dupes',
+        choices=['off', 'flag', 'redraw'],
+        default='off',
+        help='detect visually identical images by hashing the composite pixels and flag them (in '
+             f'{Const.PIXEL_DUPLICATES_FILE_NAME}) or re-draw them when randomly generating'
+    )
+    parser.add_argument(
+        '--car',
+        dest='car',
+        action='store_true',
+        help=f'compute the IPFS CID of each image as it is saved and stream the images into '
+             f'{Const.CAR_FILE_NAME} (the root CID can be used as the image URL base by update_csv.py)'
+    )
+    parser.add_argument(
+        '--archive',
+        dest='archive',
+        choices=ARCHIVE_FORMATS,
+        help='stream the images (and their ERC-721 JSON) into one tar or zip archive, or the images into a CAR '
+             f'({ARCHIVE_FILE_NAMES["tar"]}, {ARCHIVE_FILE_NAMES["zip"]}, or {ARCHIVE_FILE_NAMES["car"]}) '
+             'instead of image files (needs --inline-metadata; see image_archive.py to extract them)'
+    )
+    parser.add_argument(
+        '--pipeline',
+        dest='pipeline',
+        action='store_true',
+        help='overlap the compose, encode, write, and exiftool stages of consecutive images in threads '
+             '(within each worker process) with bounded queues between the stages'
+    )
+    parser.add_argument(
+        '--check-png',
+        dest='check_png',
+        action='store_true',
+        help='validate each PNG (chunk CRCs and inflated image data) right after it is saved and render it again '
+             'if it is damaged (see png_check.py to check an existing directory)'
+    )
+    parser.add_argument(
+        '--metadata',
+        dest='metadata_sinks',
+        action='append',
+        choices=METADATA_SINKS,
+        default=[],
+        help=f'also write the metadata as ERC-721 JSON files ({Const.GEN_METADATA_SUBDIR}/<token>.json) or a JSON '
+             f'lines manifest ({Const.METADATA_JSONL_FILE_NAME}) in the same pass as the CSV (repeatable)'
+    )
+    parser.add_argument(
+        '--rarity',
+        dest='rarity',
+        action='store_true',
+        help=f'write trait frequencies and rarity scores ({Const.RARITY_CSV_FILE_NAME} and '
+             f'{Const.RARITY_REPORT_FILE_NAME}) when finished (see rarity.py to score an existing CSV)'
+    )
+    parser.add_argument(
+        '-M', '--inline-metadata',
+        dest='inline_metadata',
+        action='store_true',
+        help='write the EXIF/XMP metadata while saving each PNG instead of updating it afterwards with exiftool'
+    )
+    parser.add_argument(
+        '--seed',
+        dest='seed',
+        type=int,
+        help='random seed (the same seed and arguments always generate the same permutations)'
+    )
+    parser.add_argument(
+        '--shard',
+        dest='shard',
+        type=parse_shard,
+        default=(1, 1),
+        help='only render shard "i/n" of the collection (e.g., 2/4) with the image numbers of the whole '
+             'collection; random generation requires --seed so every shard plans the same permutations'
+    )
+    parser.add_argument(
+        '-R', '--resume',
+        dest='resume',
+        action='store_true',
+        help='resume an interrupted run in the existing generated directory (using the same arguments)'
+    )
     parser.add_argument(
         'layers_dir',
         default='./layers',
@@ -106,76 +323,43 @@ def main():
     global num_to_generate
     num_to_generate = args.num_to_generate
 
-    global verbose
+    global verbose, progress_secs
     verbose = args.verbose
+    progress_secs = args.progress_secs
+
+    global sampler_name
+    sampler_name = args.sampler_name
 
-    for layer_dir in sorted(os.scandir(layers_dir_path_str), key=lambda ld: ld.name):
-        if layer_dir.is_dir():
-            layer_dir_name = layer_dir.name
-            print(f'\nFinding trait images in: {layer_dir_name}')
-
-            layer_trait_type = layer_dir_name[(layer_dir_name.find('-') + 1):]
-
-            total_trait_weight = 0
-
-            trait_images: list[TraitImageInfo] = []
-            for layer_file in sorted(os.scandir(layer_dir), key=lambda lf: lf.name):
-                layer_file_name = layer_file.name
-                print(f'  {layer_file_name}')
-
-                layer_trait_value_start = layer_file_name.find(layer_trait_type) + len(layer_trait_type) + 1
-                layer_trait_value_period_index = layer_file_name.rfind('.', layer_trait_value_start)
-                layer_trait_value_end = layer_trait_value_period_index
-
-                layer_trait_value_weight_index = \
-                    layer_file_name.rfind('#', layer_trait_value_start, layer_trait_value_end)
-                layer_trait_weight = 1
-                if layer_trait_value_weight_index != -1:
-                    layer_trait_value_end = layer_trait_value_weight_index
-                    try:
-                        layer_trait_weight = \
-                            int(layer_file_name[layer_trait_value_weight_index + 1:layer_trait_value_period_index])
-                    except ValueError:
-                        pass
-
-                total_trait_weight = total_trait_weight + layer_trait_weight
-
-                layer_trait_value = \
-                    layer_file_name[layer_trait_value_start:layer_trait_value_end].translate(Const.TRAIT_TRANS)
-
-                layer_trait = Trait(
-                    type=layer_trait_type,
-                    value=layer_trait_value,
-                    weight=layer_trait_weight
-                )
-                print(f'    {layer_trait}')
-
-                trait_images.append(TraitImageInfo(
-                    image=Image(filename=layer_file.path),
-                    name=layer_file_name,
-                    path=layer_file.path,
-                    trait=layer_trait
-                ))
-
-            layer_info = LayerInfo(
-                name=layer_dir.name,
-                path=layer_dir.path,
-                trait_type=layer_trait_type,
-                trait_images=trait_images,
-                total_weight=total_trait_weight
-            )
-            print(f'  Total layer weight = {layer_info.total_weight}')
-
-            layers.append(layer_info)
+    # trait images are only decoded when first used (by the renderer or each worker) unless they are cached
+    global layers
+    layer_cache = LayerCache(args.layer_cache_dir) if args.layer_cache_dir is not None else None
+    if layer_cache is not None:
+        layers = layer_cache.load_layers(layers_dir_path_str)
+    else:
+        layers = load_layers(layers_dir_path_str)
 
     global num_layers
     num_layers = len(layers)
     print(f'\nLayers discovered: {num_layers}')
 
+    global trait_rules
+    try:
+        trait_rules = TraitRules.load(layers, args.rules_path)
+    except (OSError, ValueError) as e:
+        print(f'Cannot load the trait rules: {e}')
+        sys.stdout.flush()
+        exit(4)
+
     global max_possible
     max_possible = 1
     for layer in layers:
         max_possible *= len(layer.trait_images)
+    if trait_rules:
+        # counted from the rule masks without enumerating the permutations
+        unconstrained = max_possible
+        max_possible = trait_rules.count()
+        print(f'Trait rules exclude [{len(trait_rules.exclusions)}] trait pairs '
+              f'([{unconstrained - max_possible}] permutations)')
     print(f'Max possible permutations: {max_possible}\n')
 
     if num_to_generate > max_possible:
@@ -183,135 +367,529 @@ def main():
         sys.stdout.flush()
         exit(1)
 
-    # Deleting content can cause data loss (e.g., if the wrong dir is passed in).
-    # Just warn the user, so they can move or delete the directory themselves.
+    shard_index, num_shards = args.shard
+    if num_shards > 1 and num_to_generate > 0 and args.seed is None:
+        print('Cannot shard random generation without a --seed (every shard must plan the same permutations)')
+        sys.stdout.flush()
+        exit(1)
+
+    # shards are contiguous ranges of the image numbers (of ALL permutations or the planned random permutations)
+    global shard_start, shard_stop
+    num_total = num_to_generate if num_to_generate > 0 else max_possible
+    shard_start = (shard_index - 1) * num_total // num_shards
+    shard_stop = shard_index * num_total // num_shards
+    if num_shards > 1:
+        print(f'Shard [{shard_index}/{num_shards}] generates images [{shard_start + 1}] to [{shard_stop}]\n')
+
+    if args.archive is not None and not args.inline_metadata:
+        print('Archived images cannot be updated by exiftool (use --inline-metadata with --archive)')
+        sys.stdout.flush()
+        exit(1)
+    if args.archive is not None and args.resume:
+        print('Cannot resume an archive (the journaled images are not image files)')
+        sys.stdout.flush()
+        exit(1)
+
+    pixel_redraw = args.pixel_dupes == 'redraw' and num_to_generate > 0
+    if args.pixel_dupes == 'redraw' and not pixel_redraw:
+        print('Visually identical images can only be re-drawn when randomly generating (flagging them instead)\n')
+
+    # the random seed is journaled so a resumed run can replay the same random permutations
+    journal_settings = {
+        'seed': args.seed if args.seed is not None else random.randrange(2 ** 32),
+        'num_to_generate': num_to_generate,
+        'sampler': sampler_name,
+        'shard': f'{shard_index}/{num_shards}',
+        'nft_name_prefix': nft_name_prefix,
+        'nft_description_prefix': nft_description_prefix,
+        # re-drawing visually identical permutations changes which permutations are generated
+        'pixel_dupes': 'redraw' if pixel_redraw else None,
+        'rules': trait_rules.fingerprint(),
+        # the metadata sinks must have every token (not only the ones rendered after resuming)
+        'metadata': sorted(set(args.metadata_sinks)) or None
+    }
+
+    global journal
+    if args.resume:
+        try:
+            journal = GenerationJournal.resume(journal_path(gen_dir_path_str), gen_image_dir_path)
+        except OSError as e:
+            print('Cannot resume without a generation journal:')
+            print('  ' + e.strerror)
+            sys.stdout.flush()
+            exit(3)
+
+        mismatched = [k for k, v in journal_settings.items()
+                      if (k != 'seed' or args.seed is not None) and journal.settings.get(k) != v]
+        if mismatched:
+            print(f'Cannot resume with different arguments than the original run: {mismatched}')
+            sys.stdout.flush()
+            exit(3)
+
+        print(f'Resuming after [{len(journal.entries)}] journaled images...\n')
+    else:
+        # Deleting content can cause data loss (e.g., if the wrong dir is passed in).
+        # Just warn the user, so they can move or delete the directory themselves.
+        try:
+            os.makedirs(gen_image_dir_path, exist_ok=False)
+        except OSError as e:
+            print('Generated directory already exists or other OS error encountered:')
+            print('  ' + e.strerror)
+            sys.stdout.flush()
+            exit(2)
+
+        journal = GenerationJournal.create(journal_path(gen_dir_path_str), journal_settings)
+
+    # created right after the journal (and truncated to the journaled tokens when resuming)
     try:
-        os.makedirs(gen_image_dir_path, exist_ok=False)
-    except OSError as e:
-        print(f'Generated directory already exists or other OS error encountered:')
-        print('  ' + e.strerror)
+        metadata_sinks = create_metadata_sinks(gen_dir_path_str, args.metadata_sinks,
+                                               len(journal.entries) if args.resume else None)
+    except ValueError as e:
+        print(f'Cannot resume: {e}')
         sys.stdout.flush()
-        exit(2)
+        exit(3)
+
+    random.seed(journal.settings['seed'])
+
+    png_profile = PNG_PROFILES[args.png_profile]
+    if args.png_level is not None:
+        png_profile = dataclasses.replace(png_profile, compression_level=args.png_level)
+    if args.png_filter is not None:
+        png_profile = dataclasses.replace(png_profile, compression_filter=args.png_filter)
+    if args.png_strategy is not None:
+        png_profile = dataclasses.replace(png_profile, compression_strategy=args.png_strategy)
+    if args.png_depth is not None:
+        png_depth = required_bit_depth(layers) if args.png_depth == 'auto' else int(args.png_depth)
+        png_profile = dataclasses.replace(png_profile, bit_depth=png_depth)
+    print(f'PNG encoding profile: {png_profile}\n')
+
+    render_settings = RenderSettings(
+        gen_image_dir_path=gen_image_dir_path,
+        backend=args.backend,
+        crop_traits=args.crop_traits,
+        cache_max_bytes=args.cache_mb * 2 ** 20,
+        use_prefix_cache=args.prefix_cache and num_to_generate <= 0,
+        inline_metadata=args.inline_metadata,
+        png_profile=png_profile,
+        pixel_hash=args.pixel_dupes != 'off' and not pixel_redraw,
+        layer_cache_dir=args.layer_cache_dir,
+        unixfs_dag=args.car or args.archive == 'car',
+        check_png=args.check_png,
+        pipeline=args.pipeline,
+        archive=args.archive
+    )
 
-    with open(gen_assets_csv_path, 'w', newline='') as csvfile:
-        csvwriter = csv.DictWriter(csvfile, fieldnames=Const.CSV_FIELDNAMES)
-        csvwriter.writeheader()
+    if layer_cache is not None:
+        backend = create_backend(args.backend)
+        if backend.raw_decoder is None:
+            print(f'The [{args.backend}] backend does not decode trait images '
+                  f'so the layer cache only has the layers\n')
+        else:
+            p_start = time.perf_counter()
+            num_decoded = layer_cache.update(layers, backend, os.cpu_count())
+            print(f'Layer cache decoded [{num_decoded}] new or changed trait images '
+                  f'in {time.perf_counter() - p_start:.03f}s\n')
+
+    global renderer, render_pool, render_pipeline, run_metrics, pixel_index, pixel_deduper, \
+        generated_trait_indices, car_writer
+    global token_archive
+    run_metrics = RunMetrics()
+    if render_settings.unixfs_dag:
+        car_writer = CarWriter(os.path.join(gen_dir_path_str, Const.CAR_FILE_NAME))
+        # the CAR file is written again when resuming, so only the journaled images have to be read back
+        for entry in journal.entries:
+            with open(os.path.join(gen_image_dir_path, entry.file_name), 'rb') as image_file:
+                car_writer.add_file(entry.file_name, file_dag(image_file.read()))
+    if args.archive in ('tar', 'zip'):
+        token_archive = create_archive_writer(gen_dir_path_str, args.archive)
+    if args.rarity:
+        generated_trait_indices = [entry.trait_indices for entry in journal.entries]
+    if render_settings.pixel_hash:
+        pixel_index = PixelIndex()
+        for entry in journal.entries:
+            if entry.pixel_digest is not None:
+                pixel_index.add(entry.pixel_digest, entry.file_name)
+    # re-drawing visually identical permutations reuses composites made in this process, so it renders here too
+    num_workers = 1 if pixel_redraw else args.num_workers
+    if num_workers < args.num_workers:
+        print('Visually identical images are re-drawn from composites made in this process, so they are rendered '
+              'here too (instead of by worker processes)\n')
+    shared_pixels = None
+    if args.shared_traits and num_workers > 1:
+        backend = create_backend(args.backend, args.crop_traits, layer_cache)
+        if backend.raw_decoder is None:
+            print(f'The [{args.backend}] backend does not decode trait images so they cannot be shared\n')
+        else:
+            p_start = time.perf_counter()
+            shared_pixels = SharedTraitPixels.create(layers, backend)
+            render_settings = dataclasses.replace(render_settings, shared_traits=shared_pixels.index)
+            print(f'Shared [{len(shared_pixels.index.traits)}] decoded trait images '
+                  f'({shared_pixels.num_bytes / 2 ** 20:.01f}MB) in {time.perf_counter() - p_start:.03f}s')
+    if num_workers > 1:
+        print(f'Rendering with [{num_workers}] worker processes...')
+        render_pool = RenderPool(num_workers, layers_dir_path_str, render_settings)
+    else:
+        renderer = create_renderer(layers, render_settings)
+        if args.pipeline:
+            render_pipeline = RenderPipeline(renderer)
+        if pixel_redraw:
+            pixel_deduper = PixelDeduper(renderer)
 
+    try:
         if num_to_generate > 0:
             print(f'Generating [{num_to_generate}] image permutations...')
-            generate_weighted_images(csvwriter)
+            generate_images(metadata_sinks, generate_weighted_images())
         else:
             print('Generating ALL image permutations...')
-            generate_all_images(csvwriter, [])
-
-    print(f'\nGENERATED: {num_generated}')
+            if num_shards > 1:
+                # ALL permutations can start right at the shard (numbered as if the earlier ones were generated)
+                global num_generated
+                num_generated = shard_start
+                generate_images(metadata_sinks, generate_all_images_in_range(shard_start, shard_stop))
+            else:
+                generate_images(metadata_sinks, generate_all_images([]))
+    finally:
+        for sink in metadata_sinks:
+            sink.close()
+        if token_archive is not None:
+            token_archive.close()
+
+    journal.close()
+
+    if render_pool is not None:
+        render_pool.close()
+        cache_stats = render_pool.cache_stats()
+        print(f'\nTRAIT IMAGE CACHE: {cache_stats}')
+        if shared_pixels is not None:
+            shared_pixels.close()
+    else:
+        cache_stats = renderer.image_cache.stats
+        print(f'\nTRAIT IMAGE CACHE: {cache_stats}')
+        if renderer.prefix_cache is not None:
+            print(f'PREFIX CACHE COMPOSITES: {renderer.prefix_cache.num_composites} '
+                  f'(instead of {run_metrics.render.count * (num_layers - 1)})')
+        if render_pipeline is not None:
+            render_pipeline.close()
+        renderer.close()
+
+    print('\nSTAGE TIMES (per image, summed across workers):')
+    run_metrics.print_summary()
+
+    # the image numbers of a shard start after the earlier shards' images
+    num_shard_generated = max(0, num_generated - shard_start)
+    if num_shards > 1:
+        print(f'\nGENERATED: {num_shard_generated} (images [{shard_start + 1}] to [{num_generated}] '
+              f'of shard [{shard_index}/{num_shards}])')
+    else:
+        print(f'\nGENERATED: {num_shard_generated}')
+    if args.resume:
+        print(f'RENDERED: {run_metrics.render.count} (after resuming)')
+
+    if pixel_index is not None:
+        pixel_duplicates_path = os.path.join(gen_dir_path_str, Const.PIXEL_DUPLICATES_FILE_NAME)
+        pixel_index.write_csv(pixel_duplicates_path)
+        print(f'PIXEL DUPLICATES FLAGGED: {len(pixel_index.duplicates)} (see {pixel_duplicates_path})')
+    if pixel_deduper is not None:
+        print(f'PIXEL DUPLICATES RE-DRAWN: {pixel_deduper.num_redrawn}')
+
+    car_root = None
+    if car_writer is not None:
+        directory = car_writer.finish()
+        car_root = cid_string(directory.cid)
+        car_writer.write_cids(os.path.join(gen_dir_path_str, Const.CAR_CIDS_FILE_NAME), directory)
+        print(f'CAR: {car_writer.car_path} ({len(car_writer.entries)} images, root CID: {car_root})')
+    if token_archive is not None:
+        print(f'ARCHIVE: {token_archive.archive_path} ({token_archive.num_tokens} images, '
+              f'{os.path.getsize(token_archive.archive_path)} bytes)')
+
+    if generated_trait_indices is not None:
+        write_rarity_report(layers, trait_matrix(generated_trait_indices, num_layers),
+                            [gen_assets_csv_path], gen_dir_path_str)
+
+    if weighted_sampler is not None:
+        print(f'RANDOM TRIALS AVOIDED: ~{weighted_sampler.trials_saved()} (expected with random trials)')
 
     total_time = time.perf_counter() - main_start
     hms_time = str(datetime.timedelta(seconds=total_time))
     print(f'TOTAL TIME: {total_time:.03f}s == ({hms_time})hms')
 
+    metrics_path = os.path.join(gen_dir_path_str, Const.METRICS_FILE_NAME)
+    run_metrics.write_json(
+        metrics_path,
+        settings={
+            'backend': args.backend,
+            'workers': num_workers,
+            'sampler': sampler_name if num_to_generate > 0 else None,
+            'shard': f'{shard_index}/{num_shards}',
+            'resumed': args.resume,
+            'png_profile': str(png_profile)
+        },
+        totals={
+            'generated': num_generated,
+            'rendered': run_metrics.render.count,
+            'trials': num_trials if num_to_generate > 0 else None,
+            'pixel_duplicates_flagged': len(pixel_index.duplicates) if pixel_index is not None else None,
+            'pixel_duplicates_redrawn': pixel_deduper.num_redrawn if pixel_deduper is not None else None,
+            'car_root': car_root,
+            'total_s': total_time,
+            'render_s': run_metrics.elapsed(),
+            'images_per_s': run_metrics.render.count / max(run_metrics.elapsed(), 1e-9)
+        },
+        trait_image_cache=dataclasses.asdict(cache_stats)
+    )
+    print(f'METRICS: {metrics_path}')
+
 
-def generate_image(csvwriter, parts):
+def parse_shard(shard):
     """
-    Generate a composite image from multiple parts and append metadata to the CSV file.
-    :param csvwriter: writer to use when appending rows into the metadata CSV.
-    :param parts: image parts to use when generating image.
-    :return: `None` if processing should not continue; generated file path otherwise.
+    Parse a shard argument such as `2/4`.
+    :param shard: shard argument string.
+    :return: tuple of the (1-based) shard index and the number of shards.
     """
+    try:
+        shard_index, num_shards = map(int, shard.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'shard must look like i/n (e.g., 2/4): {shard}')
+    if not 1 <= shard_index <= num_shards:
+        raise argparse.ArgumentTypeError(f'shard index must be from 1 to {num_shards}: {shard}')
+    return shard_index, num_shards
 
-    global num_generated, num_to_generate
-    if 0 < num_to_generate <= num_generated:
-        return None
-
-    generated = None
-
-    p_start = time.perf_counter()
-
-    traits: list[str] = []
-    for image_part in parts:
-        traits.append(image_part.trait.csv_json())
-
-        # grab the cached part image first
-        image = image_part.image
 
-        if generated is None:
-            # start with a copy of the cached image
-            generated = Image(image)
-        else:
-            # composite the cached image over the current image
-            generated.composite(image)
+def next_render_job(parts):
+    """
+    Assign the next image number to a combination of image parts.
+    :param parts: image parts to use when generating image.
+    :return: the job to render the numbered image.
+    """
 
+    global num_generated
     num_generated += 1
-    file_name = f'{num_generated:05}.png'
-    file_path = os.path.join(gen_image_dir_path, file_name)
-    generated.save(filename=file_path)
-    generated.close()
-
-    image_name = f'{nft_name_prefix}{num_generated}'
-    image_desc = f'{nft_description_prefix}{num_generated}'
-    traits_str = join_traits(traits)
 
-    while not os.path.exists(file_path):
-        time.sleep(.1)
+    traits = list(map(lambda ti: ti.trait.attribute_json, parts))
 
-    exif_updater.update_metadata(
-        file_path=file_path,
-        file_name=file_name,
-        image_name=image_name,
-        image_desc=image_desc,
-        traits_str=traits_str
+    return RenderJob(
+        index=num_generated,
+        trait_indices=tuple(map(lambda ti: ti.index, parts)),
+        file_name=f'{num_generated:05}.png',
+        image_name=f'{nft_name_prefix}{num_generated}',
+        image_desc=f'{nft_description_prefix}{num_generated}',
+        traits_str=join_traits(traits)
     )
 
-    p_stop = time.perf_counter()
-    print(f'[{p_stop - p_start:.03f}s] {file_path}')
-    if verbose:
-        print(str(traits))
 
-    csvwriter.writerow({
-        Const.CSV_FIELD_NAME: image_name,
-        Const.CSV_FIELD_DESC: image_desc,
-        Const.CSV_FIELD_IMAGE: file_name,
-        Const.CSV_FIELD_ATTS: traits_str
-    })
+def generate_images(metadata_sinks: list[MetadataSink], parts_iter):
+    """
+    Generate a composite image for each combination of parts and write its metadata to every metadata sink.
+    Images are rendered by the worker pool (if enabled) but metadata is always written in image number order.
+    Metadata is flushed in batches and each finished image is recorded in the journal after its metadata
+    is flushed.
+    :param metadata_sinks: metadata sinks to write the metadata of each image to (see `create_metadata_sinks`).
+    :param parts_iter: iterator of image parts to use when generating each image.
+    """
 
-    return GeneratedImageInfo(file_name, file_path, traits_str)
+    jobs = map(next_render_job, parts_iter)
+
+    # skip the planned random permutations that belong to earlier shards (without rendering)
+    while num_generated < shard_start:
+        job = next(jobs, None)
+        if job is None:
+            break
+        if pixel_deduper is not None:
+            pixel_deduper.discard(job.trait_indices)
+
+    # replay the journaled permutations (without rendering) so the numbering and random state continue exactly
+    for entry in journal.entries:
+        job = next(jobs, None)
+        if job is None or job.trait_indices != entry.trait_indices:
+            raise ValueError(f'Journal does not match the permutations being generated at image [{entry.index}] '
+                             f'(were the layers changed?)')
+        if pixel_deduper is not None:
+            pixel_deduper.discard(job.trait_indices)
+
+    if render_pool is not None:
+        results = render_pool.render(jobs)
+    else:
+        results = render_pipeline.render(jobs) if render_pipeline is not None else render_in_batches(jobs)
+
+    num_rendered = 0
+    progress = ProgressReporter(shard_stop - shard_start - len(journal.entries), progress_secs)
+    weighted = num_to_generate > 0
+
+    # rendered tokens (and their checksum and pixel digest) whose metadata isn't flushed (and journaled) yet
+    pending: list[tuple[RenderJob, str, str | None]] = []
+    p_flush = time.perf_counter()
+
+    def flush_pending():
+        p_start = time.perf_counter()
+        for sink in metadata_sinks:
+            sink.flush()
+        p_sinks = time.perf_counter()
+        for pending_job, checksum, pixel_digest in pending:
+            journal.append(pending_job, checksum, pixel_digest, flush=False)
+        journal.flush()
+        run_metrics.add('sinks_flush', p_sinks - p_start)
+        run_metrics.add('journal', time.perf_counter() - p_sinks)
+        pending.clear()
+        return time.perf_counter()
+
+    for job, result in results:
+        if verbose:
+            print(f'[{result.elapsed:.03f}s] {os.path.join(gen_image_dir_path, job.file_name)}')
+            print(job.traits_str)
+
+        p_start = time.perf_counter()
+        for sink in metadata_sinks:
+            sink.write(job)
+        p_sinks = time.perf_counter()
+
+        pending.append((job, result.checksum, result.pixel_digest))
+        if len(pending) >= METADATA_BATCH_SIZE or p_sinks - p_flush >= METADATA_BATCH_SECS:
+            p_flush = flush_pending()
+
+        if car_writer is not None:
+            p_car = time.perf_counter()
+            car_writer.add_file(job.file_name, result.unixfs)
+            run_metrics.add('car', time.perf_counter() - p_car)
+
+        if token_archive is not None:
+            p_archive = time.perf_counter()
+            token_archive.add(job, result.png_bytes)
+            run_metrics.add('archive', time.perf_counter() - p_archive)
+
+        if pixel_index is not None:
+            first_image = pixel_index.add(result.pixel_digest, job.file_name)
+            if first_image is not None:
+                print(f'PIXEL DUPLICATE: {job.file_name} is visually identical to {first_image}')
+
+        if generated_trait_indices is not None:
+            generated_trait_indices.append(job.trait_indices)
+
+        run_metrics.add_result(result)
+        run_metrics.add('sinks', p_sinks - p_start)
+
+        num_rendered += 1
+        progress.update(num_rendered, num_trials if weighted else None)
+
+    flush_pending()
+    progress.update(num_rendered, num_trials if weighted else None, force=True)
+
+
+def render_in_batches(jobs, batch_size=8):
+    """
+    Render the jobs in this process in small batches (so batch compositing backends like NumPy can composite them
+    together).
+    :param jobs: iterator of tokens to render.
+    :return: iterator of `(job, result)` in the same order as the jobs.
+    """
+    jobs_iter = iter(jobs)
+    while batch := list(itertools.islice(jobs_iter, batch_size)):
+        yield from zip(batch, renderer.render_batch(batch))
 
 
-def generate_all_images(csvwriter, parts):
+def generate_all_images(parts, masks=None):
     """
-    Recursively generate all permutations of images possible (using :py:func:`generate_image`).
+    Recursively generate all permutations of images possible (to be rendered by :py:func:`generate_images`).
     Note that the image numbers will be "predictable" because they're generated in the order of traversal.
-    :param csvwriter: writer to use when appending rows into the metadata CSV.
     :param parts: image parts to use when generating image (use `[]` for initial call).
-    :return: `True` if processing should continue; `False` otherwise
+    :param masks: allowed trait masks of the remaining layers (see :py:class:`trait_rules.TraitRules`).
+    :return: iterator of image parts for each permutation.
     """
 
     parts_len = len(parts)
+    if masks is None:
+        masks = trait_rules.initial_masks()
 
-    global num_layers
     if parts_len == num_layers:
-        return generate_image(csvwriter, parts) is not None
+        yield parts.copy()
     else:
-        global layers
         for layer_index in range(parts_len, parts_len + 1):
             layer_info = layers[layer_index]
             layer_images = layer_info.trait_images
             new_parts = parts.copy()
             for layer_image in layer_images:
+                # prune the branches of traits excluded by the trait rules
+                if not masks[0] >> layer_image.index & 1:
+                    continue
                 new_parts.append(layer_image)
-                if not generate_all_images(csvwriter, new_parts):
-                    return False
+                yield from generate_all_images(new_parts,
+                                               trait_rules.choose(masks, layer_index, layer_image.index))
                 new_parts.pop()
 
-    return True
 
+def generate_all_images_in_range(start, stop):
+    """
+    Generate a range of all permutations (in the same order as :py:func:`generate_all_images`) without walking
+    the permutations before the range. The permutation index is a mixed-radix number with a digit per layer.
+    :param start: index of the first permutation to generate.
+    :param stop: index after the last permutation to generate.
+    :return: iterator of image parts for each permutation.
+    """
+
+    if trait_rules:
+        # with rules the allowed permutations aren't a mixed-radix range, so skip whole branches by their counts
+        for trait_indices in trait_rules.walk(start, stop):
+            yield [layers[layer_index].trait_images[trait_index]
+                   for layer_index, trait_index in enumerate(trait_indices)]
+        return
+
+    radices = list(map(lambda li: len(li.trait_images), layers))
+    trait_indices = [0] * num_layers
+    remainder = start
+    for layer_index in range(num_layers - 1, -1, -1):
+        remainder, trait_indices[layer_index] = divmod(remainder, radices[layer_index])
+
+    for _ in range(start, stop):
+        yield [layers[layer_index].trait_images[trait_index]
+               for layer_index, trait_index in enumerate(trait_indices)]
+
+        # increment the mixed-radix permutation index
+        for layer_index in range(num_layers - 1, -1, -1):
+            trait_indices[layer_index] += 1
+            if trait_indices[layer_index] < radices[layer_index]:
+                break
+            trait_indices[layer_index] = 0
 
-def generate_weighted_images(csvwriter):
+
+def generate_weighted_images():
     """
-    Randomly generate permutations of images using trait value weights (using :py:func:`generate_image`).
+    Randomly generate permutations of images using trait value weights
+    (to be rendered by :py:func:`generate_images`).
+    Note that the image numbers will be "unpredictable" because the permutations are randomly generated.
+    Also note that it will not generate duplicates (see :py:class:`sampler.WeightedComboSampler`).
+    :return: iterator of image parts for each unique permutation.
+    """
+
+    if sampler_name == 'trials':
+        yield from generate_trial_images()
+        return
+
+    global weighted_sampler, num_trials
+    weighted_sampler = WeightedComboSampler(list(map(lambda li: li.weights, layers)), rules=trait_rules)
+
+    while num_generated < shard_stop:
+        if weighted_sampler.remaining_weight() <= 0:
+            print('All permutations with non-zero weights have been generated')
+            return
+
+        trait_indices = weighted_sampler.sample()
+        num_trials += 1
+        parts = [layers[layer_index].trait_images[trait_index]
+                 for layer_index, trait_index in enumerate(trait_indices)]
+
+        # the sampler never draws the same permutation again so a visually identical one is simply skipped
+        if pixel_deduper is not None and not pixel_deduper.is_unique(parts):
+            continue
+
+        yield parts
+
+
+def generate_trial_images():
+    """
+    Randomly generate permutations of images using trait value weights
+    (to be rendered by :py:func:`generate_images`).
     Note that the image numbers will be "unpredictable" because the permutations are randomly generated.
     Also note that it will not generate duplicates but large sets may take a little more time to generate.
-    :param csvwriter: writer to use when appending rows into the metadata CSV.
+    :return: iterator of image parts for each unique permutation.
     """
 
     # NOTE:
@@ -323,9 +901,22 @@ def generate_weighted_images(csvwriter):
     p_last = time.perf_counter()
     memo: set[str] = set()
 
-    global num_generated
-    while num_generated < num_to_generate:
+    # the trials only draw traits with non-zero weights (and pixel duplicates are skipped after being memoized)
+    nonzero_masks = tuple(sum(1 << index for index, weight in enumerate(layer.weights) if weight)
+                          for layer in layers)
+    if trait_rules:
+        num_possible = trait_rules.count(masks=nonzero_masks)
+    else:
+        num_possible = math.prod(mask.bit_count() for mask in nonzero_masks)
+
+    global num_trials
+    while num_generated < shard_stop:
+        if len(memo) >= num_possible:
+            print('All permutations with non-zero weights have been generated')
+            return
+
         trials += 1
+        num_trials += 1
         parts = []
         for layer_index in range(0, num_layers):
             layer_info = layers[layer_index]
@@ -336,23 +927,29 @@ def generate_weighted_images(csvwriter):
             )[0]
             parts.append(layer_image)
 
+        # brute force trials can only reject the permutations that break the trait rules
+        if trait_rules and not trait_rules.is_allowed(tuple(map(lambda ti: ti.index, parts))):
+            continue
+
         # use the traits string to establish a hash string for the memo set
-        traits = list(map(lambda ti: ti.trait.csv_json(), parts))
+        traits = list(map(lambda ti: ti.trait.attribute_json, parts))
         traits_str = join_traits(traits)
 
         # only generate if we haven't encountered this combination of traits yet
         if traits_str not in memo:
-            gen_info = generate_image(csvwriter, parts)
-            file_path = gen_info.file_path
-            if file_path is not None:
-                # generated a valid image file so add to memo and reset counters
-                memo.add(traits_str)
+            memo.add(traits_str)
+
+            if pixel_deduper is not None and not pixel_deduper.is_unique(parts):
+                continue
 
+            if verbose:
                 p_now = time.perf_counter()
                 print(f'[{p_now - p_last:.03f}s] random trials: {trials}')
                 p_last = p_now
 
-                trials = 0
+            trials = 0
+
+            yield parts
 
 
 if __name__ == '__main__':
@@ -0,0 +1,304 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import fnmatch
+import io
+import os
+import tarfile
+import time
+import zipfile
+from abc import ABC, abstractmethod
+
+from ipfs_car import CarReader
+from metadata_sinks import BUFFER_SIZE, erc721_json
+from util import *
+
+# the CAR archive is the IPFS images directory (see `ipfs_car.CarWriter`) so it only has the images
+ARCHIVE_FORMATS = ['tar', 'zip', 'car']
+
+ARCHIVE_FILE_NAMES = {
+    'tar': Const.TAR_FILE_NAME,
+    'zip': Const.ZIP_FILE_NAME,
+    'car': Const.CAR_FILE_NAME
+}
+
+
+def image_member_name(file_name: str) -> str:
+    return f'{Const.GEN_IMAGE_SUBDIR}/{file_name}'
+
+
+def metadata_member_name(index: int) -> str:
+    return f'{Const.GEN_METADATA_SUBDIR}/{index}.json'
+
+
+class TokenArchiveWriter(ABC):
+    """
+    Appends the image and ERC-721 metadata JSON of every token to one archive file (in image number order),
+    instead of writing thousands of small files. The members are named like the files of a generated directory
+    (`images/00001.png` and `metadata/1.json`) so extracting the archive recreates them.
+    """
+
+    def __init__(self, archive_path: str):
+        self.archive_path = archive_path
+        self.archive_file = open(archive_path, 'xb', buffering=BUFFER_SIZE)
+        # every member has the time the run started
+        self.mtime = time.time()
+        self.num_tokens = 0
+
+    def add(self, job: RenderJob, png_bytes: bytes):
+        """
+        :param job: rendered token.
+        :param png_bytes: final image file bytes (with its metadata).
+        """
+        self.add_member(image_member_name(job.file_name), png_bytes)
+        self.add_member(metadata_member_name(job.index), erc721_json(job).encode('utf-8'))
+        self.num_tokens += 1
+
+    @abstractmethod
+    def add_member(self, name: str, data: bytes):
+        pass
+
+    def close(self):
+        self.archive_file.close()
+
+
+class TarArchiveWriter(TokenArchiveWriter):
+    """
+    Uncompressed tar archive (the images are already compressed).
+    """
+
+    def __init__(self, tar_path: str):
+        super().__init__(tar_path)
+        self.tar_file = tarfile.open(fileobj=self.archive_file, mode='w')
+
+    def add_member(self, name: str, data: bytes):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.tar_file.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.tar_file.close()
+        super().close()
+
+
+class AppendOnlyFile:
+    """
+    File wrapper without `seek` and `tell`, so zipfile writes a data descriptor after each member instead of
+    seeking back to fill in its local header (the archive is written as one sequential stream).
+    """
+
+    def __init__(self, file):
+        self.file = file
+
+    def write(self, data) -> int:
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+
+class ZipArchiveWriter(TokenArchiveWriter):
+    """
+    Zip archive with the images stored as they are (already compressed) and the metadata JSON deflated.
+    """
+
+    def __init__(self, zip_path: str):
+        super().__init__(zip_path)
+        self.zip_file = zipfile.ZipFile(AppendOnlyFile(self.archive_file), mode='w')
+        self.date_time = time.localtime(self.mtime)[:6]
+
+    def add_member(self, name: str, data: bytes):
+        info = zipfile.ZipInfo(name, self.date_time)
+        info.compress_type = zipfile.ZIP_STORED if name.endswith('.png') else zipfile.ZIP_DEFLATED
+        info.external_attr = 0o644 << 16
+        self.zip_file.writestr(info, data)
+
+    def close(self):
+        self.zip_file.close()
+        super().close()
+
+
+def create_archive_writer(gen_dir_path: str, archive_format: str) -> TokenArchiveWriter:
+    """
+    :param gen_dir_path: generated output directory.
+    :param archive_format: `tar` or `zip` (a CAR archive is written by `ipfs_car.CarWriter`).
+    :return: writer of a new archive in the generated directory.
+    """
+    archive_path = os.path.join(gen_dir_path, ARCHIVE_FILE_NAMES[archive_format])
+    if archive_format == 'tar':
+        return TarArchiveWriter(archive_path)
+    if archive_format == 'zip':
+        return ZipArchiveWriter(archive_path)
+    raise ValueError(f'Tokens cannot be written to a [{archive_format}] archive')
+
+
+class TokenArchiveReader(ABC):
+    """
+    Reads members of an archive on demand (without extracting the whole archive).
+    """
+
+    @abstractmethod
+    def names(self) -> list[str]:
+        pass
+
+    @abstractmethod
+    def read(self, name: str) -> bytes:
+        pass
+
+    def close(self):
+        pass
+
+
+class TarArchiveReader(TokenArchiveReader):
+
+    def __init__(self, tar_path: str):
+        self.tar_file = tarfile.open(tar_path, mode='r:')
+        # reading the member headers skips over the member data
+        self.members = {member.name: member for member in self.tar_file.getmembers() if member.isfile()}
+
+    def names(self) -> list[str]:
+        return list(self.members)
+
+    def read(self, name: str) -> bytes:
+        return self.tar_file.extractfile(self.members[name]).read()
+
+    def close(self):
+        self.tar_file.close()
+
+
+class ZipArchiveReader(TokenArchiveReader):
+
+    def __init__(self, zip_path: str):
+        self.zip_file = zipfile.ZipFile(zip_path)
+
+    def names(self) -> list[str]:
+        return [name for name in self.zip_file.namelist() if not name.endswith('/')]
+
+    def read(self, name: str) -> bytes:
+        return self.zip_file.read(name)
+
+    def close(self):
+        self.zip_file.close()
+
+
+class CarArchiveReader(TokenArchiveReader):
+    """
+    The files of the CAR root directory (named as if they were in the images directory).
+    """
+
+    def __init__(self, car_path: str):
+        self.car_reader = CarReader(car_path)
+        self.entries = {image_member_name(name): cid for name, cid in sorted(self.car_reader.entries().items())}
+
+    def names(self) -> list[str]:
+        return list(self.entries)
+
+    def read(self, name: str) -> bytes:
+        return self.car_reader.read_file(self.entries[name])
+
+    def close(self):
+        self.car_reader.close()
+
+
+def open_archive(archive_path: str) -> TokenArchiveReader:
+    """
+    :param archive_path: tar, zip, or CAR file path (the format is chosen by the file extension).
+    :return: reader of the archive.
+    """
+    archive_format = os.path.splitext(archive_path)[1].lower().lstrip('.')
+    if archive_format == 'tar':
+        return TarArchiveReader(archive_path)
+    if archive_format == 'zip':
+        return ZipArchiveReader(archive_path)
+    if archive_format == 'car':
+        return CarArchiveReader(archive_path)
+    raise ValueError(f'Unknown archive format (expected one of {ARCHIVE_FORMATS}): {archive_path}')
+
+
+def extract_path(output_dir_path: str, name: str) -> str:
+    """
+    :param output_dir_path: directory to extract into.
+    :param name: archive member name.
+    :return: file path to extract the member to.
+    :raises ValueError: if the member would be extracted outside the directory.
+    """
+    relative_path = os.path.normpath(name)
+    if os.path.isabs(relative_path) or relative_path.split(os.sep)[0] == '..':
+        raise ValueError(f'Archive member is outside the output directory: {name}')
+    return os.path.join(output_dir_path, relative_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Image Archive',
+        description='Lists or extracts the images and metadata of a tar, zip, or CAR archive written by '
+                    'generate_nfts.py (only the requested members are read).',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        '-l', '--list',
+        dest='list_only',
+        action='store_true',
+        help='list the matching members instead of extracting them'
+    )
+    parser.add_argument(
+        '-o', '--output-dir',
+        dest='output_dir',
+        help='directory to extract into (default: the directory of the archive, i.e., the generated directory)'
+    )
+    parser.add_argument(
+        'archive',
+        help='archive file path (e.g., ./generated/tokens.tar)'
+    )
+    parser.add_argument(
+        'patterns',
+        nargs='*',
+        help='member names or glob patterns to extract (e.g., "images/0004*.png" or metadata/42.json); '
+             'otherwise ALL'
+    )
+
+    args = parser.parse_args()
+
+    p_start = time.perf_counter()
+    reader = open_archive(args.archive)
+    try:
+        names = [name for name in reader.names()
+                 if not args.patterns or any(fnmatch.fnmatchcase(name, pattern) for pattern in args.patterns)]
+        if args.list_only:
+            for name in names:
+                print(name)
+            return
+
+        output_dir_path = args.output_dir or os.path.dirname(args.archive) or '.'
+        num_bytes = 0
+        for name in names:
+            file_path = extract_path(output_dir_path, name)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            data = reader.read(name)
+            with open(file_path, 'wb') as member_file:
+                member_file.write(data)
+            num_bytes += len(data)
+    finally:
+        reader.close()
+
+    print(f'Extracted [{len(names)}] files ({num_bytes} bytes) into: {output_dir_path}')
+    print(f'TOTAL TIME: {time.perf_counter() - p_start:.03f}s')
+
+
+if __name__ == '__main__':
+    main()
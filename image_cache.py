@@ -0,0 +1,125 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable
+
+from util import TraitImageInfo
+
+
+@dataclass
+class CacheStats:
+    """
+    Trait image cache counters.
+    """
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    peak_bytes: int = 0
+
+    def __add__(self, other):
+        return CacheStats(
+            hits=self.hits + other.hits,
+            misses=self.misses + other.misses,
+            evictions=self.evictions + other.evictions,
+            peak_bytes=self.peak_bytes + other.peak_bytes
+        )
+
+    def __str__(self):
+        return f'hits: {self.hits}, misses: {self.misses}, evictions: {self.evictions}, ' \
+               f'peak: {self.peak_bytes / 2 ** 20:.01f}MB'
+
+
+def load_wand_image(path: str):
+    # imported here so ImageMagick is only required when Wand images are cached
+    from wand.image import Image
+    return Image(filename=path)
+
+
+def wand_image_bytes(image) -> int:
+    from wand.version import QUANTUM_DEPTH
+    # ImageMagick keeps each RGBA channel at the quantum depth it was built with
+    return image.width * image.height * 4 * (QUANTUM_DEPTH // 8)
+
+
+def close_wand_image(image):
+    image.close()
+
+
+class TraitImageCache:
+    """
+    Least recently used cache of decoded trait images that are loaded on first use.
+
+    Images are Wand images by default, but any decoded form can be cached by providing the functions to load,
+    measure, and close it. The least recently used images are closed whenever the total would exceed the budget.
+    """
+
+    def __init__(self, max_bytes: int = 0, load_image: Callable[[str], Any] = load_wand_image,
+                 image_bytes: Callable[[Any], int] = wand_image_bytes,
+                 close_image: Callable[[Any], None] | None = close_wand_image):
+        """
+        :param max_bytes: memory budget for the decoded images (`0` for unlimited).
+        :param load_image: function that decodes an image file.
+        :param image_bytes: function that returns (or estimates) the memory used by a decoded image.
+        :param close_image: function that releases a decoded image (if needed).
+        """
+        self.max_bytes = max_bytes
+        self.load_image = load_image
+        self.image_bytes = image_bytes
+        self.close_image = close_image
+        self.images: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self.num_bytes = 0
+        self.stats = CacheStats()
+
+    def get(self, trait_image: TraitImageInfo) -> Any:
+        """
+        Get the decoded image of a trait (loading it if needed).
+        Note that the image may be closed by a later call so it should be used right away.
+        :param trait_image: trait image file info.
+        :return: the cached image (owned by the cache so it must not be closed by the caller).
+        """
+
+        cached = self.images.get(trait_image.path)
+        if cached is not None:
+            self.stats.hits += 1
+            self.images.move_to_end(trait_image.path)
+            return cached[0]
+
+        self.stats.misses += 1
+        image = self.load_image(trait_image.path)
+        image_bytes = self.image_bytes(image)
+
+        if self.max_bytes > 0:
+            while self.images and self.num_bytes + image_bytes > self.max_bytes:
+                evicted, evicted_bytes = self.images.popitem(last=False)[1]
+                self._close(evicted)
+                self.num_bytes -= evicted_bytes
+                self.stats.evictions += 1
+
+        self.images[trait_image.path] = (image, image_bytes)
+        self.num_bytes += image_bytes
+        self.stats.peak_bytes = max(self.stats.peak_bytes, self.num_bytes)
+        return image
+
+    def close(self):
+        for image, _ in self.images.values():
+            self._close(image)
+        self.images.clear()
+        self.num_bytes = 0
+
+    def _close(self, image):
+        if self.close_image is not None:
+            self.close_image(image)
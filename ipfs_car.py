@@ -0,0 +1,573 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import base64
+import csv
+import hashlib
+import os
+import struct
+import time
+from dataclasses import dataclass, field
+
+from util import *
+
+# multicodec codes
+RAW = 0x55
+DAG_PB = 0x70
+SHA2_256 = 0x12
+MURMUR3_X64_64 = 0x22
+
+# UnixFS data types
+UNIXFS_DIRECTORY = 1
+UNIXFS_FILE = 2
+UNIXFS_HAMT_SHARD = 5
+
+# the default parameters of `ipfs add --cid-version 1` (256KiB chunks as raw leaves in a balanced DAG of 174 links
+# per node, and a directory is sharded (HAMT with 256 buckets) once the names and CIDs of its links add up to
+# 256KiB); not checked against a particular kubo version, so its CIDs can differ if kubo's defaults change
+CHUNK_SIZE = 256 * 1024
+MAX_LINKS = 174
+HAMT_FANOUT = 256
+HAMT_SHARDING_SIZE = 256 * 1024
+
+MASK_64 = 2 ** 64 - 1
+
+
+def varint(value: int) -> bytes:
+    """
+    :param value: unsigned integer.
+    :return: unsigned LEB128 (protobuf and multiformats) varint bytes.
+    """
+    out = bytearray()
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def make_cid(codec: int, block: bytes) -> bytes:
+    """
+    :param codec: multicodec of the block (`RAW` or `DAG_PB`).
+    :param block: block bytes.
+    :return: binary CIDv1 of the block (with a SHA-256 multihash).
+    """
+    return b'\x01' + varint(codec) + bytes((SHA2_256, 32)) + hashlib.sha256(block).digest()
+
+
+def cid_string(cid: bytes) -> str:
+    """
+    :param cid: binary CIDv1.
+    :return: base32 multibase string of the CID (e.g., `bafy...`).
+    """
+    return 'b' + base64.b32encode(cid).decode('ascii').lower().rstrip('=')
+
+
+def read_varint(buffer: bytes, offset: int) -> tuple[int, int]:
+    """
+    :param buffer: bytes to decode from.
+    :param offset: offset of the varint.
+    :return: the decoded unsigned varint and the offset after it.
+    """
+    value = shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def cid_length(buffer: bytes, offset: int) -> int:
+    """
+    :param buffer: bytes that start with a binary CID (at the offset).
+    :param offset: offset of the CID.
+    :return: length of the CID (CIDv0 or CIDv1).
+    """
+    if buffer[offset] == SHA2_256:
+        # CIDv0 is a bare SHA-256 multihash
+        return 34
+    _, end = read_varint(buffer, offset)  # version
+    _, end = read_varint(buffer, end)  # codec
+    _, end = read_varint(buffer, end)  # multihash code
+    digest_size, end = read_varint(buffer, end)
+    return end + digest_size - offset
+
+
+def cid_codec(cid: bytes) -> int:
+    return DAG_PB if cid[0] == SHA2_256 else read_varint(cid, read_varint(cid, 0)[1])[0]
+
+
+def pb_fields(message: bytes):
+    """
+    :param message: encoded protobuf message.
+    :return: iterator of `(field number, value)` (varints as `int` and length delimited fields as `bytes`).
+    """
+    offset = 0
+    while offset < len(message):
+        key, offset = read_varint(message, offset)
+        if key & 7 == 0:
+            value, offset = read_varint(message, offset)
+        elif key & 7 == 2:
+            length, offset = read_varint(message, offset)
+            value = message[offset:offset + length]
+            offset += length
+        else:
+            raise ValueError(f'Unsupported protobuf wire type: {key & 7}')
+        yield key >> 3, value
+
+
+def parse_dag_pb(block: bytes) -> tuple[bytes, list[tuple[str, bytes]]]:
+    """
+    :param block: encoded dag-pb `PBNode`.
+    :return: UnixFS data of the node and `(name, cid)` of each link.
+    """
+    data = b''
+    links = []
+    for field_number, value in pb_fields(block):
+        if field_number == 1:
+            data = value
+        elif field_number == 2:
+            link = dict(pb_fields(value))
+            links.append((link.get(2, b'').decode('utf-8'), link[1]))
+    return data, links
+
+
+def pb_field(field_number: int, value: bytes) -> bytes:
+    # length delimited protobuf field
+    return varint(field_number << 3 | 2) + varint(len(value)) + value
+
+
+def pb_varint_field(field_number: int, value: int) -> bytes:
+    return varint(field_number << 3) + varint(value)
+
+
+def unixfs_data(data_type: int, data: bytes | None = None, filesize: int | None = None,
+                blocksizes: list[int] = (), hash_type: int | None = None, fanout: int | None = None) -> bytes:
+    """
+    :return: encoded UnixFS `Data` protobuf message.
+    """
+    out = pb_varint_field(1, data_type)
+    if data is not None:
+        out += pb_field(2, data)
+    if filesize is not None:
+        out += pb_varint_field(3, filesize)
+    for blocksize in blocksizes:
+        out += pb_varint_field(4, blocksize)
+    if hash_type is not None:
+        out += pb_varint_field(5, hash_type)
+    if fanout is not None:
+        out += pb_varint_field(6, fanout)
+    return out
+
+
+def dag_pb_node(data: bytes, links: list[tuple[str, bytes, int]]) -> bytes:
+    """
+    :param data: UnixFS data of the node.
+    :param links: `(name, cid, tsize)` of each link (in the order to encode them).
+    :return: encoded dag-pb `PBNode` (links are encoded before the data).
+    """
+    out = bytearray()
+    for name, cid, tsize in links:
+        out += pb_field(2, pb_field(1, cid) + pb_field(2, name.encode('utf-8')) + pb_varint_field(3, tsize))
+    out += pb_field(1, data)
+    return bytes(out)
+
+
+@dataclass
+class UnixFSDag:
+    """
+    Blocks of a UnixFS DAG (a file or a directory) and its root.
+    """
+    cid: bytes
+    # cumulative size of every block of the DAG (the `Tsize` of a link to it)
+    tsize: int
+    blocks: list[tuple[bytes, bytes]] = field(default_factory=list)
+
+
+def file_dag(content: bytes) -> UnixFSDag:
+    """
+    Chunk a file into raw leaves and link them with a balanced DAG of dag-pb nodes.
+    :param content: file content.
+    :return: the file DAG (a single raw block if the file fits in one chunk).
+    """
+
+    blocks = []
+    # (cid, tsize, file size) of each node of the current level
+    level = []
+    for start in range(0, max(len(content), 1), CHUNK_SIZE):
+        chunk = content[start:start + CHUNK_SIZE]
+        cid = make_cid(RAW, chunk)
+        blocks.append((cid, chunk))
+        level.append((cid, len(chunk), len(chunk)))
+
+    # every node is filled with the most links before the next one so grouping each level gives the balanced layout
+    while len(level) > 1:
+        parents = []
+        for start in range(0, len(level), MAX_LINKS):
+            children = level[start:start + MAX_LINKS]
+            filesize = sum(child[2] for child in children)
+            node = dag_pb_node(
+                unixfs_data(UNIXFS_FILE, filesize=filesize, blocksizes=[child[2] for child in children]),
+                [('', cid, tsize) for cid, tsize, _ in children]
+            )
+            cid = make_cid(DAG_PB, node)
+            blocks.append((cid, node))
+            parents.append((cid, len(node) + sum(child[1] for child in children), filesize))
+        level = parents
+
+    return UnixFSDag(level[0][0], level[0][1], blocks)
+
+
+def directory_dag(entries: dict[str, tuple[bytes, int]]) -> UnixFSDag:
+    """
+    Link the entries of a directory (as one node, or as a HAMT sharded directory if that node would be too big).
+    :param entries: `(cid, tsize)` of each entry by name.
+    :return: the directory DAG (only the directory blocks).
+    """
+
+    blocks = []
+    estimated_size = sum(len(name.encode('utf-8')) + len(cid) for name, (cid, _) in entries.items())
+    if estimated_size < HAMT_SHARDING_SIZE:
+        links = sorted((name, cid, tsize) for name, (cid, tsize) in entries.items())
+        node = dag_pb_node(unixfs_data(UNIXFS_DIRECTORY), links)
+        cid = make_cid(DAG_PB, node)
+        blocks.append((cid, node))
+        return UnixFSDag(cid, len(node) + sum(link[2] for link in links), blocks)
+
+    root = HamtShard(0)
+    for name, (cid, tsize) in entries.items():
+        root.insert(name, murmur3_x64_64(name.encode('utf-8')), cid, tsize)
+    cid, tsize = root.build(blocks)
+    return UnixFSDag(cid, tsize, blocks)
+
+
+class HamtShard:
+    """
+    One node of a HAMT sharded directory. Each level uses the next byte of the murmur3 hash of an entry name
+    as its bucket, and a bucket holds either one entry or a shard of the next level (if several entries collide).
+    """
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.buckets: dict[int, tuple[str, bytes, bytes, int] | HamtShard] = {}
+
+    def insert(self, name: str, name_hash: bytes, cid: bytes, tsize: int):
+        if self.depth >= len(name_hash):
+            raise ValueError(f'Too many directory entries with the same name hash: {name}')
+        bucket = name_hash[self.depth]
+        existing = self.buckets.get(bucket)
+        if existing is None:
+            self.buckets[bucket] = (name, name_hash, cid, tsize)
+        elif isinstance(existing, HamtShard):
+            existing.insert(name, name_hash, cid, tsize)
+        else:
+            shard = self.buckets[bucket] = HamtShard(self.depth + 1)
+            shard.insert(*existing)
+            shard.insert(name, name_hash, cid, tsize)
+
+    def build(self, blocks: list[tuple[bytes, bytes]]) -> tuple[bytes, int]:
+        """
+        :param blocks: list to append the blocks of this shard (and its child shards) to.
+        :return: `(cid, tsize)` of this shard.
+        """
+        links = []
+        bitfield = 0
+        for bucket in sorted(self.buckets):
+            bitfield |= 1 << bucket
+            # link names start with the bucket index (followed by the entry name unless it links to a child shard)
+            prefix = f'{bucket:02X}'
+            entry = self.buckets[bucket]
+            if isinstance(entry, HamtShard):
+                links.append((prefix, *entry.build(blocks)))
+            else:
+                name, _, cid, tsize = entry
+                links.append((prefix + name, cid, tsize))
+
+        data = unixfs_data(UNIXFS_HAMT_SHARD, data=bitfield.to_bytes(HAMT_FANOUT // 8, 'big'),
+                           hash_type=MURMUR3_X64_64, fanout=HAMT_FANOUT)
+        node = dag_pb_node(data, links)
+        cid = make_cid(DAG_PB, node)
+        blocks.append((cid, node))
+        return cid, len(node) + sum(link[2] for link in links)
+
+
+def murmur3_x64_64(data: bytes) -> bytes:
+    """
+    :param data: bytes to hash.
+    :return: first 64 bits (big-endian) of the 128-bit x64 MurmurHash3 (seed 0) used by UnixFS HAMT directories.
+    """
+
+    def rotl(x: int, r: int) -> int:
+        return (x << r | x >> (64 - r)) & MASK_64
+
+    def fmix(k: int) -> int:
+        k ^= k >> 33
+        k = k * 0xff51afd7ed558ccd & MASK_64
+        k ^= k >> 33
+        k = k * 0xc4ceb9fe1a85ec53 & MASK_64
+        k ^= k >> 33
+        return k
+
+    c1 = 0x87c37b91114253d5
+    c2 = 0x4cf5ad432745937f
+    h1 = h2 = 0
+
+    num_blocks = len(data) // 16
+    for k1, k2 in struct.iter_unpack('<QQ', data[:num_blocks * 16]):
+        h1 ^= rotl(k1 * c1 & MASK_64, 31) * c2 & MASK_64
+        h1 = (rotl(h1, 27) + h2) * 5 + 0x52dce729 & MASK_64
+        h2 ^= rotl(k2 * c2 & MASK_64, 33) * c1 & MASK_64
+        h2 = (rotl(h2, 31) + h1) * 5 + 0x38495ab5 & MASK_64
+
+    tail = data[num_blocks * 16:]
+    if len(tail) > 8:
+        h2 ^= rotl(int.from_bytes(tail[8:], 'little') * c2 & MASK_64, 33) * c1 & MASK_64
+    if tail:
+        h1 ^= rotl(int.from_bytes(tail[:8], 'little') * c1 & MASK_64, 31) * c2 & MASK_64
+
+    h1 ^= len(data)
+    h2 ^= len(data)
+    h1 = (h1 + h2) & MASK_64
+    h2 = (h2 + h1) & MASK_64
+    h1 = fmix(h1)
+    h2 = fmix(h2)
+    h1 = (h1 + h2) & MASK_64
+    return h1.to_bytes(8, 'big')
+
+
+def car_header(root: bytes) -> bytes:
+    """
+    :param root: binary CID of the root.
+    :return: CARv1 header (varint length and DAG-CBOR `{"roots": [root], "version": 1}`).
+    """
+    # CBOR map(2), "roots": array(1) of tag 42 (CID) bytes (with the identity multibase prefix), "version": 1
+    cid_bytes = b'\x00' + root
+    header = b'\xa2\x65roots\x81\xd8\x2a' + cbor_bytes_head(len(cid_bytes)) + cid_bytes + b'\x67version\x01'
+    return varint(len(header)) + header
+
+
+def cbor_bytes_head(length: int) -> bytes:
+    if length < 24:
+        return bytes((0x40 | length,))
+    if length < 256:
+        return bytes((0x58, length))
+    return b'\x59' + length.to_bytes(2, 'big')
+
+
+class CarWriter:
+    """
+    Streams the blocks of the files of one directory into a CARv1 file as the files are added, and then adds the
+    directory blocks last. The root CID isn't known until then, so the header is written with a placeholder root
+    and overwritten when finished (the root is always a CIDv1 dag-pb SHA-256, so the header size doesn't change).
+    Blocks that were already written (e.g., identical chunks or files) are only written once.
+    """
+
+    def __init__(self, car_path: str):
+        self.car_path = car_path
+        self.car_file = open(car_path, 'wb', buffering=2 ** 20)
+        self.car_file.write(car_header(b'\x01' + varint(DAG_PB) + bytes((SHA2_256, 32)) + bytes(32)))
+        self.written: set[bytes] = set()
+        self.entries: dict[str, tuple[bytes, int]] = {}
+        self.num_bytes = 0
+
+    def write_block(self, cid: bytes, block: bytes):
+        if cid in self.written:
+            return
+        self.written.add(cid)
+        self.car_file.write(varint(len(cid) + len(block)))
+        self.car_file.write(cid)
+        self.car_file.write(block)
+        self.num_bytes += len(block)
+
+    def add_file(self, name: str, dag: UnixFSDag):
+        """
+        :param name: file name in the directory.
+        :param dag: DAG of the file content (see :py:func:`file_dag`).
+        """
+        for cid, block in dag.blocks:
+            self.write_block(cid, block)
+        self.entries[name] = (dag.cid, dag.tsize)
+
+    def finish(self) -> UnixFSDag:
+        """
+        Write the directory blocks and the final header.
+        :return: the directory DAG (its `cid` is the root of the CAR).
+        """
+        directory = directory_dag(self.entries)
+        for cid, block in directory.blocks:
+            self.write_block(cid, block)
+        self.car_file.seek(0)
+        self.car_file.write(car_header(directory.cid))
+        self.car_file.close()
+        return directory
+
+    def write_cids(self, cids_csv_path: str, directory: UnixFSDag):
+        """
+        Write the CID of the directory and every file as a CSV (e.g., to check what an IPFS node pinned).
+        :param cids_csv_path: CSV file path.
+        :param directory: the finished directory DAG.
+        """
+        with open(cids_csv_path, 'w', newline='') as cids_csv:
+            csvwriter = csv.writer(cids_csv)
+            csvwriter.writerow(['name', 'cid', 'tsize'])
+            csvwriter.writerow(['', cid_string(directory.cid), directory.tsize])
+            for name in sorted(self.entries):
+                cid, tsize = self.entries[name]
+                csvwriter.writerow([name, cid_string(cid), tsize])
+
+
+def car_root(header: bytes) -> bytes:
+    """
+    :param header: start of a CARv1 file (at least the header).
+    :return: binary CID of the (first) root in the header.
+    :raises ValueError: if the header doesn't have a CID root.
+    """
+
+    # the first root is the first CID (CBOR tag 42) of the header: a byte string of the identity multibase prefix
+    # followed by the binary CID
+    start = header.find(b'\xd8\x2a')
+    if start < 0 or header[start + 2] not in range(0x40, 0x59):
+        raise ValueError('No root CID in the CAR header')
+    if header[start + 2] == 0x58:
+        length, cid_start = header[start + 3], start + 4
+    else:
+        length, cid_start = header[start + 2] - 0x40, start + 3
+    return header[cid_start + 1:cid_start + length]
+
+
+def read_car_root(car_path: str) -> str:
+    """
+    :param car_path: CARv1 file path.
+    :return: base32 string of the (first) root CID in the header.
+    :raises ValueError: if the header doesn't have a CID root.
+    """
+    with open(car_path, 'rb') as car_file:
+        header = car_file.read(256)
+    try:
+        return cid_string(car_root(header))
+    except ValueError as e:
+        raise ValueError(f'{e}: {car_path}')
+
+
+class CarReader:
+    """
+    Reads the files of a directory from a CARv1 file (e.g., written by :py:class:`CarWriter`) without unpacking it.
+    The blocks are indexed by one pass over the section headers and only the blocks of the files being read
+    are loaded.
+    """
+
+    def __init__(self, car_path: str):
+        self.car_path = car_path
+        self.car_file = open(car_path, 'rb')
+        header = self.car_file.read(256)
+        header_length, offset = read_varint(header, 0)
+        self.root = car_root(header[:offset + header_length])
+
+        # CID -> (offset, length) of the block data
+        self.blocks: dict[bytes, tuple[int, int]] = {}
+        car_size = os.fstat(self.car_file.fileno()).st_size
+        position = offset + header_length
+        while position < car_size:
+            self.car_file.seek(position)
+            section = self.car_file.read(128)
+            section_length, start = read_varint(section, 0)
+            cid_end = start + cid_length(section, start)
+            self.blocks[section[start:cid_end]] = (position + cid_end, section_length - (cid_end - start))
+            position += start + section_length
+
+    def block(self, cid: bytes) -> bytes:
+        """
+        :param cid: binary CID of the block.
+        :return: block bytes.
+        :raises KeyError: if the CAR file doesn't have the block.
+        """
+        offset, length = self.blocks[cid]
+        self.car_file.seek(offset)
+        return self.car_file.read(length)
+
+    def entries(self, directory: bytes | None = None) -> dict[str, bytes]:
+        """
+        :param directory: binary CID of a UnixFS directory (the root by default).
+        :return: binary CID of each entry of the directory by name (including every entry of a sharded directory).
+        """
+        data, links = parse_dag_pb(self.block(directory or self.root))
+        sharded = dict(pb_fields(data)).get(1) == UNIXFS_HAMT_SHARD
+        entries = {}
+        for name, cid in links:
+            if not sharded:
+                entries[name] = cid
+            elif len(name) > 2:
+                # the bucket index is followed by the entry name
+                entries[name[2:]] = cid
+            else:
+                entries.update(self.entries(cid))
+        return entries
+
+    def read_file(self, cid: bytes) -> bytes:
+        """
+        :param cid: binary CID of a UnixFS file.
+        :return: file content (every leaf of its DAG in order).
+        """
+        block = self.block(cid)
+        if cid_codec(cid) == RAW:
+            return block
+        data, links = parse_dag_pb(block)
+        if not links:
+            return dict(pb_fields(data)).get(2, b'')
+        return b''.join(self.read_file(link_cid) for _, link_cid in links)
+
+    def close(self):
+        self.car_file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='IPFS CAR',
+        description='Packs the generated images into an IPFS CAR file (without Node.js or an IPFS node).',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        'generated_dir',
+        default='./generated',
+        help='generated output directory (with the images directory to pack)'
+    )
+
+    args = parser.parse_args()
+
+    p_start = time.perf_counter()
+    gen_image_dir_path = os.path.join(args.generated_dir, Const.GEN_IMAGE_SUBDIR)
+    car_path = os.path.join(args.generated_dir, Const.CAR_FILE_NAME)
+    car_writer = CarWriter(car_path)
+    for entry in sorted(os.scandir(gen_image_dir_path), key=lambda e: e.name):
+        if entry.is_file():
+            with open(entry.path, 'rb') as image_file:
+                car_writer.add_file(entry.name, file_dag(image_file.read()))
+    directory = car_writer.finish()
+
+    cids_csv_path = os.path.join(args.generated_dir, Const.CAR_CIDS_FILE_NAME)
+    car_writer.write_cids(cids_csv_path, directory)
+
+    print(f'Packed [{len(car_writer.entries)}] images into: {car_path} ({os.path.getsize(car_path)} bytes)')
+    print(f'CIDs: {cids_csv_path}')
+    print(f'ROOT CID: {cid_string(directory.cid)}')
+    print(f'IPFS base URL example: https://ipfs.io/ipfs/{cid_string(directory.cid)}/')
+    print(f'TOTAL TIME: {time.perf_counter() - p_start:.03f}s')
+
+
+if __name__ == '__main__':
+    main()
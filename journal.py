@@ -0,0 +1,185 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import csv
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+
+from util import Const, RenderJob
+
+
+@dataclass(frozen=True)
+class JournalEntry:
+    """
+    A finished (rendered and saved) token recorded in the generation journal.
+    """
+    index: int
+    trait_indices: tuple[int, ...]
+    file_name: str
+    checksum: str
+    pixel_digest: str | None = None
+
+
+def file_checksum(file_path: str) -> str:
+    """
+    :param file_path: path of the file to hash.
+    :return: SHA-256 hex digest of the file content.
+    """
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(2 ** 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class GenerationJournal:
+    """
+    Append-only journal (JSON lines) of every finished token so an interrupted run can be resumed.
+
+    The first line records the run settings (e.g., the random seed) and every following line records one token.
+    A line is only appended after the image file is complete and its metadata was flushed, so after a crash the
+    journal never claims more than what is actually on disk (a partially written last line is ignored).
+    """
+
+    def __init__(self, journal_path: str, settings: dict, entries: list[JournalEntry]):
+        self.journal_path = journal_path
+        self.settings = settings
+        self.entries = entries
+        self.journal_file = open(journal_path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def create(journal_path: str, settings: dict):
+        """
+        Create a new journal (the file must not exist yet).
+        :param journal_path: journal file path.
+        :param settings: run settings needed to resume (must be JSON serializable).
+        :return: the new journal.
+        """
+        with open(journal_path, 'x', encoding='utf-8') as journal_file:
+            journal_file.write(json.dumps(settings) + '\n')
+        return GenerationJournal(journal_path, settings, [])
+
+    @staticmethod
+    def resume(journal_path: str, gen_image_dir_path: str):
+        """
+        Load an existing journal and drop any entries after the first one whose image file is missing.
+        The checksum of the last remaining entry is verified as well (the image most likely to be damaged).
+        :param journal_path: journal file path.
+        :param gen_image_dir_path: generated images directory.
+        :return: the loaded journal (ready to append to).
+        """
+
+        entries: list[JournalEntry] = []
+        with open(journal_path, 'rb') as journal_file:
+            settings = json.loads(journal_file.readline())
+            good_size = journal_file.tell()
+            for line in journal_file:
+                if not line.endswith(b'\n'):
+                    # partially written when the run was interrupted
+                    break
+                entry = json.loads(line)
+                entry = JournalEntry(
+                    index=entry['index'],
+                    trait_indices=tuple(entry['traits']),
+                    file_name=entry['file'],
+                    checksum=entry['sha256'],
+                    pixel_digest=entry.get('pixels')
+                )
+                if not os.path.exists(os.path.join(gen_image_dir_path, entry.file_name)):
+                    break
+                entries.append(entry)
+                good_size = journal_file.tell()
+
+        rewrite = False
+        while entries:
+            last = entries[-1]
+            if file_checksum(os.path.join(gen_image_dir_path, last.file_name)) == last.checksum:
+                break
+            entries.pop()
+            rewrite = True
+
+        if rewrite:
+            # rewrite the journal because entries that were already read completely were dropped
+            with open(journal_path, 'w', encoding='utf-8') as journal_file:
+                journal_file.write(json.dumps(settings) + '\n')
+                for entry in entries:
+                    journal_file.write(GenerationJournal._entry_line(entry))
+        else:
+            os.truncate(journal_path, good_size)
+
+        return GenerationJournal(journal_path, settings, entries)
+
+    @staticmethod
+    def _entry_line(entry: JournalEntry) -> str:
+        line = {
+            'index': entry.index,
+            'traits': list(entry.trait_indices),
+            'file': entry.file_name,
+            'sha256': entry.checksum
+        }
+        if entry.pixel_digest is not None:
+            line['pixels'] = entry.pixel_digest
+        return json.dumps(line) + '\n'
+
+    def append(self, job: RenderJob, checksum: str, pixel_digest: str | None = None, flush: bool = True):
+        """
+        Record a finished token.
+        :param job: job that was rendered.
+        :param checksum: SHA-256 hex digest of the image file.
+        :param pixel_digest: digest of the composite pixels (if pixel duplicates are being detected).
+        :param flush: flush the journal file (otherwise call `flush` after appending a batch of tokens).
+        """
+        entry = JournalEntry(index=job.index, trait_indices=job.trait_indices, file_name=job.file_name,
+                             checksum=checksum, pixel_digest=pixel_digest)
+        self.journal_file.write(self._entry_line(entry))
+        if flush:
+            self.journal_file.flush()
+
+    def flush(self):
+        self.journal_file.flush()
+
+    def close(self):
+        self.journal_file.close()
+
+
+def truncate_csv(csv_path: str, num_rows: int):
+    """
+    Truncate a metadata CSV file to its header and the given number of rows.
+    :param csv_path: metadata CSV file path.
+    :param num_rows: number of (non-header) rows to keep.
+    :raises ValueError: if the CSV is missing or has fewer rows.
+    """
+
+    if not os.path.exists(csv_path):
+        raise ValueError(f'CSV is missing but the journal has [{num_rows}] rows: {csv_path}')
+
+    with open(csv_path, 'r', newline='') as csv_file:
+        csvreader = csv.reader(csv_file)
+        rows = [row for _, row in zip(range(num_rows + 1), csvreader)]
+
+    if len(rows) < num_rows + 1:
+        raise ValueError(f'CSV has fewer rows [{len(rows) - 1}] than the journal [{num_rows}]: {csv_path}')
+
+    new_csv_path = csv_path + '.tmp'
+    with open(new_csv_path, 'w', newline='') as csv_file:
+        csvwriter = csv.writer(csv_file)
+        csvwriter.writerows(rows)
+    os.replace(new_csv_path, csv_path)
+
+
+def journal_path(gen_dir_path: str) -> str:
+    return os.path.join(gen_dir_path, Const.JOURNAL_FILE_NAME)
@@ -0,0 +1,231 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import dataclasses
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+from compositor_backends import PixelBackend, create_backend
+from journal import file_checksum
+from util import LayerInfo, Trait, TraitImageInfo, load_layers
+
+INDEX_FILE_NAME = 'index.json'
+INDEX_VERSION = 1
+
+
+class LayerCache:
+    """
+    On-disk cache of the parsed layers and the decoded pixels of every trait image (to start generating quickly).
+
+    The parsed layers are reused while the modification times of the layers directory and its layer directories
+    are unchanged (adding, removing, or renaming a trait image changes them). Each trait image file is indexed by
+    its path, size, modification time, and content hash, and its straight RGBA pixels are stored as a `.npy` file
+    named by the content hash (and the decoder that produced them), which is memory-mapped instead of decoded.
+    Only new or changed trait image files are decoded again (in parallel), and a file that was only touched is
+    recognized by its content hash.
+    """
+
+    def __init__(self, cache_dir_path: str):
+        """
+        :param cache_dir_path: cache directory (created if needed).
+        """
+        self.cache_dir_path = cache_dir_path
+        self.index_path = os.path.join(cache_dir_path, INDEX_FILE_NAME)
+        os.makedirs(cache_dir_path, exist_ok=True)
+
+        # trait image file path -> size, modification time, and content hash
+        self.files: dict[str, dict] = {}
+        # layers directory path -> modification times and the parsed layers
+        self.layers: dict[str, dict] = {}
+
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as index_file:
+                index = json.load(index_file)
+            if index.get('version') == INDEX_VERSION:
+                self.files = index['files']
+                self.layers = index['layers']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        # written to a temporary file first so a reader (e.g., a worker process) never sees a partial index
+        index_tmp_path = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(index_tmp_path, 'w', encoding='utf-8') as index_file:
+            json.dump({'version': INDEX_VERSION, 'files': self.files, 'layers': self.layers}, index_file)
+        os.replace(index_tmp_path, self.index_path)
+
+    def load_layers(self, layers_dir_path: str, verbose: bool = True) -> list[LayerInfo]:
+        """
+        Load the parsed layers from the cache if the layer directories are unchanged (see :py:func:`load_layers`).
+        :param layers_dir_path: layers input directory.
+        :param verbose: print the layers and traits as they are discovered.
+        :return: the layers in layering order.
+        """
+
+        key = os.path.abspath(layers_dir_path)
+        mtimes = directory_mtimes(layers_dir_path)
+        cached = self.layers.get(key)
+        if cached is not None and cached['mtimes'] == mtimes:
+            layers = [layer_from_dict(layer_dict, layers_dir_path) for layer_dict in cached['layers']]
+            if verbose:
+                print(f'\nLoaded [{len(layers)}] layers from the layer cache: {self.cache_dir_path}')
+            return layers
+
+        layers = load_layers(layers_dir_path, verbose)
+        self.layers[key] = {'mtimes': mtimes, 'layers': list(map(layer_to_dict, layers))}
+        self.save()
+        return layers
+
+    def pixels_path(self, content_hash: str, decoder: str) -> str:
+        return os.path.join(self.cache_dir_path, f'{content_hash}.{decoder}.npy')
+
+    def pixels(self, path: str, decoder: str) -> np.ndarray | None:
+        """
+        :param path: trait image file path.
+        :param decoder: decoder of the pixels (see `CompositorBackend.raw_decoder`).
+        :return: memory-mapped (read-only) straight RGBA pixels of the trait image or `None` if not cached.
+        """
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None:
+            return None
+        try:
+            return np.load(self.pixels_path(entry['hash'], decoder), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+
+    def update(self, layers: list[LayerInfo], backend: PixelBackend, num_workers: int = 1) -> int:
+        """
+        Index every trait image file and decode the new or changed ones into the cache.
+        :param layers: layers to cache the trait images of.
+        :param backend: backend whose `decode_rgba` decodes the trait images.
+        :param num_workers: number of worker processes to decode with.
+        :return: number of trait images that were decoded.
+        """
+
+        stale: dict[str, str] = {}
+        paths = set()
+        for layer in layers:
+            for trait_image in layer.trait_images:
+                path = os.path.abspath(trait_image.path)
+                paths.add(path)
+                stat = os.stat(path)
+                entry = self.files.get(path)
+                if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns:
+                    entry = self.files[path] = {
+                        'size': stat.st_size,
+                        'mtime_ns': stat.st_mtime_ns,
+                        'hash': file_checksum(path)
+                    }
+                pixels_path = self.pixels_path(entry['hash'], backend.raw_decoder)
+                if not os.path.exists(pixels_path):
+                    # identical trait image files are only decoded once
+                    stale.setdefault(pixels_path, path)
+
+        tasks = [(path, pixels_path) for pixels_path, path in stale.items()]
+        if num_workers > 1 and len(tasks) > 1:
+            # spawn (instead of fork) so workers don't inherit ImageMagick state from the parent
+            context = multiprocessing.get_context('spawn')
+            with context.Pool(min(num_workers, len(tasks)), initializer=init_decode_worker,
+                              initargs=(backend.name,)) as pool:
+                for _ in pool.imap_unordered(decode_to_cache, tasks):
+                    pass
+        else:
+            for path, pixels_path in tasks:
+                save_pixels(backend.decode_rgba(path), pixels_path)
+
+        self.prune(paths)
+        self.save()
+        return len(tasks)
+
+    def prune(self, paths: set[str]):
+        """
+        Forget the trait image files that no longer exist and delete the pixels no file refers to anymore.
+        :param paths: trait image file paths that are in use (always kept).
+        """
+        self.files = {path: entry for path, entry in self.files.items() if path in paths or os.path.exists(path)}
+        hashes = set(entry['hash'] for entry in self.files.values())
+        for cache_entry in os.scandir(self.cache_dir_path):
+            if cache_entry.name.endswith('.npy') and cache_entry.name.split('.', 1)[0] not in hashes:
+                os.remove(cache_entry.path)
+
+
+def directory_mtimes(layers_dir_path: str) -> dict[str, int]:
+    """
+    :param layers_dir_path: layers input directory.
+    :return: modification time (in nanoseconds) of the layers directory (`''`) and each of its directories.
+    """
+    mtimes = {'': os.stat(layers_dir_path).st_mtime_ns}
+    for layer_dir in os.scandir(layers_dir_path):
+        if layer_dir.is_dir():
+            mtimes[layer_dir.name] = layer_dir.stat().st_mtime_ns
+    return mtimes
+
+
+def layer_to_dict(layer: LayerInfo) -> dict:
+    layer_dict = dataclasses.asdict(layer)
+    layer_dict['path'] = str(layer.path)
+    # derived from the trait images
+    del layer_dict['weights']
+    return layer_dict
+
+
+def layer_from_dict(layer_dict: dict, layers_dir_path: str) -> LayerInfo:
+    """
+    :param layer_dict: cached layer (see `layer_to_dict`).
+    :param layers_dir_path: layers input directory of this run.
+    :return: the layer with its paths under the layers directory of this run (like :py:func:`load_layers`),
+        since the cached paths are relative to the working directory of the run that cached them.
+    """
+    layer_path = os.path.join(layers_dir_path, layer_dict['name'])
+    return LayerInfo(
+        name=layer_dict['name'],
+        path=layer_path,
+        trait_type=layer_dict['trait_type'],
+        total_weight=layer_dict['total_weight'],
+        trait_images=[
+            TraitImageInfo(
+                name=trait_image['name'],
+                path=os.path.join(layer_path, trait_image['name']),
+                trait=Trait(**trait_image['trait']),
+                index=trait_image['index']
+            )
+            for trait_image in layer_dict['trait_images']
+        ]
+    )
+
+
+def save_pixels(pixels: np.ndarray, pixels_path: str):
+    # written to a temporary file first so a partially written file is never memory-mapped
+    pixels_tmp_path = f'{pixels_path}.{os.getpid()}.tmp'
+    with open(pixels_tmp_path, 'wb') as pixels_file:
+        np.save(pixels_file, np.ascontiguousarray(pixels))
+    os.replace(pixels_tmp_path, pixels_path)
+
+
+# each decode worker process decodes with its own backend
+decode_backend: PixelBackend | None = None
+
+
+def init_decode_worker(backend_name: str):
+    global decode_backend
+    decode_backend = create_backend(backend_name)
+
+
+def decode_to_cache(task: tuple[str, str]):
+    path, pixels_path = task
+    save_pixels(decode_backend.decode_rgba(path), pixels_path)
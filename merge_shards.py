@@ -0,0 +1,207 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import csv
+import os
+import shutil
+import sys
+
+from image_archive import (ARCHIVE_FILE_NAMES, ARCHIVE_FORMATS, TokenArchiveReader, create_archive_writer,
+                           image_member_name, metadata_member_name, open_archive)
+from ipfs_car import CarReader, CarWriter, cid_string, file_dag
+from util import *
+
+
+def image_number(file_name: str) -> int:
+    return int(os.path.splitext(file_name)[0])
+
+
+def link_or_copy(src_path: str, dst_path: str):
+    """
+    Hard link a file (to avoid copying large images) or copy it if linking isn't possible (e.g., across devices).
+    """
+    try:
+        os.link(src_path, dst_path)
+    except OSError:
+        shutil.copy2(src_path, dst_path)
+
+
+def image_source(shard_dir: str, file_name: str) -> str | None:
+    """
+    :param shard_dir: generated directory of a shard.
+    :param file_name: file name of an image of the shard.
+    :return: `files` if the shard has image files; otherwise the format of its image archive (`None` if neither).
+    """
+    if os.path.exists(os.path.join(shard_dir, Const.GEN_IMAGE_SUBDIR, file_name)):
+        return 'files'
+    for archive_format in ARCHIVE_FORMATS:
+        if os.path.exists(os.path.join(shard_dir, ARCHIVE_FILE_NAMES[archive_format])):
+            return archive_format
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Merge Shards',
+        description='Merges the generated directories of shards (see generate_nfts.py --shard) '
+                    'into one collection.',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        'generated_dir',
+        help='merged generated output directory to create'
+    )
+    parser.add_argument(
+        'shard_dirs',
+        nargs='+',
+        help='generated directories of the shards (in any order)'
+    )
+
+    args = parser.parse_args()
+
+    shards: list[tuple[str, list[dict]]] = []
+    for shard_dir in args.shard_dirs:
+        with open(os.path.join(shard_dir, Const.DEFAULT_CSV_FILE_NAME), 'r', newline='') as assets_csv:
+            rows = list(csv.DictReader(assets_csv))
+        if rows:
+            shards.append((shard_dir, rows))
+        print(f'Shard rows: {len(rows):6}  {shard_dir}')
+
+    # shards are generated with the image numbers of the whole collection, so sort them by their first image
+    shards.sort(key=lambda shard: image_number(shard[1][0][Const.CSV_FIELD_IMAGE]))
+
+    expected_number = 1
+    for shard_dir, rows in shards:
+        for row in rows:
+            number = image_number(row[Const.CSV_FIELD_IMAGE])
+            if number != expected_number:
+                print(f'\nShards are missing or overlapping images: '
+                      f'expected [{expected_number}] but found [{number}] in {shard_dir}')
+                sys.stdout.flush()
+                exit(1)
+            expected_number += 1
+
+    # every shard must have been generated with the same output options (checked before anything is written)
+    problems = []
+    sources = {shard_dir: image_source(shard_dir, rows[0][Const.CSV_FIELD_IMAGE]) for shard_dir, rows in shards}
+    problems += [f'{shard_dir} has no image files or image archive' for shard_dir, source in sources.items()
+                 if source is None]
+    if len(set(sources.values())) > 1:
+        problems.append(f'Shards store their images differently: {sources}')
+    source = next(iter(sources.values()))
+
+    def every_shard_has(name: str) -> bool:
+        found = [os.path.exists(os.path.join(shard_dir, name)) for shard_dir, _ in shards]
+        if any(found) and not all(found):
+            problems.append(f'Only some shards have {name} (were they generated with different options?)')
+        return all(found)
+
+    merge_metadata_dir = source == 'files' and every_shard_has(Const.GEN_METADATA_SUBDIR)
+    merge_jsonl = every_shard_has(Const.METADATA_JSONL_FILE_NAME)
+    merge_car = every_shard_has(Const.CAR_FILE_NAME)
+
+    missing = []
+    readers: dict[str, TokenArchiveReader] = {}
+    # the images (and metadata files) are only looked for where every shard stores them
+    for shard_dir, rows in shards if len(set(sources.values())) == 1 else []:
+        if source == 'files':
+            for row in rows:
+                file_paths = [os.path.join(shard_dir, Const.GEN_IMAGE_SUBDIR, row[Const.CSV_FIELD_IMAGE])]
+                if merge_metadata_dir:
+                    file_paths.append(os.path.join(shard_dir, metadata_member_name(
+                        image_number(row[Const.CSV_FIELD_IMAGE]))))
+                missing += [file_path for file_path in file_paths if not os.path.exists(file_path)]
+        elif source is not None:
+            reader = readers[shard_dir] = open_archive(os.path.join(shard_dir, ARCHIVE_FILE_NAMES[source]))
+            names = set(reader.names())
+            for row in rows:
+                member_names = [image_member_name(row[Const.CSV_FIELD_IMAGE])]
+                if source != 'car':
+                    member_names.append(metadata_member_name(image_number(row[Const.CSV_FIELD_IMAGE])))
+                missing += [f'{shard_dir} {source} archive: {name}' for name in member_names if name not in names]
+    if missing:
+        problems.append(f'Shards are missing [{len(missing)}] images or metadata files, e.g.: {missing[0]}')
+
+    if problems:
+        print('\nCannot merge the shards:')
+        for problem in problems:
+            print('  ' + problem)
+        sys.stdout.flush()
+        exit(1)
+
+    gen_image_dir_path = os.path.join(args.generated_dir, Const.GEN_IMAGE_SUBDIR)
+    try:
+        os.makedirs(gen_image_dir_path, exist_ok=False)
+    except OSError as e:
+        print('Generated directory already exists or other OS error encountered:')
+        print('  ' + e.strerror)
+        sys.stdout.flush()
+        exit(2)
+    if merge_metadata_dir:
+        os.makedirs(os.path.join(args.generated_dir, Const.GEN_METADATA_SUBDIR))
+
+    with open(os.path.join(args.generated_dir, Const.DEFAULT_CSV_FILE_NAME), 'w', newline='') as assets_csv:
+        csvwriter = csv.DictWriter(assets_csv, fieldnames=Const.CSV_FIELDNAMES)
+        csvwriter.writeheader()
+        for shard_dir, rows in shards:
+            for row in rows:
+                file_name = row[Const.CSV_FIELD_IMAGE]
+                if source == 'files':
+                    member_names = [image_member_name(file_name)]
+                    if merge_metadata_dir:
+                        member_names.append(metadata_member_name(image_number(file_name)))
+                    for name in member_names:
+                        link_or_copy(os.path.join(shard_dir, name), os.path.join(args.generated_dir, name))
+                csvwriter.writerow(row)
+
+    if source in ('tar', 'zip'):
+        # the members are appended in image number order (like generate_nfts.py --archive writes them)
+        archive = create_archive_writer(args.generated_dir, source)
+        for shard_dir, rows in shards:
+            for row in rows:
+                file_name = row[Const.CSV_FIELD_IMAGE]
+                for name in [image_member_name(file_name), metadata_member_name(image_number(file_name))]:
+                    archive.add_member(name, readers[shard_dir].read(name))
+        archive.close()
+        print(f'ARCHIVE: {archive.archive_path}')
+
+    if merge_jsonl:
+        with open(os.path.join(args.generated_dir, Const.METADATA_JSONL_FILE_NAME), 'wb') as merged_jsonl:
+            for shard_dir, _ in shards:
+                with open(os.path.join(shard_dir, Const.METADATA_JSONL_FILE_NAME), 'rb') as shard_jsonl:
+                    shutil.copyfileobj(shard_jsonl, merged_jsonl)
+
+    if merge_car:
+        # the root CID covers every image, so the blocks of each image are added to one new CAR
+        car_writer = CarWriter(os.path.join(args.generated_dir, Const.CAR_FILE_NAME))
+        for shard_dir, rows in shards:
+            car_reader = CarReader(os.path.join(shard_dir, Const.CAR_FILE_NAME))
+            entries = car_reader.entries()
+            for row in rows:
+                file_name = row[Const.CSV_FIELD_IMAGE]
+                car_writer.add_file(file_name, file_dag(car_reader.read_file(entries[file_name])))
+            car_reader.close()
+        directory = car_writer.finish()
+        car_writer.write_cids(os.path.join(args.generated_dir, Const.CAR_CIDS_FILE_NAME), directory)
+        print(f'CAR: {car_writer.car_path} (root CID: {cid_string(directory.cid)})')
+
+    for reader in readers.values():
+        reader.close()
+
+    print(f'\nMERGED: {expected_number - 1} images from {len(shards)} shards into {args.generated_dir}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import csv
+import json
+import os
+from abc import ABC, abstractmethod
+
+from journal import truncate_csv
+from util import Const, RenderJob
+
+# metadata files are written through large buffers (and flushed in batches of tokens)
+BUFFER_SIZE = 2 ** 20
+
+
+def erc721_json(job: RenderJob) -> str:
+    """
+    :param job: token to describe.
+    :return: compact ERC-721 metadata JSON of the token (the attributes are the precomputed traits JSON).
+    """
+    return ''.join([
+        '{"name":', json.dumps(job.image_name, ensure_ascii=False),
+        ',"description":', json.dumps(job.image_desc, ensure_ascii=False),
+        ',"image":', json.dumps(job.file_name, ensure_ascii=False),
+        ',"attributes":', job.traits_str,
+        '}'
+    ])
+
+
+class MetadataSink(ABC):
+    """
+    Destination of the metadata of every generated token (in image number order).
+    Writes may be buffered until `flush`, which is called before the flushed tokens are journaled.
+    """
+
+    @abstractmethod
+    def write(self, job: RenderJob):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class CsvMetadataSink(MetadataSink):
+    """
+    NiftyKit DropKit CSV rows (see `Const.CSV_FIELDNAMES`).
+    """
+
+    def __init__(self, csv_path: str, resume_rows: int | None = None):
+        """
+        :param csv_path: metadata CSV file path.
+        :param resume_rows: number of journaled rows to keep and append after; otherwise a new CSV is created.
+        """
+        self.csv_path = csv_path
+        if resume_rows == 0 and not os.path.exists(csv_path):
+            # the run stopped before the CSV was created (nothing was journaled), so it's created now
+            resume_rows = None
+        if resume_rows is not None:
+            truncate_csv(csv_path, resume_rows)
+        self.csv_file = open(csv_path, 'a' if resume_rows is not None else 'w', newline='', buffering=BUFFER_SIZE)
+        self.csvwriter = csv.writer(self.csv_file)
+        if resume_rows is None:
+            self.csvwriter.writerow(Const.CSV_FIELDNAMES)
+        # the columns after the image column are always empty
+        self.empty_columns = [''] * (len(Const.CSV_FIELDNAMES) - 4)
+
+    def write(self, job: RenderJob):
+        self.csvwriter.writerow([job.image_name, job.image_desc, job.traits_str, job.file_name] +
+                                self.empty_columns)
+
+    def flush(self):
+        self.csv_file.flush()
+
+    def close(self):
+        self.csv_file.close()
+
+
+class JsonlMetadataSink(MetadataSink):
+    """
+    JSON lines manifest with the token ID and ERC-721 metadata of every token.
+    """
+
+    def __init__(self, jsonl_path: str, resume_rows: int | None = None):
+        """
+        :param jsonl_path: manifest file path.
+        :param resume_rows: number of journaled lines to keep and append after;
+            otherwise a new manifest is created.
+        """
+        self.jsonl_path = jsonl_path
+        if resume_rows == 0 and not os.path.exists(jsonl_path):
+            resume_rows = None
+        if resume_rows is not None:
+            truncate_lines(jsonl_path, resume_rows)
+        self.jsonl_file = open(jsonl_path, 'a' if resume_rows is not None else 'w', encoding='utf-8',
+                               buffering=BUFFER_SIZE)
+
+    def write(self, job: RenderJob):
+        # the token ID is prepended to the (already compact) ERC-721 JSON object
+        self.jsonl_file.write(f'{{"token_id":{job.index},{erc721_json(job)[1:]}\n')
+
+    def flush(self):
+        self.jsonl_file.flush()
+
+    def close(self):
+        self.jsonl_file.close()
+
+
+class Erc721MetadataSink(MetadataSink):
+    """
+    One ERC-721 metadata JSON file per token (named by the token ID) in the metadata directory.
+    """
+
+    def __init__(self, metadata_dir_path: str):
+        """
+        :param metadata_dir_path: metadata directory (created if needed).
+        """
+        self.metadata_dir_path = metadata_dir_path
+        os.makedirs(metadata_dir_path, exist_ok=True)
+        self.pending: list[tuple[int, str]] = []
+
+    def write(self, job: RenderJob):
+        self.pending.append((job.index, erc721_json(job)))
+
+    def flush(self):
+        for index, metadata_json in self.pending:
+            with open(os.path.join(self.metadata_dir_path, f'{index}.json'), 'w', encoding='utf-8') as json_file:
+                json_file.write(metadata_json)
+        self.pending.clear()
+
+
+METADATA_SINKS = ['erc721', 'jsonl']
+
+
+def create_metadata_sinks(gen_dir_path: str, names: list[str],
+                          resume_rows: int | None = None) -> list[MetadataSink]:
+    """
+    Create the CSV sink and the other requested metadata sinks.
+    :param gen_dir_path: generated output directory.
+    :param names: names of the metadata sinks to write besides the CSV (see `METADATA_SINKS`).
+    :param resume_rows: number of journaled tokens when resuming (the sinks are truncated to them).
+    :return: the metadata sinks.
+    """
+    sinks: list[MetadataSink] = [
+        CsvMetadataSink(os.path.join(gen_dir_path, Const.DEFAULT_CSV_FILE_NAME), resume_rows)
+    ]
+    if 'erc721' in names:
+        sinks.append(Erc721MetadataSink(os.path.join(gen_dir_path, Const.GEN_METADATA_SUBDIR)))
+    if 'jsonl' in names:
+        sinks.append(JsonlMetadataSink(os.path.join(gen_dir_path, Const.METADATA_JSONL_FILE_NAME), resume_rows))
+    return sinks
+
+
+def truncate_lines(file_path: str, num_lines: int):
+    """
+    Truncate a text file to the given number of lines.
+    :param file_path: file path.
+    :param num_lines: number of lines to keep.
+    :raises ValueError: if the file is missing or has fewer lines.
+    """
+    if not os.path.exists(file_path):
+        raise ValueError(f'File is missing but the journal has [{num_lines}] lines: {file_path}')
+    with open(file_path, 'rb') as text_file:
+        for line_number in range(num_lines):
+            if not text_file.readline().endswith(b'\n'):
+                raise ValueError(f'File has fewer lines [{line_number}] than the journal [{num_lines}]: '
+                                 f'{file_path}')
+        size = text_file.tell()
+    os.truncate(file_path, size)
@@ -0,0 +1,209 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import bisect
+import datetime
+import json
+import time
+
+from util import RenderResult
+
+# upper bounds (in milliseconds) of the histogram buckets (the last bucket has no upper bound)
+BUCKET_BOUNDS_MS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+class LapTimer:
+    """
+    Times consecutive stages of one token (each lap is the time since the previous lap).
+    """
+
+    def __init__(self):
+        self.p_start = time.perf_counter()
+        self.p_last = self.p_start
+        self.stages: dict[str, float] = {}
+
+    def lap(self, stage: str):
+        """
+        Add the time since the previous lap (or the start) to a stage.
+        :param stage: stage name.
+        """
+        p_now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + p_now - self.p_last
+        self.p_last = p_now
+
+    def add(self, stage: str, seconds: float):
+        """
+        Add time that was measured separately (e.g., a share of a batch) to a stage (and the elapsed time).
+        :param stage: stage name.
+        :param seconds: seconds to add.
+        """
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+        self.p_start -= seconds
+
+    def skip(self):
+        """
+        Don't count the time since the previous lap (e.g., while the token was waiting in a pipeline queue).
+        """
+        p_now = time.perf_counter()
+        self.p_start += p_now - self.p_last
+        self.p_last = p_now
+
+    def elapsed(self) -> float:
+        return self.p_last - self.p_start
+
+
+class TimingHistogram:
+    """
+    Histogram of stage times with fixed (roughly logarithmic) buckets so it can be merged and reported cheaply.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+
+    def add(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+
+    def percentile(self, percent: float) -> float:
+        """
+        :param percent: percentile from 0 to 100.
+        :return: upper bound (in seconds) of the bucket that contains the percentile (capped at the max time).
+        """
+        if self.count == 0:
+            return 0.0
+        rank = self.count * percent / 100
+        cumulative = 0
+        for bucket_index, bucket_count in enumerate(self.buckets):
+            cumulative += bucket_count
+            if cumulative >= rank and bucket_count > 0:
+                if bucket_index == len(BUCKET_BOUNDS_MS):
+                    break
+                return min(BUCKET_BOUNDS_MS[bucket_index] / 1000, self.max)
+        return self.max
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'total_s': self.total,
+            'mean_ms': self.total * 1000 / self.count if self.count else 0.0,
+            'min_ms': self.min * 1000 if self.count else 0.0,
+            'max_ms': self.max * 1000,
+            'p50_ms': self.percentile(50) * 1000,
+            'p95_ms': self.percentile(95) * 1000,
+            'p99_ms': self.percentile(99) * 1000,
+            'buckets': {f'<={bound}ms': count for bound, count in zip(BUCKET_BOUNDS_MS, self.buckets)} |
+                       {f'>{BUCKET_BOUNDS_MS[-1]}ms': self.buckets[-1]}
+        }
+
+    def __str__(self):
+        return f'total: {self.total:9.03f}s  mean: {self.total * 1000 / max(self.count, 1):8.02f}ms  ' \
+               f'p50: <={self.percentile(50) * 1000:8.02f}ms  p95: <={self.percentile(95) * 1000:8.02f}ms  ' \
+               f'max: {self.max * 1000:8.02f}ms'
+
+
+class RunMetrics:
+    """
+    Timing histograms of every stage (compose, encode, metadata, write, exif, checksum, sinks, and journal)
+    across all the tokens of a run (including the tokens rendered by worker processes).
+    """
+
+    def __init__(self):
+        self.p_start = time.perf_counter()
+        self.stages: dict[str, TimingHistogram] = {}
+        self.render = TimingHistogram()
+
+    def add(self, stage: str, seconds: float):
+        histogram = self.stages.get(stage)
+        if histogram is None:
+            histogram = self.stages[stage] = TimingHistogram()
+        histogram.add(seconds)
+
+    def add_result(self, result: RenderResult):
+        self.render.add(result.elapsed)
+        for stage, seconds in result.stages.items():
+            self.add(stage, seconds)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.p_start
+
+    def to_dict(self) -> dict:
+        return {
+            'render': self.render.to_dict(),
+            'stages': {stage: histogram.to_dict() for stage, histogram in self.stages.items()}
+        }
+
+    def print_summary(self):
+        print(f'  {"render":10} {self.render}')
+        for stage, histogram in self.stages.items():
+            print(f'  {stage:10} {histogram}')
+
+    def write_json(self, metrics_path: str, **details):
+        """
+        Write the metrics (and any other run details) as JSON.
+        :param metrics_path: JSON file path.
+        :param details: other JSON serializable run details to include (e.g., settings and totals).
+        """
+        with open(metrics_path, 'w', encoding='utf-8') as metrics_file:
+            json.dump(details | self.to_dict(), metrics_file, indent=2)
+
+
+class ProgressReporter:
+    """
+    Prints the progress (throughput and ETA) at most once per interval instead of a line per token.
+    """
+
+    def __init__(self, total: int, interval: float = 2.0):
+        """
+        :param total: number of tokens expected (`0` if unknown).
+        :param interval: minimum seconds between progress lines.
+        """
+        self.total = total
+        self.interval = interval
+        self.p_start = time.perf_counter()
+        self.p_next = self.p_start + interval
+        self.last_done = -1
+
+    def update(self, num_done: int, num_trials: int | None = None, force: bool = False):
+        """
+        Print the progress if the interval has passed.
+        :param num_done: number of tokens finished so far.
+        :param num_trials: number of random trials so far (only in weighted mode).
+        :param force: print even if the interval hasn't passed (e.g., when finished) unless nothing changed.
+        """
+        p_now = time.perf_counter()
+        if num_done == self.last_done or (p_now < self.p_next and not force):
+            return
+        self.p_next = p_now + self.interval
+        self.last_done = num_done
+
+        elapsed = max(p_now - self.p_start, 1e-9)
+        rate = num_done / elapsed
+        line = f'[{num_done}'
+        if self.total > 0:
+            line += f'/{self.total} {num_done * 100 / self.total:5.01f}%'
+        line += f'] {rate:.02f} images/s'
+        if num_trials is not None:
+            line += f', {num_trials / elapsed:.02f} trials/s'
+        if self.total > 0 and rate > 0:
+            eta = datetime.timedelta(seconds=round((self.total - num_done) / rate))
+            line += f', ETA {eta}'
+        print(line, flush=True)
@@ -0,0 +1,181 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+from typing import Callable
+
+import numpy as np
+from wand.image import Image
+
+from compositor_backends import SparseTrait
+from png_encoding import PngEncodingProfile
+from util import TraitImageInfo
+
+
+def decode_rgba(path: str) -> np.ndarray:
+    """
+    Decode an image file into straight (not premultiplied) RGBA pixels.
+    :param path: image file path.
+    :return: `uint8` (or big-endian `uint16` if the image has 16-bit precision) array
+        with shape `(height, width, 4)`.
+    """
+    with Image(filename=path) as image:
+        return rgba_pixels(image)
+
+
+def rgba_pixels(image: Image) -> np.ndarray:
+    """
+    Export the straight (not premultiplied) RGBA pixels of a Wand image.
+    :param image: Wand image (its depth may be changed).
+    :return: `uint8` (or big-endian `uint16` if the image has 16-bit precision) array
+        with shape `(height, width, 4)`.
+    """
+
+    # keep 16-bit precision when the image has it
+    depth = 16 if image.depth > 8 else 8
+    image.depth = depth
+    raw = image.make_blob('RGBA')
+    return np.frombuffer(raw, dtype='>u2' if depth == 16 else np.uint8).reshape(image.height, image.width, 4)
+
+
+def premultiply(pixels: np.ndarray) -> np.ndarray:
+    """
+    :param pixels: straight RGBA pixels (see :py:func:`decode_rgba`).
+    :return: premultiplied RGBA array (float32 values from 0 to 1) with the same shape.
+    """
+    depth = 16 if pixels.dtype.itemsize == 2 else 8
+    premultiplied = pixels.astype(np.float32) / np.float32(2 ** depth - 1)
+    premultiplied[..., :3] *= premultiplied[..., 3:]
+    return premultiplied
+
+
+def decode_premultiplied(path: str) -> np.ndarray:
+    """
+    Decode an image file into a premultiplied RGBA array (float32 values from 0 to 1).
+    :param path: image file path.
+    :return: array with shape `(height, width, 4)`.
+    """
+    return premultiply(decode_rgba(path))
+
+
+def composite_over(src: np.ndarray, dst: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+    """
+    Porter-Duff "over" of premultiplied RGBA arrays (`src + dst * (1 - src_alpha)`).
+    The arrays are broadcast, so a stack of `src` images can be composited over one shared `dst` (or vice versa).
+    :param src: top premultiplied RGBA array(s).
+    :param dst: bottom premultiplied RGBA array(s).
+    :param out: optional array to store the result in (may be `dst` to composite in place).
+    :return: composited premultiplied RGBA array(s).
+    """
+    out = np.multiply(dst, 1 - src[..., 3:], out=out)
+    out += src
+    return out
+
+
+def composite_over_region(src: np.ndarray, dst: np.ndarray, left: int, top: int):
+    """
+    Porter-Duff "over" of a (smaller) premultiplied RGBA array onto a region of another one (in place).
+    :param src: top premultiplied RGBA array.
+    :param dst: bottom premultiplied RGBA array (updated in place).
+    :param left: x offset of `src` in `dst`.
+    :param top: y offset of `src` in `dst`.
+    """
+    region = dst[top:top + src.shape[0], left:left + src.shape[1]]
+    composite_over(src, region, out=region)
+
+
+def encode_png(premultiplied: np.ndarray, profile: PngEncodingProfile = PngEncodingProfile()) -> bytes:
+    """
+    Encode a premultiplied RGBA array as an RGBA PNG (using ImageMagick only for the encoding).
+    :param premultiplied: array with shape `(height, width, 4)`.
+    :param profile: PNG encoding options (8-bit unless the profile bit depth is 16).
+    :return: encoded PNG bytes.
+    """
+
+    alpha = premultiplied[..., 3:]
+    straight = np.zeros_like(premultiplied)
+    np.divide(premultiplied[..., :3], alpha, out=straight[..., :3], where=alpha > 0)
+    straight[..., 3:] = alpha
+
+    depth = 16 if profile.bit_depth == 16 else 8
+    max_value = 2 ** depth - 1
+    pixels = np.clip(np.rint(straight * max_value), 0, max_value).astype('>u2' if depth == 16 else np.uint8)
+    height, width = pixels.shape[:2]
+    with Image(blob=pixels.tobytes(), format='RGBA', width=width, height=height, depth=depth) as image:
+        profile.apply(image)
+        return image.make_blob('png')
+
+
+class NumpyCompositor:
+    """
+    Composites trait images with vectorized NumPy math instead of one ImageMagick call per layer.
+
+    Each trait is decoded once into a premultiplied RGBA array (through the trait image cache). Consecutive
+    images that only differ in the top layer (e.g., when generating ALL permutations) are composited as a batch
+    by compositing the stack of top layers over their shared base in a single operation.
+    Top layers cropped to their bounding boxes are composited over copies of the base one region at a time instead.
+    """
+
+    def __init__(self, load_image: Callable[[TraitImageInfo], np.ndarray | SparseTrait], backend):
+        """
+        :param load_image: function that returns the (cached) premultiplied array of a trait.
+        :param backend: NumPy compositor backend (to composite trait images cropped to their bounding boxes).
+        """
+        self.load_image = load_image
+        self.backend = backend
+
+    def composite_base(self, parts: list[TraitImageInfo]) -> np.ndarray:
+        """
+        Composite the image parts in layer order.
+        :param parts: image parts to use when generating image.
+        :return: a new premultiplied RGBA array.
+        """
+
+        generated = self.backend.copy(self.load_image(parts[0]))
+        for part in parts[1:]:
+            try:
+                self.backend.composite(generated, self.load_image(part))
+            except ValueError as e:
+                raise ValueError(f'{e}: {part.path}')
+        return generated
+
+    def composite_batch(self, base_parts: list[TraitImageInfo], top_parts: list[TraitImageInfo]) -> np.ndarray:
+        """
+        Composite each top part over the same shared base parts.
+        :param base_parts: image parts shared by every image in the batch.
+        :param top_parts: top image part of each image in the batch.
+        :return: premultiplied RGBA arrays with shape `(len(top_parts), height, width, 4)`.
+        """
+
+        tops = [self.load_image(part) for part in top_parts]
+        if any(isinstance(top, SparseTrait) for top in tops):
+            if base_parts:
+                base = self.composite_base(base_parts)
+            else:
+                # any sparse top knows the canvas size (a fully opaque trait isn't cropped)
+                sparse = next(top for top in tops if isinstance(top, SparseTrait))
+                base = self.backend.blank(sparse.canvas_width, sparse.canvas_height)
+            generated = np.repeat(base[np.newaxis], len(tops), axis=0)
+            for image, top in zip(generated, tops):
+                self.backend.composite(image, top)
+            return generated
+
+        tops = np.stack(tops)
+        if not base_parts:
+            return tops
+
+        base = self.composite_base(base_parts)
+        if tops.shape[1:] != base.shape:
+            raise ValueError(f'Trait image sizes {tops.shape[2:0:-1]} and {base.shape[1::-1]} do not match')
+        return composite_over(tops, base)
@@ -0,0 +1,175 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import csv
+import multiprocessing
+import os
+import sys
+
+from compositor_backends import BACKENDS, CompositorBackend, create_backend
+from renderer import Renderer
+from util import *
+
+
+class PixelIndex:
+    """
+    Index of the pixel digests of the images generated so far (to find visually identical images).
+
+    Unique traits can still produce identical images (e.g., a trait that is completely hidden by a higher layer
+    or a blank trait image), which can only be detected by comparing the pixels.
+    """
+
+    def __init__(self):
+        self.first_images: dict[str, str] = {}
+        self.duplicates: list[tuple[str, str]] = []
+
+    def add(self, pixel_digest: str, file_name: str) -> str | None:
+        """
+        Add an image to the index.
+        :param pixel_digest: digest of the image pixels.
+        :param file_name: image file name.
+        :return: file name of the first image with the same pixels if this image is a duplicate; otherwise `None`.
+        """
+        first_image = self.first_images.setdefault(pixel_digest, file_name)
+        if first_image == file_name:
+            return None
+        self.duplicates.append((file_name, first_image))
+        return first_image
+
+    def write_csv(self, csv_path: str):
+        """
+        Write the duplicate images (and the first image each one duplicates) as a CSV file.
+        :param csv_path: CSV file path.
+        """
+        with open(csv_path, 'w', newline='') as duplicates_csv:
+            csvwriter = csv.writer(duplicates_csv)
+            csvwriter.writerow(['image', 'duplicate_of'])
+            csvwriter.writerows(self.duplicates)
+
+
+class PixelDeduper:
+    """
+    Composites candidate permutations before they are numbered so visually identical permutations can be
+    re-drawn (instead of only flagged after rendering). The composite of each unique permutation is kept by the
+    renderer (see `Renderer.planned`) and rendered as it is, so no permutation is composited twice.
+    """
+
+    def __init__(self, renderer: Renderer):
+        """
+        :param renderer: renderer (in this process) that composites and later renders the permutations.
+        """
+        self.renderer = renderer
+        self.pixel_digests: set[str] = set()
+        self.num_redrawn = 0
+
+    def is_unique(self, parts: list[TraitImageInfo]) -> bool:
+        """
+        Check (and remember) the pixels of a permutation.
+        :param parts: image parts of the permutation.
+        :return: `True` if no earlier permutation has the same pixels
+            (its composite is then kept for the renderer).
+        """
+        backend = self.renderer.backend
+        generated = self.renderer.composite(parts)
+        pixel_digest = backend.pixel_digest(generated)
+
+        if pixel_digest in self.pixel_digests:
+            backend.close_image(generated)
+            self.num_redrawn += 1
+            return False
+        self.pixel_digests.add(pixel_digest)
+        self.renderer.planned[tuple(map(lambda ti: ti.index, parts))] = (generated, pixel_digest)
+        return True
+
+    def discard(self, trait_indices: tuple[int, ...]):
+        """
+        Close the kept composite of a permutation that isn't rendered (e.g., a journaled one when resuming).
+        :param trait_indices: trait indices of the permutation.
+        """
+        planned = self.renderer.planned.pop(trait_indices, None)
+        if planned is not None:
+            self.renderer.backend.close_image(planned[0])
+
+
+# each scan worker process loads images with its own backend
+scan_backend: CompositorBackend | None = None
+
+
+def init_scan_worker(backend_name: str):
+    global scan_backend
+    scan_backend = create_backend(backend_name)
+
+
+def scan_image(file_path: str) -> str:
+    image = scan_backend.load(file_path)
+    pixel_digest = scan_backend.pixel_digest(image)
+    scan_backend.close_image(image)
+    return pixel_digest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Pixel Duplicates',
+        description='Scans the generated images in parallel for visually identical images (identical pixels).',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        '-W', '--workers',
+        dest='num_workers',
+        type=int,
+        default=os.cpu_count(),
+        help='number of worker processes decoding and hashing images'
+    )
+    parser.add_argument(
+        '--backend',
+        dest='backend',
+        choices=[name for name in BACKENDS.keys() if name != 'magick'],
+        default='wand',
+        help='backend used to decode the images'
+    )
+    parser.add_argument(
+        'generated_dir',
+        default='./generated',
+        help='generated output directory to scan'
+    )
+
+    args = parser.parse_args()
+
+    gen_image_dir_path = os.path.join(args.generated_dir, Const.GEN_IMAGE_SUBDIR)
+    file_names = sorted(entry.name for entry in os.scandir(gen_image_dir_path)
+                        if entry.is_file() and entry.name.lower().endswith('.png'))
+    print(f'Scanning [{len(file_names)}] images with [{args.num_workers}] worker processes...')
+
+    pixel_index = PixelIndex()
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.num_workers, initializer=init_scan_worker, initargs=(args.backend,)) as pool:
+        file_paths = [os.path.join(gen_image_dir_path, file_name) for file_name in file_names]
+        for file_name, pixel_digest in zip(file_names, pool.imap(scan_image, file_paths, chunksize=16)):
+            pixel_index.add(pixel_digest, file_name)
+
+    duplicates_csv_path = os.path.join(args.generated_dir, Const.PIXEL_DUPLICATES_FILE_NAME)
+    pixel_index.write_csv(duplicates_csv_path)
+
+    print(f'\nPIXEL DUPLICATES: {len(pixel_index.duplicates)} (see {duplicates_csv_path})')
+    for file_name, first_image in pixel_index.duplicates:
+        print(f'  {file_name} == {first_image}')
+
+    sys.stdout.flush()
+    exit(1 if pixel_index.duplicates else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import multiprocessing
+import os
+import struct
+import sys
+import time
+import zlib
+
+from png_metadata import PNG_SIGNATURE
+from util import *
+
+# color type -> (samples per pixel, allowed bit depths, description)
+PNG_COLOR_TYPES = {
+    0: (1, (1, 2, 4, 8, 16), 'grayscale'),
+    2: (3, (8, 16), 'RGB'),
+    3: (1, (1, 2, 4, 8), 'palette'),
+    4: (2, (8, 16), 'grayscale+alpha'),
+    6: (4, (8, 16), 'RGB+alpha')
+}
+
+# Adam7 passes (x start, y start, x step, y step)
+ADAM7_PASSES = [(0, 0, 8, 8), (4, 0, 8, 8), (0, 4, 4, 8), (2, 0, 4, 4), (0, 2, 2, 4), (1, 0, 2, 2), (0, 1, 1, 2)]
+
+MAX_FILTER_TYPE = 4
+
+
+class CorruptPngError(ValueError):
+    """
+    Raised when a PNG image is damaged (or isn't a PNG image).
+    """
+
+
+def scanline_sizes(width: int, height: int, bits_per_pixel: int, interlaced: bool) -> list[tuple[int, int]]:
+    """
+    :param width: image width.
+    :param height: image height.
+    :param bits_per_pixel: bits per pixel (samples per pixel x bit depth).
+    :param interlaced: `True` if the image uses Adam7 interlacing.
+    :return: (number of rows, bytes per row including the filter type byte) of each (non-empty) pass.
+    """
+    passes = ADAM7_PASSES if interlaced else [(0, 0, 1, 1)]
+    sizes = []
+    for x_start, y_start, x_step, y_step in passes:
+        pass_width = (width - x_start + x_step - 1) // x_step
+        pass_height = (height - y_start + y_step - 1) // y_step
+        if pass_width > 0 and pass_height > 0:
+            sizes.append((pass_height, 1 + (pass_width * bits_per_pixel + 7) // 8))
+    return sizes
+
+
+def check_png(png_bytes: bytes) -> str:
+    """
+    Validate an encoded PNG image: the chunk structure and every chunk CRC, the IHDR header, and that the
+    IDAT stream inflates to exactly the size of the image scanlines (with a valid filter type on every row).
+    :param png_bytes: encoded PNG image.
+    :return: summary of the image (like `pngcheck`).
+    :raises CorruptPngError: if the image is damaged.
+    """
+
+    if not png_bytes.startswith(PNG_SIGNATURE):
+        raise CorruptPngError('missing PNG signature')
+
+    header = None
+    idat = []
+    idat_done = False
+    has_palette = False
+    num_chunks = 0
+    offset = len(PNG_SIGNATURE)
+    view = memoryview(png_bytes)
+    while True:
+        if offset + 8 > len(png_bytes):
+            raise CorruptPngError(f'truncated chunk header at offset {offset}')
+        length, chunk_type = struct.unpack_from('>I4s', png_bytes, offset)
+        chunk_end = offset + 8 + length + 4
+        if length > 0x7FFFFFFF or chunk_end > len(png_bytes):
+            raise CorruptPngError(f'truncated {chunk_type.decode("latin-1")} chunk at offset {offset}')
+        if not chunk_type.isalpha():
+            raise CorruptPngError(f'invalid chunk type {chunk_type!r} at offset {offset}')
+        crc, = struct.unpack_from('>I', png_bytes, chunk_end - 4)
+        if zlib.crc32(view[offset + 4:chunk_end - 4]) != crc:
+            raise CorruptPngError(f'CRC error in {chunk_type.decode("latin-1")} chunk at offset {offset}')
+        data = view[offset + 8:chunk_end - 4]
+        num_chunks += 1
+
+        if num_chunks == 1 and chunk_type != b'IHDR':
+            raise CorruptPngError('first chunk must be IHDR')
+        if chunk_type == b'IHDR':
+            if header is not None:
+                raise CorruptPngError('multiple IHDR chunks')
+            if length != 13:
+                raise CorruptPngError(f'invalid IHDR length {length}')
+            header = struct.unpack('>IIBBBBB', data)
+        elif chunk_type == b'PLTE':
+            has_palette = True
+        elif chunk_type == b'IDAT':
+            if idat_done:
+                raise CorruptPngError('IDAT chunks are not consecutive')
+            idat.append(data)
+        elif idat:
+            idat_done = True
+
+        offset = chunk_end
+        if chunk_type == b'IEND':
+            break
+
+    if offset != len(png_bytes):
+        raise CorruptPngError(f'{len(png_bytes) - offset} bytes of data after IEND')
+
+    width, height, bit_depth, color_type, compression, filter_method, interlace = header
+    if width == 0 or height == 0:
+        raise CorruptPngError(f'invalid image size {width}x{height}')
+    if color_type not in PNG_COLOR_TYPES or bit_depth not in PNG_COLOR_TYPES[color_type][1]:
+        raise CorruptPngError(f'invalid bit depth {bit_depth} for color type {color_type}')
+    if compression != 0 or filter_method != 0 or interlace not in (0, 1):
+        raise CorruptPngError('invalid compression, filter, or interlace method')
+    if color_type == 3 and not has_palette:
+        raise CorruptPngError('palette image without a PLTE chunk')
+    if not idat:
+        raise CorruptPngError('no IDAT chunks')
+
+    samples, _, color_desc = PNG_COLOR_TYPES[color_type]
+    sizes = scanline_sizes(width, height, samples * bit_depth, interlace == 1)
+    expected_size = sum(rows * row_size for rows, row_size in sizes)
+
+    inflater = zlib.decompressobj()
+    try:
+        # never inflate more than the expected size (plus a byte to detect extra data)
+        raw = inflater.decompress(b''.join(idat), expected_size + 1)
+    except zlib.error as error:
+        raise CorruptPngError(f'IDAT stream is damaged ({error})')
+    if len(raw) != expected_size:
+        raise CorruptPngError(f'IDAT stream inflates to {len(raw)} bytes instead of {expected_size}')
+    if not inflater.eof:
+        raise CorruptPngError('IDAT stream is truncated')
+    if inflater.unused_data:
+        raise CorruptPngError('IDAT stream has data after its end')
+
+    # the first byte of every scanline is its filter type
+    start = 0
+    for rows, row_size in sizes:
+        if max(raw[start:start + rows * row_size:row_size]) > MAX_FILTER_TYPE:
+            raise CorruptPngError('invalid scanline filter type')
+        start += rows * row_size
+
+    compression_ratio = 100 * (1 - len(png_bytes) / expected_size)
+    return (f'{width}x{height}, {samples * bit_depth}-bit {color_desc}, '
+            f'{"interlaced" if interlace else "non-interlaced"}, {compression_ratio:.1f}%')
+
+
+def check_png_file(file_path: str) -> tuple[str, str | None]:
+    """
+    :param file_path: PNG file path.
+    :return: the file path and the problem found (`None` if the image is valid).
+    """
+    try:
+        with open(file_path, 'rb') as png_file:
+            check_png(png_file.read())
+        return file_path, None
+    except (CorruptPngError, OSError) as error:
+        return file_path, str(error)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='PNG Check',
+        description='Validates the generated PNG images in parallel (chunk CRCs and inflated image data).',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        '-W', '--workers',
+        dest='num_workers',
+        type=int,
+        default=os.cpu_count(),
+        help='number of worker processes validating images'
+    )
+    parser.add_argument(
+        'generated_dir',
+        default='./generated',
+        help='generated output directory to check'
+    )
+
+    args = parser.parse_args()
+
+    p_start = time.perf_counter()
+    gen_image_dir_path = os.path.join(args.generated_dir, Const.GEN_IMAGE_SUBDIR)
+    file_paths = sorted(entry.path for entry in os.scandir(gen_image_dir_path)
+                        if entry.is_file() and entry.name.lower().endswith('.png'))
+    print(f'Checking [{len(file_paths)}] images with [{args.num_workers}] worker processes...')
+
+    bad_pngs = []
+    with multiprocessing.get_context('spawn').Pool(args.num_workers) as pool:
+        for file_path, problem in pool.imap_unordered(check_png_file, file_paths, chunksize=16):
+            if problem is not None:
+                bad_pngs.append((file_path, problem))
+
+    if bad_pngs:
+        print('\nBad PNG files were discovered:')
+        for file_path, problem in sorted(bad_pngs):
+            print(f'  {file_path}: {problem}')
+    else:
+        print('\nNo bad PNG files were discovered.')
+    print(f'TOTAL TIME: {time.perf_counter() - p_start:.03f}s')
+
+    sys.stdout.flush()
+    exit(1 if bad_pngs else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import random
+import time
+from dataclasses import dataclass, replace
+
+from util import *
+
+# https://imagemagick.org/script/command-line-options.php#define (png:compression-*)
+PNG_FILTERS = {
+    'none': 0,
+    'sub': 1,
+    'up': 2,
+    'average': 3,
+    'paeth': 4,
+    'adaptive': 5
+}
+PNG_STRATEGIES = {
+    'default': 0,
+    'filtered': 1,
+    'huffman': 2,
+    'rle': 3,
+    'fixed': 4
+}
+
+
+@dataclass(frozen=True)
+class PngEncodingProfile:
+    """
+    PNG encoding options (`None` keeps the ImageMagick default).
+    """
+
+    compression_level: int | None = None
+    compression_filter: str | None = None
+    compression_strategy: str | None = None
+    bit_depth: int | None = None
+
+    def apply(self, image):
+        """
+        Set the encoding options on an image before it is saved (or encoded into a blob).
+        :param image: Wand image to be encoded.
+        """
+        if self.compression_level is not None:
+            image.options['png:compression-level'] = str(self.compression_level)
+        if self.compression_filter is not None:
+            image.options['png:compression-filter'] = str(PNG_FILTERS[self.compression_filter])
+        if self.compression_strategy is not None:
+            image.options['png:compression-strategy'] = str(PNG_STRATEGIES[self.compression_strategy])
+        if self.bit_depth is not None:
+            image.depth = self.bit_depth
+            image.options['png:bit-depth'] = str(self.bit_depth)
+
+    def __str__(self):
+        return ' '.join([
+            f'level={self.compression_level if self.compression_level is not None else "-"}',
+            f'filter={self.compression_filter or "-"}',
+            f'strategy={self.compression_strategy or "-"}',
+            f'depth={self.bit_depth or "-"}'
+        ])
+
+
+PNG_PROFILES = {
+    'default': PngEncodingProfile(),
+    'fast': PngEncodingProfile(compression_level=1, compression_filter='none', compression_strategy='default'),
+    'small': PngEncodingProfile(compression_level=9, compression_filter='adaptive', compression_strategy='default')
+}
+
+
+def png_bit_depth(path: str) -> int:
+    """
+    Read the bit depth of a PNG file from its IHDR chunk (without decoding the image).
+    :param path: PNG file path.
+    :return: bit depth per sample (e.g., 8 or 16).
+    """
+    with open(path, 'rb') as png_file:
+        header = png_file.read(25)
+    # signature (8) + length (4) + type (4) + width (4) + height (4) + bit depth (1)
+    if len(header) < 25 or header[12:16] != b'IHDR':
+        raise ValueError(f'Not a PNG image: {path}')
+    return header[24]
+
+
+def required_bit_depth(layers: list[LayerInfo]) -> int:
+    """
+    :param layers: layers of trait images.
+    :return: `16` if any PNG trait image has more than 8 bits per sample; otherwise `8`.
+    """
+    for layer in layers:
+        for trait_image in layer.trait_images:
+            # the layer loader keeps every file as a trait (the backends decode other formats too),
+            # so other files (e.g., JPEG) are treated as 8 bits per sample instead of failing the run
+            try:
+                if png_bit_depth(trait_image.path) > 8:
+                    return 16
+            except ValueError:
+                pass
+    return 8
+
+
+def benchmark_profiles(images: list,
+                       profiles: list[PngEncodingProfile]) -> list[tuple[PngEncodingProfile, float, float]]:
+    """
+    Encode every image with every profile.
+    :param images: sample Wand images to encode.
+    :param profiles: encoding profiles to compare.
+    :return: list of `(profile, ms/image, bytes/image)`.
+    """
+    # imported here so the encoding profiles can be used without ImageMagick (e.g., by the Pillow backend)
+    from wand.image import Image
+
+    results = []
+    for profile in profiles:
+        total_time = 0.0
+        total_bytes = 0
+        for image in images:
+            with Image(image) as encoded:
+                profile.apply(encoded)
+                p_start = time.perf_counter()
+                total_bytes += len(encoded.make_blob('png'))
+                total_time += time.perf_counter() - p_start
+        results.append((profile, total_time * 1000 / len(images), total_bytes / len(images)))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='PNG Encoding Benchmark',
+        description='Encodes sample composite images with several PNG encoding profiles '
+                    'to compare speed and size.',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        '-n', '--samples',
+        dest='num_samples',
+        type=int,
+        default=5,
+        help='number of random sample images to composite and encode'
+    )
+    parser.add_argument(
+        'layers_dir',
+        default='./layers',
+        help='layers input directory'
+    )
+
+    args = parser.parse_args()
+
+    from wand.image import Image
+
+    layers = load_layers(args.layers_dir, verbose=False)
+    depth = required_bit_depth(layers)
+    print(f'Layers discovered: {len(layers)} (required bit depth: {depth})')
+
+    images = []
+    for _ in range(args.num_samples):
+        generated = None
+        for layer in layers:
+            trait_image = random.choice(layer.trait_images)
+            with Image(filename=trait_image.path) as image:
+                if generated is None:
+                    generated = Image(image)
+                else:
+                    generated.composite(image)
+        images.append(generated)
+    print(f'Sample images composited: {len(images)}\n')
+
+    profiles = list(PNG_PROFILES.values())
+    for level in [1, 3, 6, 9]:
+        for compression_filter in ['none', 'sub', 'paeth', 'adaptive']:
+            profiles.append(PngEncodingProfile(compression_level=level, compression_filter=compression_filter))
+    for compression_strategy in ['filtered', 'huffman', 'rle']:
+        profiles.append(PngEncodingProfile(compression_level=6, compression_strategy=compression_strategy))
+    if depth < 16:
+        profiles = profiles + [replace(profile, bit_depth=8) for profile in profiles]
+
+    print(f'{"ms/image":>10} {"bytes/image":>12}  profile')
+    for profile, ms_per_image, bytes_per_image in sorted(benchmark_profiles(images, profiles), key=lambda r: r[1]):
+        print(f'{ms_per_image:10.01f} {bytes_per_image:12.0f}  {profile}')
+
+    for image in images:
+        image.close()
+
+
+if __name__ == '__main__':
+    main()
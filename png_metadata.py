@@ -0,0 +1,165 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import struct
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+from exif_updater import load_exif_config
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# EXIF (TIFF IFD0) tags written into the eXIf chunk
+EXIF_TAG_IMAGE_DESCRIPTION = 0x010E
+EXIF_TAG_ARTIST = 0x013B
+EXIF_TAG_COPYRIGHT = 0x8298
+EXIF_TYPE_ASCII = 2
+
+
+def png_chunk(chunk_type: bytes, data: bytes) -> bytes:
+    """
+    Build a PNG chunk (length, type, data, and CRC).
+    :param chunk_type: 4 byte chunk type.
+    :param data: chunk data.
+    :return: chunk bytes.
+    """
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+
+def itxt_chunk(keyword: str, text: str) -> bytes:
+    """
+    Build an uncompressed PNG iTXt (international text) chunk.
+    :param keyword: Latin-1 keyword (e.g., `Title`, `XML:com.adobe.xmp`).
+    :param text: UTF-8 text value.
+    :return: chunk bytes.
+    """
+    # keyword, compression flag, compression method, language tag, translated keyword, text
+    data = keyword.encode('latin-1') + b'\x00\x00\x00' + b'\x00' + b'\x00' + text.encode('utf-8')
+    return png_chunk(b'iTXt', data)
+
+
+def exif_chunk(tags: dict[int, str]) -> bytes:
+    """
+    Build a PNG eXIf chunk containing a big-endian TIFF header and a single IFD of ASCII tags.
+    EXIF readers decode ASCII values as Latin-1, so other characters are replaced with `?`
+    (the exact UTF-8 values are in the iTXt and XMP chunks).
+    :param tags: EXIF tag IDs mapped to string values.
+    :return: chunk bytes.
+    """
+
+    entries = sorted(tags.items())
+    ifd_offset = 8
+    ifd_size = 2 + len(entries) * 12 + 4
+    value_offset = ifd_offset + ifd_size
+
+    ifd = struct.pack('>H', len(entries))
+    values = b''
+    for tag, value in entries:
+        value_bytes = value.encode('latin-1', errors='replace') + b'\x00'
+        if len(value_bytes) <= 4:
+            ifd += struct.pack('>HHI', tag, EXIF_TYPE_ASCII, len(value_bytes)) + value_bytes.ljust(4, b'\x00')
+        else:
+            ifd += struct.pack('>HHII', tag, EXIF_TYPE_ASCII, len(value_bytes), value_offset + len(values))
+            values += value_bytes
+            if len(values) % 2:
+                # TIFF values start on word boundaries
+                values += b'\x00'
+    ifd += struct.pack('>I', 0)
+
+    return png_chunk(b'eXIf', b'MM\x00\x2a' + struct.pack('>I', ifd_offset) + ifd + values)
+
+
+class PngMetadataWriter:
+    """
+    Writes the same metadata as :py:class:`exif_updater.ExifUpdater` directly into the PNG bytes while saving
+    (as eXIf, iTXt, and XMP chunks) so each image file is only written once and exiftool isn't needed.
+    """
+
+    def __init__(self):
+        self.data = load_exif_config()
+
+        contact = self.data['contact']
+        self.author = contact['author']
+        self.copyright = self.data['copyright']
+
+        # everything except the title and description is the same for every image
+        self.xmp_prefix = ''.join([
+            '<?xpacket begin="\ufeff" id="W5M0MpCehiHzreSzNTczkc9d"?>',
+            '<x:xmpmeta xmlns:x="adobe:ns:meta/">',
+            '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">',
+            '<rdf:Description rdf:about=""',
+            ' xmlns:dc="http://purl.org/dc/elements/1.1/"',
+            ' xmlns:pdf="http://ns.adobe.com/pdf/1.3/"',
+            ' xmlns:xmpRights="http://ns.adobe.com/xap/1.0/rights/"',
+            ' xmlns:Iptc4xmpCore="http://iptc.org/std/Iptc4xmpCore/1.0/xmlns/"',
+            f' pdf:Author={quoteattr(self.author)}',
+            f' pdf:Keywords={quoteattr(", ".join(self.data["keywords"]))}',
+            ' xmpRights:Marked="True"',
+            f' Iptc4xmpCore:CountryCode={quoteattr(contact["country"]["code"])}>',
+            f'<dc:creator><rdf:Seq><rdf:li>{escape(self.author)}</rdf:li></rdf:Seq></dc:creator>',
+            '<dc:rights><rdf:Alt>',
+            f'<rdf:li xml:lang="x-default">{escape(self.copyright)}</rdf:li>',
+            '</rdf:Alt></dc:rights>',
+            f'<dc:subject><rdf:Bag><rdf:li>{escape(self.data["subject"])}</rdf:li></rdf:Bag></dc:subject>',
+            '<Iptc4xmpCore:CreatorContactInfo rdf:parseType="Resource">',
+            f'<Iptc4xmpCore:CiEmailWork>{escape(contact["email"])}</Iptc4xmpCore:CiEmailWork>',
+            f'<Iptc4xmpCore:CiUrlWork>{escape(contact["url"])}</Iptc4xmpCore:CiUrlWork>',
+            f'<Iptc4xmpCore:CiAdrCtry>{escape(contact["country"]["name"])}</Iptc4xmpCore:CiAdrCtry>',
+            '</Iptc4xmpCore:CreatorContactInfo>',
+        ])
+        self.xmp_suffix = '</rdf:Description></rdf:RDF></x:xmpmeta><?xpacket end="w"?>'
+
+        self.common_chunks = itxt_chunk('Author', self.author) + itxt_chunk('Copyright', self.copyright)
+
+    def xmp(self, image_desc: str, details: str) -> str:
+        return ''.join([
+            self.xmp_prefix,
+            f'<dc:title><rdf:Alt><rdf:li xml:lang="x-default">{escape(image_desc)}</rdf:li></rdf:Alt></dc:title>',
+            '<dc:description><rdf:Alt>',
+            f'<rdf:li xml:lang="x-default">{escape(details)}</rdf:li>',
+            '</rdf:Alt></dc:description>',
+            self.xmp_suffix
+        ])
+
+    def add_metadata(self, png_bytes: bytes, image_desc: str, traits_str: str) -> bytes:
+        """
+        Insert the metadata chunks into encoded PNG bytes (right after the IHDR chunk).
+        :param png_bytes: encoded PNG image.
+        :param image_desc: image description (also used as the title).
+        :param traits_str: traits JSON string (appended to the description and comment).
+        :return: encoded PNG image including the metadata.
+        """
+
+        if not png_bytes.startswith(PNG_SIGNATURE):
+            raise ValueError('Not a PNG image')
+
+        # IHDR is always the first chunk (length + type + 13 bytes of data + CRC)
+        ihdr_end = len(PNG_SIGNATURE) + 4 + 4 + 13 + 4
+
+        details = image_desc + ' :: ' + traits_str
+        chunks = b''.join([
+            exif_chunk({
+                EXIF_TAG_IMAGE_DESCRIPTION: details,
+                EXIF_TAG_ARTIST: self.author,
+                EXIF_TAG_COPYRIGHT: self.copyright
+            }),
+            self.common_chunks,
+            itxt_chunk('Title', image_desc),
+            itxt_chunk('Description', details),
+            itxt_chunk('Comment', details),
+            itxt_chunk('XML:com.adobe.xmp', self.xmp(image_desc, details))
+        ])
+
+        return png_bytes[:ihdr_end] + chunks + png_bytes[ihdr_end:]
@@ -0,0 +1,260 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import argparse
+import csv
+import json
+import os
+import time
+
+import numpy as np
+
+from util import *
+
+# trait index of a layer that a token doesn't have a trait for
+NO_TRAIT = -1
+
+RARITY_FIELDNAMES = ['rarity_score', 'rarity_rank']
+
+# plain CSV rows are parsed much faster than dicts
+NAME_COLUMN = Const.CSV_FIELDNAMES.index(Const.CSV_FIELD_NAME)
+ATTS_COLUMN = Const.CSV_FIELDNAMES.index(Const.CSV_FIELD_ATTS)
+
+
+def read_trait_matrix(csv_paths: list[str], layers: list[LayerInfo]) -> np.ndarray:
+    """
+    Read the CSV attributes of every token into a compact matrix of trait indices.
+    :param csv_paths: metadata CSV file paths (read in order as if they were one CSV).
+    :param layers: layers in layering order.
+    :return: trait index matrix (tokens x layers) with `NO_TRAIT` for layers a token doesn't have.
+    :raises ValueError: if a token has a trait that isn't in the layers.
+    """
+
+    layer_indices = {layer.trait_type: layer_index for layer_index, layer in enumerate(layers)}
+    trait_indices = {(trait_image.trait.type, trait_image.trait.value): trait_image.index
+                     for layer in layers for trait_image in layer.trait_images}
+
+    rows: list[list[int]] = []
+    for csv_path in csv_paths:
+        with open(csv_path, 'r', newline='', buffering=2 ** 20) as assets_csv:
+            csvreader = csv.reader(assets_csv)
+            # skip the header
+            next(csvreader, None)
+            for row in csvreader:
+                token = [NO_TRAIT] * len(layers)
+                for trait in json.loads(row[ATTS_COLUMN]):
+                    key = (trait['trait_type'], trait['value'])
+                    if key not in trait_indices:
+                        raise ValueError(f'Unknown trait [{key[0]}: {key[1]}] in row: {row[NAME_COLUMN]}')
+                    token[layer_indices[key[0]]] = trait_indices[key]
+                rows.append(token)
+
+    return np.array(rows, dtype=np.int32).reshape(len(rows), len(layers))
+
+
+def trait_matrix(trait_indices: list[tuple[int, ...]], num_layers: int) -> np.ndarray:
+    """
+    :param trait_indices: trait indices of each token (e.g., the in-run permutations of generate_nfts.py).
+    :param num_layers: number of layers.
+    :return: trait index matrix (tokens x layers).
+    """
+    return np.array(trait_indices, dtype=np.int32).reshape(len(trait_indices), num_layers)
+
+
+class RarityStats:
+    """
+    Trait frequencies and token rarity scores of a collection computed from its trait index matrix.
+
+    The rarity score of a token is the sum of `1 / frequency` of each of its traits (so rare traits dominate)
+    and tokens are ranked by score (tied scores share the best rank). The realized frequency of each trait is
+    compared with the frequency expected from the trait weights.
+    """
+
+    def __init__(self, layers: list[LayerInfo], matrix: np.ndarray):
+        """
+        :param layers: layers in layering order.
+        :param matrix: trait index matrix (tokens x layers), see :py:func:`read_trait_matrix`.
+        """
+
+        self.layers = layers
+        self.matrix = matrix
+        self.num_tokens = matrix.shape[0]
+
+        # per layer trait arrays (the last entry of each count is the tokens without a trait for that layer)
+        self.counts: list[np.ndarray] = []
+        self.frequencies: list[np.ndarray] = []
+        self.expected: list[np.ndarray] = []
+        for layer_index, layer in enumerate(layers):
+            num_traits = len(layer.trait_images)
+            column = np.where(matrix[:, layer_index] == NO_TRAIT, num_traits, matrix[:, layer_index])
+            counts = np.bincount(column, minlength=num_traits + 1)
+            self.counts.append(counts)
+            self.frequencies.append(counts / max(self.num_tokens, 1))
+            self.expected.append(np.asarray(layer.weights, dtype=np.float64) / max(layer.total_weight, 1))
+
+        # gather the frequency of every trait of every token from one flat array (offset per layer)
+        offsets = np.cumsum([0] + [len(counts) for counts in self.counts[:-1]], dtype=np.int64)
+        flat_frequencies = np.concatenate(self.frequencies) if self.frequencies else np.zeros(0)
+        num_traits = np.array([len(layer.trait_images) for layer in layers], dtype=np.int64)
+        columns = np.where(matrix == NO_TRAIT, num_traits, matrix) + offsets
+        token_frequencies = flat_frequencies[columns]
+
+        self.scores = (1.0 / token_frequencies).sum(axis=1)
+        unique_scores, inverse, score_counts = np.unique(-self.scores, return_inverse=True, return_counts=True)
+        self.ranks = (np.cumsum(score_counts) - score_counts + 1)[inverse.reshape(-1)]
+
+    def deviation(self, layer_index: int) -> np.ndarray:
+        """
+        :param layer_index: layer index.
+        :return: realized minus expected frequency of each trait of the layer.
+        """
+        return self.frequencies[layer_index][:-1] - self.expected[layer_index]
+
+    def chi_square(self, layer_index: int) -> float:
+        """
+        :param layer_index: layer index.
+        :return: Pearson's chi-square statistic of the realized trait counts against the trait weights.
+        """
+        expected_counts = self.expected[layer_index] * self.num_tokens
+        observed_counts = self.counts[layer_index][:-1]
+        nonzero = expected_counts > 0
+        return float((((observed_counts - expected_counts) ** 2)[nonzero] / expected_counts[nonzero]).sum())
+
+    def to_dict(self, num_rarest: int = 10) -> dict:
+        rarest = np.argsort(self.ranks, kind='stable')[:num_rarest]
+        return {
+            'tokens': self.num_tokens,
+            'score': {
+                'min': float(self.scores.min()) if self.num_tokens else 0.0,
+                'mean': float(self.scores.mean()) if self.num_tokens else 0.0,
+                'max': float(self.scores.max()) if self.num_tokens else 0.0
+            },
+            'rarest_tokens': [{'row': int(row), 'score': float(self.scores[row]), 'rank': int(self.ranks[row])}
+                              for row in rarest],
+            'layers': [
+                {
+                    'trait_type': layer.trait_type,
+                    'chi_square': self.chi_square(layer_index),
+                    'missing': int(self.counts[layer_index][-1]),
+                    'traits': [
+                        {
+                            'value': trait_image.trait.value,
+                            'weight': trait_image.trait.weight,
+                            'count': int(self.counts[layer_index][trait_image.index]),
+                            'frequency': float(self.frequencies[layer_index][trait_image.index]),
+                            'expected': float(self.expected[layer_index][trait_image.index]),
+                            'deviation': float(self.deviation(layer_index)[trait_image.index])
+                        }
+                        for trait_image in layer.trait_images
+                    ]
+                }
+                for layer_index, layer in enumerate(self.layers)
+            ]
+        }
+
+    def print_summary(self):
+        print(f'\nTRAIT FREQUENCIES ({self.num_tokens} tokens):')
+        for layer_index, layer in enumerate(self.layers):
+            print(f'  {layer.trait_type} (chi-square vs. weights: {self.chi_square(layer_index):.02f})')
+            deviation = self.deviation(layer_index)
+            for trait_image in layer.trait_images:
+                print(f'    {trait_image.trait.value:24} '
+                      f'{self.counts[layer_index][trait_image.index]:8}  '
+                      f'{self.frequencies[layer_index][trait_image.index] * 100:6.02f}%  '
+                      f'(expected {self.expected[layer_index][trait_image.index] * 100:6.02f}%, '
+                      f'{deviation[trait_image.index] * 100:+6.02f}%)')
+        if self.num_tokens:
+            print(f'  RARITY SCORE: min {self.scores.min():.02f}  mean {self.scores.mean():.02f}  '
+                  f'max {self.scores.max():.02f}')
+
+    def write_csv(self, csv_paths: list[str], rarity_csv_path: str):
+        """
+        Write a copy of the metadata CSV with the rarity columns appended to each row.
+        :param csv_paths: metadata CSV file paths the matrix was read from.
+        :param rarity_csv_path: CSV file path to write.
+        """
+        with open(rarity_csv_path, 'w', newline='', buffering=2 ** 20) as rarity_csv:
+            csvwriter = csv.writer(rarity_csv)
+            csvwriter.writerow(Const.CSV_FIELDNAMES + RARITY_FIELDNAMES)
+            extra_columns = zip(np.char.mod('%.4f', self.scores).tolist(), self.ranks.tolist())
+            for csv_path in csv_paths:
+                with open(csv_path, 'r', newline='', buffering=2 ** 20) as assets_csv:
+                    csvreader = csv.reader(assets_csv)
+                    # skip the header
+                    next(csvreader, None)
+                    csvwriter.writerows(row + list(extra) for row, extra in zip(csvreader, extra_columns))
+
+    def write_json(self, report_path: str):
+        with open(report_path, 'w', encoding='utf-8') as report_file:
+            json.dump(self.to_dict(), report_file, indent=2)
+
+
+def write_rarity_report(layers: list[LayerInfo], matrix: np.ndarray, csv_paths: list[str], gen_dir_path: str):
+    """
+    Compute the rarity statistics and write the rarity CSV and JSON report to the generated directory.
+    :param layers: layers in layering order.
+    :param matrix: trait index matrix (tokens x layers) in the same row order as the CSV files.
+    :param csv_paths: metadata CSV file paths.
+    :param gen_dir_path: generated output directory.
+    :return: the rarity statistics.
+    """
+    stats = RarityStats(layers, matrix)
+    stats.print_summary()
+    rarity_csv_path = os.path.join(gen_dir_path, Const.RARITY_CSV_FILE_NAME)
+    stats.write_csv(csv_paths, rarity_csv_path)
+    report_path = os.path.join(gen_dir_path, Const.RARITY_REPORT_FILE_NAME)
+    stats.write_json(report_path)
+    print(f'RARITY: {rarity_csv_path} and {report_path}')
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Rarity',
+        description='Computes the trait frequencies and token rarity scores of a generated collection.',
+        epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
+
+    parser.add_argument(
+        '-c', '--csv',
+        dest='csv_paths',
+        action='append',
+        help='metadata CSV to read instead of the generated assets.csv (repeat to merge several CSVs in order)'
+    )
+    parser.add_argument(
+        'layers_dir',
+        default='./layers',
+        help='layers input directory (for the trait weights)'
+    )
+    parser.add_argument(
+        'generated_dir',
+        default='./generated',
+        help='generated output directory'
+    )
+
+    args = parser.parse_args()
+
+    p_start = time.perf_counter()
+    layers = load_layers(args.layers_dir, verbose=False)
+    csv_paths = args.csv_paths or [os.path.join(args.generated_dir, Const.DEFAULT_CSV_FILE_NAME)]
+
+    matrix = read_trait_matrix(csv_paths, layers)
+    print(f'Read [{matrix.shape[0]}] tokens x [{matrix.shape[1]}] layers in {time.perf_counter() - p_start:.03f}s')
+
+    write_rarity_report(layers, matrix, csv_paths, args.generated_dir)
+    print(f'TOTAL TIME: {time.perf_counter() - p_start:.03f}s')
+
+
+if __name__ == '__main__':
+    main()
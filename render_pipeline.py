@@ -0,0 +1,232 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import itertools
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Iterable, Iterator
+
+from metrics import LapTimer
+from png_check import CorruptPngError
+from renderer import Renderer
+from util import RenderJob, RenderResult
+
+# marks the end of the work sent to a stage (the stage passes it on and exits)
+STOP = None
+
+
+@dataclass
+class PipelineItem:
+    """
+    One token moving through the pipeline stages.
+    """
+    seq: int
+    job: RenderJob
+    timer: LapTimer
+    attempt: int = 0
+    pixel_digest: str | None = None
+    # composite image, then encoded PNG bytes
+    image: Any = None
+
+
+class RenderPipeline:
+    """
+    Renders tokens with the stages overlapped instead of back to back, so compositing isn't idle while an image
+    is being encoded or waiting on the disk and exiftool (and vice versa):
+
+        compose (calling thread) -> encode -> write -> exif (batched)
+
+    Each stage runs in its own thread (ImageMagick, Pillow, zlib, and file I/O release the GIL) and the stages are
+    connected by bounded queues, so a slow stage blocks the stages before it and only a few composite images and
+    encoded images are held in memory at any time. The exif stage updates every image that is waiting for it with
+    one exiftool command. Results are returned in the same order as the jobs.
+    """
+
+    def __init__(self, renderer: Renderer, queue_size: int = 4, exif_batch_size: int = 16, batch_size: int = 8):
+        """
+        :param renderer: renderer whose stages are run (only used by the pipeline threads from now on).
+        :param queue_size: maximum number of tokens waiting for each stage.
+        :param exif_batch_size: maximum number of image files updated by one exiftool command.
+        :param batch_size: number of jobs read ahead (and composited together by batch compositing backends).
+        """
+        self.renderer = renderer
+        self.exif_batch_size = exif_batch_size
+        self.batch_size = batch_size
+
+        self.encode_queue: queue.Queue[PipelineItem | None] = queue.Queue(queue_size)
+        self.write_queue: queue.Queue[PipelineItem | None] = queue.Queue(queue_size)
+        self.exif_queue: queue.Queue[PipelineItem | None] = queue.Queue(queue_size)
+        # not bounded because the calling thread drains it between composites
+        self.done_queue: queue.Queue[tuple[PipelineItem, RenderResult | Exception]] = queue.Queue()
+
+        stages = [self._encode_stage, self._write_stage]
+        if renderer.exif_updater is not None:
+            stages.append(self._exif_stage)
+        self.threads = [threading.Thread(target=stage, name=stage.__name__, daemon=True) for stage in stages]
+        for thread in self.threads:
+            thread.start()
+
+    def render(self, jobs: Iterable[RenderJob]) -> Iterator[tuple[RenderJob, RenderResult]]:
+        """
+        Render the jobs through the pipeline.
+        :param jobs: tokens to render.
+        :return: iterator of `(job, result)` in the same order as the jobs.
+        """
+
+        # finished tokens that are waiting for the tokens before them
+        finished: dict[int, tuple[RenderJob, RenderResult]] = {}
+        seq_next = 0
+        num_sent = 0
+        jobs_iter = iter(jobs)
+        while batch := list(itertools.islice(jobs_iter, self.batch_size)):
+            for group in self._groups(batch):
+                self._compose([PipelineItem(num_sent + i, job, LapTimer()) for i, job in enumerate(group)])
+                num_sent += len(group)
+                # return whatever is finished without waiting
+                self._collect(finished, block=False)
+                while seq_next in finished:
+                    yield finished.pop(seq_next)
+                    seq_next += 1
+
+        while seq_next < num_sent:
+            if seq_next not in finished:
+                self._collect(finished, block=True)
+                continue
+            yield finished.pop(seq_next)
+            seq_next += 1
+
+    def close(self):
+        """
+        Stop the stage threads (after every token sent to them is finished).
+        """
+        self.encode_queue.put(STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _groups(self, batch: list[RenderJob]) -> list[list[RenderJob]]:
+        if self.renderer.batch_compositor is None or self.renderer.planned:
+            return [[job] for job in batch]
+        # consecutive jobs that only differ in the top layer are composited together
+        return [list(group) for _, group in itertools.groupby(batch, key=lambda j: j.trait_indices[:-1])]
+
+    def _compose(self, items: list[PipelineItem]):
+        renderer = self.renderer
+        if renderer.batch_compositor is None or items[0].job.trait_indices in renderer.planned:
+            item = items[0]
+            item.image, item.pixel_digest = renderer.compose(item.job, item.timer)
+            self.encode_queue.put(item)
+            return
+
+        p_start = time.perf_counter()
+        parts = renderer.parts(items[0].job)
+        generated = renderer.batch_compositor.composite_batch(
+            base_parts=parts[:-1],
+            top_parts=[renderer.parts(item.job)[-1] for item in items]
+        )
+        composite_time = (time.perf_counter() - p_start) / len(items)
+        for item, image in zip(items, generated):
+            item.timer.skip()
+            item.timer.add('compose', composite_time)
+            item.image = image
+            item.pixel_digest = renderer.hash_pixels(image, item.timer)
+            self.encode_queue.put(item)
+
+    def _collect(self, finished: dict[int, tuple[RenderJob, RenderResult]], block: bool):
+        """
+        Move the tokens that finished the last stage into `finished` (composing a damaged image again once).
+        """
+        while True:
+            try:
+                item, outcome = self.done_queue.get(block=block)
+            except queue.Empty:
+                return
+            if isinstance(outcome, CorruptPngError) and item.attempt == 0:
+                print(f'WARNING: {item.job.file_name} was damaged ({outcome}) so it is being rendered again')
+                self._compose([PipelineItem(item.seq, item.job, LapTimer(), attempt=1)])
+            elif isinstance(outcome, Exception):
+                raise outcome
+            else:
+                finished[item.seq] = (item.job, outcome)
+            block = False
+
+    def _encode_stage(self):
+        renderer = self.renderer
+        while (item := self.encode_queue.get()) is not STOP:
+            try:
+                item.timer.skip()
+                generated = item.image
+                item.image = renderer.backend.encode(generated, renderer.png_profile)
+                renderer.backend.close_image(generated)
+                item.timer.lap('encode')
+                self.write_queue.put(item)
+            except Exception as e:
+                self.done_queue.put((item, e))
+        self.write_queue.put(STOP)
+
+    def _write_stage(self):
+        renderer = self.renderer
+        while (item := self.write_queue.get()) is not STOP:
+            try:
+                item.timer.skip()
+                png_bytes = renderer.write(item.job, item.image, item.timer)
+                item.image = None
+                if renderer.exif_updater is not None:
+                    self.exif_queue.put(item)
+                else:
+                    self._done(item, *renderer.finish(png_bytes, item.timer))
+            except Exception as e:
+                self.done_queue.put((item, e))
+        self.exif_queue.put(STOP)
+
+    def _exif_stage(self):
+        renderer = self.renderer
+        stopped = False
+        while not stopped:
+            items = [self.exif_queue.get()]
+            # update every image that is already waiting with the same exiftool command
+            while len(items) < self.exif_batch_size and items[-1] is not STOP:
+                try:
+                    items.append(self.exif_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if items[-1] is STOP:
+                items.pop()
+                stopped = True
+            if not items:
+                continue
+
+            try:
+                p_start = time.perf_counter()
+                renderer.update_exif([item.job for item in items])
+                exif_time = (time.perf_counter() - p_start) / len(items)
+            except Exception as e:
+                for item in items:
+                    self.done_queue.put((item, e))
+                continue
+
+            for item in items:
+                try:
+                    item.timer.skip()
+                    item.timer.add('exif', exif_time)
+                    self._done(item, *renderer.finish_file(item.job, item.timer))
+                except Exception as e:
+                    self.done_queue.put((item, e))
+
+    def _done(self, item: PipelineItem, checksum: str, unixfs, png_bytes: bytes | None):
+        result = RenderResult(item.timer.elapsed(), checksum, item.timer.stages, item.pixel_digest, unixfs,
+                              png_bytes)
+        self.done_queue.put((item, result))
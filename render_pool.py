@@ -0,0 +1,126 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import itertools
+import multiprocessing
+import multiprocessing.util
+import os
+from collections import deque
+from typing import Iterable, Iterator
+
+from image_cache import CacheStats
+from layer_cache import LayerCache
+from render_pipeline import RenderPipeline
+from renderer import Renderer, RenderSettings, create_renderer
+from util import RenderJob, RenderResult, load_layers
+
+# each worker process renders with its own layers, image cache, exiftool process, and (optional) prefix cache
+worker_renderer: Renderer | None = None
+worker_pipeline: RenderPipeline | None = None
+
+
+def init_worker(layers_dir_path: str, settings: RenderSettings):
+    global worker_renderer, worker_pipeline
+    if settings.layer_cache_dir is not None:
+        layers = LayerCache(settings.layer_cache_dir).load_layers(layers_dir_path, verbose=False)
+    else:
+        layers = load_layers(layers_dir_path, verbose=False)
+    worker_renderer = create_renderer(layers, settings)
+    if settings.pipeline:
+        worker_pipeline = RenderPipeline(worker_renderer)
+    # runs when the worker exits after `RenderPool.close` (but not if the pool is terminated)
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    """
+    Stop the worker's pipeline threads and close its renderer (including its exiftool process).
+    """
+    global worker_renderer, worker_pipeline
+    if worker_pipeline is not None:
+        worker_pipeline.close()
+        worker_pipeline = None
+    if worker_renderer is not None:
+        worker_renderer.close()
+        worker_renderer = None
+
+
+def render_batch(jobs: list[RenderJob]) -> tuple[int, list[RenderResult], CacheStats]:
+    if worker_pipeline is not None:
+        results = [result for _, result in worker_pipeline.render(jobs)]
+    else:
+        results = worker_renderer.render_batch(jobs)
+    return os.getpid(), results, worker_renderer.image_cache.stats
+
+
+class RenderPool:
+    """
+    Process pool that renders tokens in parallel while returning the results in the same order as the jobs.
+
+    Jobs are sent in small batches so consecutive tokens (which usually share lower layers) are rendered by the
+    same worker, and only a few batches per worker are kept in flight so the job source is not consumed too far
+    ahead.
+    """
+
+    def __init__(self, num_workers: int, layers_dir_path: str, settings: RenderSettings, batch_size: int = 8):
+        self.batch_size = batch_size
+        self.max_pending = num_workers * 2
+
+        # latest trait image cache counters reported by each worker process
+        self.worker_cache_stats: dict[int, CacheStats] = {}
+
+        # spawn (instead of fork) so workers don't inherit ImageMagick or exiftool state from the parent
+        context = multiprocessing.get_context('spawn')
+        self.pool = context.Pool(
+            processes=num_workers,
+            initializer=init_worker,
+            initargs=(layers_dir_path, settings)
+        )
+
+    def render(self, jobs: Iterable[RenderJob]) -> Iterator[tuple[RenderJob, RenderResult]]:
+        """
+        Render the jobs in the worker processes.
+        :param jobs: tokens to render.
+        :return: iterator of `(job, result)` in the same order as the jobs.
+        """
+
+        pending = deque()
+        jobs_iter = iter(jobs)
+        while batch := list(itertools.islice(jobs_iter, self.batch_size)):
+            pending.append((batch, self.pool.apply_async(render_batch, (batch,))))
+            while len(pending) >= self.max_pending:
+                yield from self._finish(pending.popleft())
+
+        while pending:
+            yield from self._finish(pending.popleft())
+
+    def _finish(self, pending_batch) -> Iterator[tuple[RenderJob, RenderResult]]:
+        batch, async_result = pending_batch
+        pid, results, cache_stats = async_result.get()
+        self.worker_cache_stats[pid] = cache_stats
+        yield from zip(batch, results)
+
+    def cache_stats(self) -> CacheStats:
+        """
+        :return: trait image cache counters summed over all workers (the peak is the sum of each worker's peak).
+        """
+        return sum(self.worker_cache_stats.values(), CacheStats())
+
+    def close(self):
+        """
+        Wait for the workers to exit (each closes its renderer on the way out, see `close_worker`).
+        """
+        self.pool.close()
+        self.pool.join()
@@ -0,0 +1,394 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import hashlib
+import itertools
+import os
+import time
+from dataclasses import dataclass
+from typing import Any
+
+from composite_cache import PrefixCompositeCache
+from compositor_backends import CompositorBackend, create_backend
+from exif_updater import ExifUpdater
+from image_cache import TraitImageCache
+from ipfs_car import UnixFSDag, file_dag
+from layer_cache import LayerCache
+from png_check import CorruptPngError, check_png
+from png_encoding import PngEncodingProfile
+from png_metadata import PngMetadataWriter
+from shared_pixels import SharedTraitIndex, SharedTraitPixels
+from journal import file_checksum
+from metrics import LapTimer
+from util import LayerInfo, RenderJob, RenderResult, TraitImageInfo
+
+
+@dataclass(frozen=True)
+class RenderSettings:
+    """
+    Options used to create a :py:class:`Renderer` (in this process or in each worker process).
+    """
+    gen_image_dir_path: str
+    backend: str = 'wand'
+    crop_traits: bool = False
+    cache_max_bytes: int = 0
+    use_prefix_cache: bool = False
+    inline_metadata: bool = False
+    png_profile: PngEncodingProfile = PngEncodingProfile()
+    pixel_hash: bool = False
+    layer_cache_dir: str | None = None
+    # trait image pixels shared by the main process (see :py:class:`shared_pixels.SharedTraitPixels`)
+    shared_traits: SharedTraitIndex | None = None
+    unixfs_dag: bool = False
+    check_png: bool = False
+    # overlap the render stages in threads (see :py:class:`render_pipeline.RenderPipeline`)
+    pipeline: bool = False
+    # the images are written to an archive by the main process instead of image files (see `image_archive`)
+    archive: str | None = None
+
+
+class Renderer:
+    """
+    Renders tokens (composite, save, and update EXIF metadata) from the trait images of the given layers.
+    The metadata is either written while saving (`metadata_writer`) or updated afterwards by exiftool
+    (`exif_updater`).
+    Loading, compositing, and encoding the trait images is done by the compositor `backend` (Wand by default).
+    With `unixfs_dag`, the IPFS UnixFS DAG of each final image file is computed from the bytes that are already
+    in memory (for the checksum) so the images don't have to be read again to pack them into a CAR file.
+    With `check_png`, each final image is validated right after it is saved and rendered again once if it is
+    damaged.
+    With an `archive` format, image files aren't written: the final image bytes are returned in each result instead
+    (except for a CAR archive, which only needs the UnixFS DAG).
+    """
+
+    def __init__(self, layers: list[LayerInfo], gen_image_dir_path: str, backend: CompositorBackend,
+                 image_cache: TraitImageCache, exif_updater: ExifUpdater | None = None,
+                 metadata_writer: PngMetadataWriter | None = None, use_prefix_cache: bool = False,
+                 png_profile: PngEncodingProfile = PngEncodingProfile(), pixel_hash: bool = False,
+                 unixfs_dag: bool = False, check_png: bool = False, archive: str | None = None):
+        self.layers = layers
+        self.gen_image_dir_path = gen_image_dir_path
+        self.backend = backend
+        self.image_cache = image_cache
+        self.exif_updater = exif_updater
+        self.metadata_writer = metadata_writer
+        self.png_profile = png_profile
+        self.pixel_hash = pixel_hash
+        self.unixfs_dag = unixfs_dag
+        self.check_png = check_png
+        self.archive = archive
+        self.batch_compositor = backend.batch_compositor(image_cache.get)
+        self.prefix_cache = PrefixCompositeCache(image_cache.get, backend) \
+            if use_prefix_cache and self.batch_compositor is None else None
+        # composites (and pixel digests) made while the permutations were planned, by trait indices
+        # (see :py:class:`pixel_dupes.PixelDeduper`)
+        self.planned: dict[tuple[int, ...], tuple[Any, str]] = {}
+
+    def parts(self, job: RenderJob) -> list[TraitImageInfo]:
+        return [self.layers[layer_index].trait_images[trait_index]
+                for layer_index, trait_index in enumerate(job.trait_indices)]
+
+    def composite(self, parts: list[TraitImageInfo]):
+        """
+        Composite the image parts in layer order (using the prefix cache if enabled).
+        :param parts: image parts to use when generating image.
+        :return: a new composite image (the caller is responsible for closing it).
+        """
+
+        if self.prefix_cache is not None:
+            return self.prefix_cache.composite(parts)
+
+        generated = None
+        for image_part in parts:
+            # grab the cached part image first
+            image = self.image_cache.get(image_part)
+
+            if generated is None:
+                # start with a copy of the cached image
+                generated = self.backend.copy(image)
+            else:
+                # composite the cached image over the current image
+                self.backend.composite(generated, image)
+
+        return generated
+
+    def render(self, job: RenderJob) -> RenderResult:
+        """
+        Render the job's composite image into the generated images directory and update its EXIF metadata.
+        :param job: token to render.
+        :return: seconds spent rendering (in total and per stage) and the checksum of the image file.
+        """
+
+        if self.batch_compositor is not None and job.trait_indices not in self.planned:
+            return self.render_batch([job])[0]
+
+        try:
+            return self.render_image(job)
+        except CorruptPngError as error:
+            print(f'WARNING: {job.file_name} was damaged ({error}) so it is being rendered again')
+            return self.render_image(job)
+
+    def render_image(self, job: RenderJob) -> RenderResult:
+        timer = LapTimer()
+        generated, pixel_digest = self.compose(job, timer)
+
+        if self.metadata_writer is not None:
+            # encode in memory so the file is written once (with metadata) and exiftool isn't needed
+            png_bytes = self.backend.encode(generated, self.png_profile)
+            self.backend.close_image(generated)
+            timer.lap('encode')
+            checksum, unixfs, archive_bytes = self.save(job, png_bytes, timer)
+        else:
+            self.backend.save(generated, os.path.join(self.gen_image_dir_path, job.file_name), self.png_profile)
+            self.backend.close_image(generated)
+            timer.lap('encode')
+            checksum, unixfs, archive_bytes = self.save(job, timer=timer)
+
+        return RenderResult(timer.elapsed(), checksum, timer.stages, pixel_digest, unixfs, archive_bytes)
+
+    def compose(self, job: RenderJob, timer: LapTimer) -> tuple[Any, str | None]:
+        """
+        Composite the image of a job and hash its pixels (if enabled), unless it was composited when it was
+        planned.
+        :param job: token to render.
+        :param timer: timer to record the time of each stage with.
+        :return: a new composite image (the caller is responsible for closing it) and its pixel digest (or `None`).
+        """
+        planned = self.planned.pop(job.trait_indices, None)
+        if planned is not None:
+            return planned
+        generated = self.composite(self.parts(job))
+        timer.lap('compose')
+        return generated, self.hash_pixels(generated, timer)
+
+    def hash_pixels(self, generated, timer: LapTimer) -> str | None:
+        """
+        :param generated: composite image (before encoding).
+        :param timer: timer to record the time of the stage with.
+        :return: digest of the composite pixels if pixel hashing is enabled; otherwise `None`.
+        """
+        if not self.pixel_hash:
+            return None
+        pixel_digest = self.backend.pixel_digest(generated)
+        timer.lap('pixel_hash')
+        return pixel_digest
+
+    def render_batch(self, jobs: list[RenderJob]) -> list[RenderResult]:
+        """
+        Render several jobs. If the backend supports it (e.g., NumPy), consecutive jobs that only differ in the
+        top layer are composited together as one batch.
+        :param jobs: tokens to render.
+        :return: result of each job (batch compositing time is split between the jobs).
+        """
+
+        if self.batch_compositor is None or self.planned:
+            return [self.render(job) for job in jobs]
+
+        results = []
+        for _, group in itertools.groupby(jobs, key=lambda j: j.trait_indices[:-1]):
+            results.extend(self.render_group(list(group)))
+        return results
+
+    def render_group(self, group: list[RenderJob], retry: bool = True) -> list[RenderResult]:
+        """
+        Composite jobs that only differ in the top layer as one batch and save each image.
+        :param group: jobs that share every layer except the top layer.
+        :param retry: render a damaged image again (on its own) instead of raising the error.
+        :return: result of each job.
+        """
+
+        results = []
+        p_start = time.perf_counter()
+        parts = self.parts(group[0])
+        generated = self.batch_compositor.composite_batch(
+            base_parts=parts[:-1],
+            top_parts=[self.parts(job)[-1] for job in group]
+        )
+        composite_time = (time.perf_counter() - p_start) / len(group)
+
+        for job, image in zip(group, generated):
+            timer = LapTimer()
+            pixel_digest = self.hash_pixels(image, timer)
+            png_bytes = self.backend.encode(image, self.png_profile)
+            timer.lap('encode')
+            try:
+                checksum, unixfs, archive_bytes = self.save(job, png_bytes, timer)
+            except CorruptPngError as error:
+                if not retry:
+                    raise
+                print(f'WARNING: {job.file_name} was damaged ({error}) so it is being rendered again')
+                results.extend(self.render_group([job], retry=False))
+                continue
+            timer.stages['compose'] = composite_time
+            results.append(RenderResult(composite_time + timer.elapsed(), checksum, timer.stages, pixel_digest,
+                                        unixfs, archive_bytes))
+
+        return results
+
+    def save(self, job: RenderJob, png_bytes: bytes | None = None,
+             timer: LapTimer | None = None) -> tuple[str, UnixFSDag | None, bytes | None]:
+        """
+        Write the encoded image (unless it was already saved) and its metadata.
+        :param job: token being rendered.
+        :param png_bytes: encoded PNG image; otherwise the image file was already saved.
+        :param timer: timer to record the time of each stage with.
+        :return: SHA-256 hex digest of the final image file, its UnixFS DAG (if enabled),
+            and its bytes (if archived).
+        :raises CorruptPngError: if PNG checking is enabled and the final image file is damaged.
+        """
+
+        if timer is None:
+            timer = LapTimer()
+
+        if png_bytes is not None:
+            png_bytes = self.write(job, png_bytes, timer)
+
+        if self.exif_updater is None:
+            return self.finish(png_bytes, timer)
+
+        # the image file is complete once it has been saved (or written) so exiftool can update it right away
+        self.update_exif([job])
+        timer.lap('exif')
+        return self.finish_file(job, timer)
+
+    def write(self, job: RenderJob, png_bytes: bytes, timer: LapTimer) -> bytes:
+        """
+        Write the encoded image (with its metadata if it is written inline).
+        :param job: token being rendered.
+        :param png_bytes: encoded PNG image.
+        :param timer: timer to record the time of each stage with.
+        :return: the bytes that were written (or that will be archived).
+        """
+        if self.metadata_writer is not None:
+            png_bytes = self.metadata_writer.add_metadata(png_bytes, job.image_desc, job.traits_str)
+            timer.lap('metadata')
+        if self.archive is not None:
+            return png_bytes
+        with open(os.path.join(self.gen_image_dir_path, job.file_name), 'wb') as png_file:
+            png_file.write(png_bytes)
+        timer.lap('write')
+        return png_bytes
+
+    def update_exif(self, jobs: list[RenderJob]):
+        """
+        Update the EXIF metadata of saved image files (with one exiftool command).
+        :param jobs: tokens whose image files were saved.
+        """
+        self.exif_updater.update_metadata_batch([
+            (os.path.join(self.gen_image_dir_path, job.file_name), job.image_desc, job.traits_str) for job in jobs
+        ])
+
+    def finish(self, png_bytes: bytes, timer: LapTimer) -> tuple[str, UnixFSDag | None, bytes | None]:
+        """
+        :param png_bytes: final image file bytes.
+        :param timer: timer to record the time of each stage with.
+        :return: SHA-256 hex digest of the final image file, its UnixFS DAG (if enabled),
+            and its bytes (if archived).
+        :raises CorruptPngError: if PNG checking is enabled and the image is damaged.
+        """
+        self.validate(png_bytes, timer)
+        checksum = hashlib.sha256(png_bytes).hexdigest()
+        timer.lap('checksum')
+        archive_bytes = png_bytes if self.archive is not None and self.archive != 'car' else None
+        return checksum, self.file_dag(png_bytes, timer), archive_bytes
+
+    def finish_file(self, job: RenderJob, timer: LapTimer) -> tuple[str, UnixFSDag | None, bytes | None]:
+        """
+        :param job: token whose image file was updated by exiftool.
+        :param timer: timer to record the time of each stage with.
+        :return: SHA-256 hex digest of the final image file, its UnixFS DAG (if enabled),
+            and its bytes (if archived).
+        :raises CorruptPngError: if PNG checking is enabled and the image is damaged.
+        """
+
+        file_path = os.path.join(self.gen_image_dir_path, job.file_name)
+        if not self.unixfs_dag and not self.check_png:
+            checksum = file_checksum(file_path)
+            timer.lap('checksum')
+            return checksum, None, None
+
+        # exiftool rewrote the file, so it's read once for the validation, the checksum, and the DAG
+        with open(file_path, 'rb') as png_file:
+            png_bytes = png_file.read()
+        return self.finish(png_bytes, timer)
+
+    def validate(self, png_bytes: bytes, timer: LapTimer):
+        """
+        :param png_bytes: final image file bytes.
+        :param timer: timer to record the time of the stage with.
+        :raises CorruptPngError: if PNG checking is enabled and the image is damaged.
+        """
+        if self.check_png:
+            check_png(png_bytes)
+            timer.lap('png_check')
+
+    def file_dag(self, png_bytes: bytes, timer: LapTimer) -> UnixFSDag | None:
+        if not self.unixfs_dag:
+            return None
+        unixfs = file_dag(png_bytes)
+        timer.lap('cid')
+        return unixfs
+
+    def close(self):
+        for generated, _ in self.planned.values():
+            self.backend.close_image(generated)
+        self.planned.clear()
+        if self.prefix_cache is not None:
+            self.prefix_cache.truncate()
+        self.image_cache.close()
+        if self.exif_updater is not None:
+            self.exif_updater.close()
+
+
+def create_renderer(layers: list[LayerInfo], settings: RenderSettings) -> Renderer:
+    """
+    Create a renderer (including its compositor backend, trait image cache, and metadata writer) from the settings.
+    :param layers: layers to render the trait images of.
+    :param settings: render options.
+    :return: the new renderer.
+    """
+
+    layer_cache = LayerCache(settings.layer_cache_dir) if settings.layer_cache_dir is not None else None
+    backend = create_backend(settings.backend, settings.crop_traits, layer_cache)
+    if settings.shared_traits is not None:
+        shared_pixels = SharedTraitPixels.attach(settings.shared_traits, backend)
+        image_cache = TraitImageCache(
+            max_bytes=settings.cache_max_bytes,
+            load_image=shared_pixels.load,
+            image_bytes=shared_pixels.image_bytes,
+            close_image=backend.close_image
+        )
+    else:
+        image_cache = TraitImageCache(
+            max_bytes=settings.cache_max_bytes,
+            load_image=backend.load,
+            image_bytes=backend.image_bytes,
+            close_image=backend.close_image
+        )
+
+    return Renderer(
+        layers=layers,
+        gen_image_dir_path=settings.gen_image_dir_path,
+        backend=backend,
+        image_cache=image_cache,
+        exif_updater=None if settings.inline_metadata else ExifUpdater(),
+        metadata_writer=PngMetadataWriter() if settings.inline_metadata else None,
+        use_prefix_cache=settings.use_prefix_cache,
+        png_profile=settings.png_profile,
+        pixel_hash=settings.pixel_hash,
+        unixfs_dag=settings.unixfs_dag,
+        check_png=settings.check_png,
+        archive=settings.archive
+    )
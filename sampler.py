@@ -0,0 +1,121 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import random
+from collections import defaultdict
+
+from trait_rules import TraitRules
+
+
+class WeightedComboSampler:
+    """
+    Draws unique trait combinations (one trait index per layer) by weight without any rejected random trials.
+
+    The weight of a combination is the product of its trait weights. The combinations form a tree (one level per
+    layer), and the sampler remembers how much weight has already been drawn under each prefix of that tree.
+    Each draw walks down the tree choosing a child in proportion to the weight still remaining under it, so drawn
+    combinations are never chosen again and every draw costs the same no matter how full the collection is.
+
+    This is the same distribution as repeating random trials until finding a combination that wasn't drawn yet.
+
+    With trait rules, the weight under each prefix only counts the combinations that don't break a rule, so
+    combinations that break a rule are never drawn (instead of being rejected after drawing them).
+    """
+
+    def __init__(self, layer_weights: list[list[int]], rng: random.Random | None = None,
+                 rules: TraitRules | None = None):
+        """
+        :param layer_weights: trait weights of each layer (in layering order).
+        :param rng: random number generator to use (uses the `random` module by default).
+        :param rules: trait compatibility rules (if any).
+        """
+
+        self.layer_weights = layer_weights
+        self.rng = rng if rng is not None else random
+        self.rules = rules if rules else None
+
+        # suffix_weights[d] is the total weight of all combinations of the layers from depth `d` to the top
+        self.suffix_weights = [1] * (len(layer_weights) + 1)
+        for depth in range(len(layer_weights) - 1, -1, -1):
+            self.suffix_weights[depth] = self.suffix_weights[depth + 1] * sum(layer_weights[depth])
+        self.total_weight = \
+            self.suffix_weights[0] if self.rules is None else self.rules.count(0, None, layer_weights)
+
+        # weight already drawn under each prefix of trait indices
+        self.drawn_weight: defaultdict[tuple[int, ...], int] = defaultdict(int)
+
+        self.num_sampled = 0
+        self.expected_trials = 0.0
+
+    def remaining_weight(self) -> int:
+        return self.total_weight - self.drawn_weight[()]
+
+    def sample(self) -> tuple[int, ...]:
+        """
+        Draw the next unique combination.
+        :return: trait index for each layer.
+        :raises ValueError: if every combination with a non-zero weight was already drawn.
+        """
+
+        remaining_weight = self.remaining_weight()
+        if remaining_weight <= 0:
+            raise ValueError('No weighted trait combinations remain to be sampled')
+
+        # random trials would have needed this many attempts (on average) to find a combination not drawn yet
+        self.expected_trials += self.total_weight / remaining_weight
+
+        prefix: tuple[int, ...] = ()
+        prefix_weight = 1
+        masks = self.rules.initial_masks() if self.rules is not None else None
+        for depth, weights in enumerate(self.layer_weights):
+            child_weights = [
+                prefix_weight * weight * self._suffix_weight(depth, masks, index)
+                - self.drawn_weight.get(prefix + (index,), 0)
+                for index, weight in enumerate(weights)
+            ]
+
+            # integer arithmetic so the remaining weights stay exact even for huge collections
+            pick = self.rng.randrange(sum(child_weights))
+            for index, child_weight in enumerate(child_weights):
+                if pick < child_weight:
+                    break
+                pick -= child_weight
+
+            prefix += (index,)
+            prefix_weight *= weights[index]
+            if masks is not None:
+                masks = self.rules.choose(masks, depth, index)
+
+        for depth in range(len(prefix) + 1):
+            self.drawn_weight[prefix[:depth]] += prefix_weight
+
+        self.num_sampled += 1
+        return prefix
+
+    def _suffix_weight(self, depth: int, masks, index: int) -> int:
+        """
+        :return: total weight of the combinations of the layers above `depth` after choosing trait `index`.
+        """
+        if masks is None:
+            return self.suffix_weights[depth + 1]
+        if not masks[0] >> index & 1:
+            return 0
+        return self.rules.count(depth + 1, self.rules.choose(masks, depth, index), self.layer_weights)
+
+    def trials_saved(self) -> int:
+        """
+        :return: expected number of (duplicate) random trials avoided compared to random trials with memoization.
+        """
+        return round(self.expected_trials) - self.num_sampled
@@ -0,0 +1,160 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Any
+
+import numpy as np
+
+from compositor_backends import PixelBackend, SparseTrait
+from util import LayerInfo
+
+# every trait image starts at a multiple of this (so the views are aligned for vectorized math)
+ALIGNMENT = 64
+
+
+@dataclass(frozen=True)
+class SharedTraitInfo:
+    """
+    Location of one trait image in the shared memory block.
+    """
+    offset: int
+    shape: tuple[int, ...]
+    dtype: str
+    # (left, top, canvas_width, canvas_height) if the trait image was cropped to its bounding box
+    sparse: tuple[int, int, int, int] | None = None
+
+
+@dataclass(frozen=True)
+class SharedTraitIndex:
+    """
+    Name of the shared memory block and the location of every trait image in it (sent to the worker processes).
+    """
+    shm_name: str
+    traits: dict[str, SharedTraitInfo]
+
+
+class SharedTraitPixels:
+    """
+    Decoded trait image pixels placed once in shared memory so every worker process composites from read-only
+    views of the same pixels instead of decoding (and keeping) its own copy of every trait image.
+
+    The main process decodes (and crops) every trait image with the backend and copies the pixels into one
+    shared memory block. Workers attach to the block and create their trait images from views of it, which
+    share the pixels with the NumPy and Pillow backends (`zero_copy_shared`); other backends create a copy
+    from the shared pixels, which still skips decoding in every worker.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory, index: SharedTraitIndex, backend: PixelBackend,
+                 owner: bool):
+        self.shm = shm
+        self.index = index
+        self.backend = backend
+        self.owner = owner
+
+    @staticmethod
+    def create(layers: list[LayerInfo], backend: PixelBackend):
+        """
+        Decode every trait image of the layers into a new shared memory block.
+        :param layers: layers to share the trait images of.
+        :param backend: backend to decode the trait images with (the same kind of backend as the workers).
+        :return: the shared pixels (owned by this process, so `close` also frees the shared memory).
+        """
+
+        traits: dict[str, SharedTraitInfo] = {}
+        pixels: list[np.ndarray] = []
+        size = 0
+        for layer in layers:
+            for trait_image in layer.trait_images:
+                image = backend.load(trait_image.path)
+                sparse = None
+                if isinstance(image, SparseTrait):
+                    sparse = (image.left, image.top, image.canvas_width, image.canvas_height)
+                    trait_pixels = np.ascontiguousarray(backend.to_shared(image.image))
+                else:
+                    trait_pixels = np.ascontiguousarray(backend.to_shared(image))
+                backend.close_image(image)
+                pixels.append(trait_pixels)
+                traits[trait_image.path] = SharedTraitInfo(
+                    offset=size,
+                    shape=trait_pixels.shape,
+                    dtype=trait_pixels.dtype.str,
+                    sparse=sparse
+                )
+                size += -(-trait_pixels.nbytes // ALIGNMENT) * ALIGNMENT
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        for info, trait_pixels in zip(traits.values(), pixels):
+            copy_to_buffer(shm.buf, info, trait_pixels)
+        pixels.clear()
+
+        return SharedTraitPixels(shm, SharedTraitIndex(shm.name, traits), backend, owner=True)
+
+    @staticmethod
+    def attach(index: SharedTraitIndex, backend: PixelBackend):
+        """
+        Attach to shared pixels created by another process.
+        :param index: index of the shared pixels (see `create`).
+        :param backend: backend to create the trait images with.
+        :return: the shared pixels.
+        """
+        return SharedTraitPixels(shared_memory.SharedMemory(name=index.shm_name), index, backend, owner=False)
+
+    @property
+    def num_bytes(self) -> int:
+        return self.shm.size
+
+    def view(self, path: str) -> tuple[np.ndarray, SharedTraitInfo]:
+        """
+        :param path: trait image file path.
+        :return: read-only view of the shared pixels of the trait image and its location.
+        """
+        info = self.index.traits[path]
+        pixels = np.ndarray(info.shape, dtype=np.dtype(info.dtype), buffer=self.shm.buf, offset=info.offset)
+        pixels.flags.writeable = False
+        return pixels, info
+
+    def load(self, path: str) -> Any:
+        """
+        :param path: trait image file path.
+        :return: the trait image created from the shared pixels (to use as the trait image cache `load_image`).
+        """
+        pixels, info = self.view(path)
+        image = self.backend.from_shared(pixels)
+        if info.sparse is None:
+            return image
+        return SparseTrait(image, *info.sparse)
+
+    def image_bytes(self, image) -> int:
+        """
+        :param image: trait image created by `load`.
+        :return: memory used by the trait image in this process (nothing unless the backend copied the pixels).
+        """
+        return 0 if self.backend.zero_copy_shared else self.backend.image_bytes(image)
+
+    def close(self):
+        """
+        Detach from the shared memory (and free it if this process created it).
+        Views of the shared pixels (including trait images that share them) must be released first.
+        """
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def copy_to_buffer(buffer, info: SharedTraitInfo, pixels: np.ndarray):
+    # the view is released when this returns (a shared memory block can't be closed while views exist)
+    np.ndarray(info.shape, dtype=pixels.dtype, buffer=buffer, offset=info.offset)[...] = pixels
@@ -0,0 +1,52 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from layer_cache import LayerCache
+from util import load_layers
+
+
+def make_layers(layers_dir_path: str):
+    for layer_name, trait_names in [('00-Background', ['Blue', 'Red']), ('01-Hat', ['Cap#2', 'Crown'])]:
+        trait_type = layer_name.split('-', 1)[1]
+        os.makedirs(os.path.join(layers_dir_path, layer_name))
+        for trait_name in trait_names:
+            trait_path = os.path.join(layers_dir_path, layer_name, f'{trait_type}-{trait_name}.png')
+            Image.new('RGBA', (4, 4)).save(trait_path)
+
+
+def test_cached_layers_from_another_working_directory(tmp_path, monkeypatch, capsys):
+    make_layers(str(tmp_path / 'run' / 'layers'))
+    cache_dir_path = str(tmp_path / 'layer_cache')
+
+    monkeypatch.chdir(tmp_path / 'run')
+    LayerCache(cache_dir_path).load_layers('layers', verbose=False)
+
+    # the same layers directory relative to another working directory
+    monkeypatch.chdir(tmp_path)
+    layers = LayerCache(cache_dir_path).load_layers(os.path.join('run', 'layers'))
+    assert 'from the layer cache' in capsys.readouterr().out
+
+    assert layers == load_layers(os.path.join('run', 'layers'), verbose=False)
+    for layer in layers:
+        assert os.path.isdir(layer.path)
+        for trait_image in layer.trait_images:
+            assert os.path.isfile(trait_image.path)
@@ -0,0 +1,61 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import io
+import os
+import sys
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from png_metadata import EXIF_TAG_ARTIST, EXIF_TAG_COPYRIGHT, EXIF_TAG_IMAGE_DESCRIPTION, PngMetadataWriter, \
+    exif_chunk
+
+
+def blank_png() -> bytes:
+    png = io.BytesIO()
+    Image.new('RGBA', (4, 4), (0, 0, 0, 0)).save(png, 'PNG')
+    return png.getvalue()
+
+
+def test_non_ascii_values_read_back(monkeypatch):
+    monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    # the configured copyright starts with ©
+    writer = PngMetadataWriter()
+    assert '©' in writer.copyright
+
+    png_bytes = writer.add_metadata(blank_png(), 'NFT #1', '[{"trait_type":"Hat","value":"Béret 🎩"}]')
+
+    with Image.open(io.BytesIO(png_bytes)) as image:
+        exif = image.getexif()
+        assert exif[EXIF_TAG_ARTIST] == writer.author
+        assert exif[EXIF_TAG_COPYRIGHT] == writer.copyright
+        # characters outside Latin-1 can't be EXIF ASCII (the exact value is in the iTXt chunks)
+        assert exif[EXIF_TAG_IMAGE_DESCRIPTION] == 'NFT #1 :: [{"trait_type":"Hat","value":"Béret ?"}]'
+        assert image.text['Description'] == 'NFT #1 :: [{"trait_type":"Hat","value":"Béret 🎩"}]'
+        assert image.text['Copyright'] == writer.copyright
+
+
+def test_exif_chunk_latin1_values_read_back():
+    png_bytes = blank_png()
+    # right after the IHDR chunk (signature + 25 bytes)
+    chunk = exif_chunk({EXIF_TAG_ARTIST: 'Zoë Café', EXIF_TAG_COPYRIGHT: '©'})
+    png_bytes = png_bytes[:33] + chunk + png_bytes[33:]
+
+    with Image.open(io.BytesIO(png_bytes)) as image:
+        exif = image.getexif()
+        assert exif[EXIF_TAG_ARTIST] == 'Zoë Café'
+        assert exif[EXIF_TAG_COPYRIGHT] == '©'
@@ -0,0 +1,120 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import itertools
+import math
+import os
+import random
+import sys
+from collections import Counter
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sampler import WeightedComboSampler
+from trait_rules import TraitRules
+from util import LayerInfo, Trait, TraitImageInfo
+
+
+def make_layers(layer_weights: list[list[int]]) -> list[LayerInfo]:
+    return [
+        LayerInfo(
+            name=f'{layer_index:02}-Layer{layer_index}',
+            path=f'layers/{layer_index:02}-Layer{layer_index}',
+            trait_type=f'Layer{layer_index}',
+            total_weight=sum(weights),
+            trait_images=[
+                TraitImageInfo(name=f'Layer{layer_index}-{trait_index}.png', path='',
+                               trait=Trait(f'Layer{layer_index}', str(trait_index), weight), index=trait_index)
+                for trait_index, weight in enumerate(weights)
+            ]
+        )
+        for layer_index, weights in enumerate(layer_weights)
+    ]
+
+
+def random_rules(rng: random.Random) -> tuple[list[list[int]], TraitRules, list[tuple[int, ...]]]:
+    """
+    :return: random layer weights, random exclusions between traits of different layers,
+        and the allowed combinations found by brute force (in layering order).
+    """
+    layer_weights = [[rng.choice([0, 1, 1, 2, 5]) for _ in range(rng.randint(1, 4))]
+                     for _ in range(rng.randint(1, 4))]
+    traits = [(layer_index, trait_index)
+              for layer_index, weights in enumerate(layer_weights) for trait_index in range(len(weights))]
+    exclusions = set()
+    for _ in range(rng.randint(0, 6)):
+        trait_a, trait_b = rng.choice(traits), rng.choice(traits)
+        if trait_a[0] != trait_b[0]:
+            exclusions.add((trait_a, trait_b))
+
+    allowed = [
+        combo for combo in itertools.product(*(range(len(weights)) for weights in layer_weights))
+        if not any(combo[layer_a] == trait_a and combo[layer_b] == trait_b
+                   for (layer_a, trait_a), (layer_b, trait_b) in exclusions)
+    ]
+    return layer_weights, TraitRules(make_layers(layer_weights), exclusions), allowed
+
+
+def combo_weight(layer_weights: list[list[int]], combo: tuple[int, ...]) -> int:
+    return math.prod(weights[trait_index] for weights, trait_index in zip(layer_weights, combo))
+
+
+@pytest.mark.parametrize('seed', range(200))
+def test_count_and_walk_match_brute_force(seed):
+    rng = random.Random(seed)
+    layer_weights, rules, allowed = random_rules(rng)
+
+    assert rules.count() == len(allowed)
+    assert rules.count(layer_weights=layer_weights) == sum(combo_weight(layer_weights, combo) for combo in allowed)
+    assert list(rules.walk()) == allowed
+
+    start = rng.randint(0, len(allowed))
+    stop = rng.randint(start, len(allowed))
+    assert list(rules.walk(start, stop)) == allowed[start:stop]
+
+    for combo in itertools.product(*(range(len(weights)) for weights in layer_weights)):
+        assert rules.is_allowed(combo) == (combo in allowed)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_sampler_draws_every_weighted_combination_once(seed):
+    rng = random.Random(seed)
+    layer_weights, rules, allowed = random_rules(rng)
+    weighted = [combo for combo in allowed if combo_weight(layer_weights, combo) > 0]
+
+    sampler = WeightedComboSampler(layer_weights, random.Random(seed), rules=rules)
+    drawn = [sampler.sample() for _ in range(len(weighted))]
+
+    assert sorted(drawn) == weighted
+    assert sampler.remaining_weight() == 0
+    with pytest.raises(ValueError):
+        sampler.sample()
+
+
+def test_sampler_first_draw_follows_weights():
+    layer_weights = [[1, 3], [2, 0, 6]]
+    rules = TraitRules(make_layers(layer_weights), {((0, 0), (1, 2))})
+
+    draws = Counter()
+    rng = random.Random(1)
+    for _ in range(20000):
+        draws[WeightedComboSampler(layer_weights, rng, rules=rules).sample()] += 1
+
+    # (0, 2) is excluded, so the weights are (0, 0): 2, (1, 0): 6, and (1, 2): 18
+    assert set(draws) == {(0, 0), (1, 0), (1, 2)}
+    for combo, weight in [((0, 0), 2), ((1, 0), 6), ((1, 2), 18)]:
+        assert draws[combo] / 20000 == pytest.approx(weight / 26, abs=0.02)
@@ -0,0 +1,223 @@
+#  Copyright 2023 Raymond Cardillo of Cardillo's Creations.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import hashlib
+import json
+import os
+from typing import Iterator
+
+import yaml
+from yaml import SafeLoader
+
+from util import LayerInfo
+
+DEFAULT_RULES_PATH = 'trait_rules.yaml'
+
+# allowed trait index bit masks of the remaining layers (from some depth to the top layer)
+Masks = tuple[int, ...]
+
+
+class TraitRules:
+    """
+    Trait compatibility rules compiled into allowed trait index masks (one bit per trait of each layer).
+
+    Every rule is compiled into pairs of traits that can't be in the same image. Choosing a trait removes the
+    traits it excludes from the masks of the higher layers, so the exhaustive walk and the weighted sampler
+    never descend into a branch that breaks a rule. The number (or total weight) of the combinations that
+    remain under a branch is counted from the masks with memoization instead of enumerating the combinations.
+    """
+
+    def __init__(self, layers: list[LayerInfo], exclusions: set[tuple[tuple[int, int], tuple[int, int]]]):
+        """
+        :param layers: layers in layering order.
+        :param exclusions: pairs of `(layer_index, trait_index)` that can't be in the same image.
+        """
+        self.num_layers = len(layers)
+        self.full_masks: Masks = tuple((1 << len(layer.trait_images)) - 1 for layer in layers)
+        self.exclusions = exclusions
+
+        # excluded[layer][trait] is the masks of the higher layers' traits excluded by choosing that trait
+        self.excluded: list[list[list[int]]] = [
+            [[0] * self.num_layers for _ in layer.trait_images] for layer in layers
+        ]
+        for (layer_a, trait_a), (layer_b, trait_b) in exclusions:
+            if layer_a > layer_b:
+                layer_a, trait_a, layer_b, trait_b = layer_b, trait_b, layer_a, trait_a
+            self.excluded[layer_a][trait_a][layer_b] |= 1 << trait_b
+
+        self.count_memo: dict[tuple, int] = {}
+
+    @staticmethod
+    def load(layers: list[LayerInfo], rules_path: str | None = None):
+        """
+        Load and compile a rules YAML file (see `trait_rules.yaml`).
+        :param layers: layers in layering order.
+        :param rules_path: rules file path (`None` to use `trait_rules.yaml` only if it exists).
+        :return: the compiled rules.
+        :raises ValueError: if a rule refers to an unknown trait or can't be compiled.
+        """
+
+        if rules_path is None:
+            rules_path = DEFAULT_RULES_PATH
+            if not os.path.exists(rules_path):
+                return TraitRules(layers, set())
+
+        with open(rules_path, 'r') as rules_file:
+            config = yaml.load(rules_file, Loader=SafeLoader) or {}
+
+        traits = {}
+        for layer_index, layer in enumerate(layers):
+            for trait_image in layer.trait_images:
+                traits[(trait_image.trait.type, trait_image.trait.value)] = (layer_index, trait_image.index)
+
+        def find_trait(trait_ref) -> tuple[int, int]:
+            if not isinstance(trait_ref, dict) or len(trait_ref) != 1:
+                raise ValueError(f'Trait must be written as "Type: Value": {trait_ref}')
+            trait_type, value = next(iter(trait_ref.items()))
+            key = (str(trait_type), str(value))
+            if key not in traits:
+                raise ValueError(f'Unknown trait in rules: {trait_type}: {value}')
+            return traits[key]
+
+        exclusions = set()
+        for group in config.get('never') or []:
+            group = list(map(find_trait, group))
+            for index, trait_a in enumerate(group):
+                for trait_b in group[index + 1:]:
+                    if trait_a[0] != trait_b[0]:
+                        exclusions.add(tuple(sorted((trait_a, trait_b))))
+
+        for requirement in config.get('requires') or []:
+            trait = find_trait(requirement.get('trait'))
+            required = list(map(find_trait, requirement.get('any of') or []))
+            required_layers = set(layer_index for layer_index, _ in required)
+            if len(required_layers) != 1 or trait[0] in required_layers:
+                raise ValueError(f'Required traits must all be in one (other) layer: {requirement}')
+            required_layer = required_layers.pop()
+            required_indices = set(trait_index for _, trait_index in required)
+            for trait_image in layers[required_layer].trait_images:
+                if trait_image.index not in required_indices:
+                    exclusions.add(tuple(sorted((trait, (required_layer, trait_image.index)))))
+
+        return TraitRules(layers, exclusions)
+
+    def __bool__(self):
+        return bool(self.exclusions)
+
+    def fingerprint(self) -> str | None:
+        """
+        :return: digest of the compiled rules (to check a resumed run uses the same rules) or `None` if no rules.
+        """
+        if not self.exclusions:
+            return None
+        return hashlib.sha256(json.dumps(sorted(self.exclusions)).encode('utf-8')).hexdigest()
+
+    def initial_masks(self) -> Masks:
+        return self.full_masks
+
+    def choose(self, masks: Masks, depth: int, trait_index: int) -> Masks:
+        """
+        :param masks: allowed masks of the layers from `depth` to the top layer.
+        :param depth: layer index of the chosen trait.
+        :param trait_index: chosen trait index.
+        :return: allowed masks of the layers above `depth` after choosing the trait.
+        """
+        excluded = self.excluded[depth][trait_index]
+        return tuple(mask & ~excluded[depth + 1 + offset] for offset, mask in enumerate(masks[1:]))
+
+    def is_allowed(self, trait_indices: tuple[int, ...]) -> bool:
+        """
+        :param trait_indices: trait index of each layer.
+        :return: `True` if the combination doesn't break any rule.
+        """
+        masks = self.initial_masks()
+        for depth, trait_index in enumerate(trait_indices):
+            if not masks[0] >> trait_index & 1:
+                return False
+            masks = self.choose(masks, depth, trait_index)
+        return True
+
+    def count(self, depth: int = 0, masks: Masks | None = None,
+              layer_weights: list[list[int]] | None = None) -> int:
+        """
+        Count the combinations of the layers from `depth` to the top layer that don't break any rule.
+        :param depth: first layer index to count from.
+        :param masks: allowed masks of the layers from `depth` to the top layer (all traits by default).
+        :param layer_weights: trait weights of each layer to sum the combination weights instead of counting them.
+        :return: number (or total weight) of the allowed combinations.
+        """
+
+        if masks is None:
+            masks = self.full_masks[depth:]
+        if depth == self.num_layers:
+            return 1
+
+        key = (depth, masks, layer_weights is not None)
+        total = self.count_memo.get(key)
+        if total is None:
+            total = 0
+            for trait_index in iter_bits(masks[0]):
+                weight = layer_weights[depth][trait_index] if layer_weights is not None else 1
+                if weight:
+                    total += weight * self.count(depth + 1, self.choose(masks, depth, trait_index), layer_weights)
+            self.count_memo[key] = total
+        return total
+
+    def walk(self, start: int = 0, stop: int | None = None) -> Iterator[tuple[int, ...]]:
+        """
+        Walk the allowed combinations in layering order (the same order as walking every combination
+        depth-first) from the `start`-th one, skipping whole branches before it by their counts.
+        :param start: index of the first allowed combination.
+        :param stop: index after the last allowed combination (all of them by default).
+        :return: iterator of the trait indices of each allowed combination.
+        """
+
+        if stop is None:
+            stop = self.count()
+        remaining = stop - start
+
+        def walk_branch(depth: int, masks: Masks, prefix: tuple[int, ...], skip: int):
+            nonlocal remaining
+            if depth == self.num_layers:
+                remaining -= 1
+                yield prefix
+                return
+            for trait_index in iter_bits(masks[0]):
+                child_masks = self.choose(masks, depth, trait_index)
+                if skip > 0:
+                    child_count = self.count(depth + 1, child_masks)
+                    if skip >= child_count:
+                        skip -= child_count
+                        continue
+                yield from walk_branch(depth + 1, child_masks, prefix + (trait_index,), skip)
+                skip = 0
+                if remaining <= 0:
+                    return
+
+        if remaining > 0:
+            yield from walk_branch(0, self.initial_masks(), (), start)
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """
+    :param mask: bit mask.
+    :return: iterator of the indices of the set bits (in increasing order).
+    """
+    index = 0
+    while mask:
+        if mask & 1:
+            yield index
+        mask >>= 1
+        index += 1
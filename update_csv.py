@@ -15,16 +15,111 @@
 
 import argparse
 import csv
+import hashlib
+import heapq
+import json
 import os
-import sys
+import struct
+import tempfile
 import urllib.parse
 
+from ipfs_car import read_car_root
 from util import *
 
 gen_dir_path_str = Const.DEFAULT_GEN_DIR
 assets_csv_file_name = Const.DEFAULT_CSV_FILE_NAME
 gen_assets_csv_path = os.path.join(gen_dir_path_str, assets_csv_file_name)
 
+# sorted run records are the traits digest followed by the (big-endian) row number so they sort by digest then row
+DIGEST_SIZE = 16
+RECORD = struct.Struct(f'>{DIGEST_SIZE}sQ')
+PROGRESS_ROWS = 100_000
+
+
+def traits_digest(traits_str: str) -> bytes:
+    """
+    Hash the canonical form of a CSV attributes JSON list so that the same traits are equal regardless of
+    their order, whitespace, or JSON formatting.
+    :param traits_str: CSV attributes (JSON list of trait dicts).
+    :return: digest of the sorted trait tuples (or of the stripped string if it isn't valid JSON).
+    """
+    try:
+        traits = json.loads(traits_str)
+        canonical = json.dumps(
+            sorted(sorted((str(k).strip(), str(v).strip()) for k, v in trait.items()) for trait in traits),
+            separators=(',', ':'),
+            ensure_ascii=False
+        )
+    except (ValueError, AttributeError, TypeError):
+        canonical = ''.join(traits_str.split())
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=DIGEST_SIZE).digest()
+
+
+def read_rows(csv_paths: list[str]):
+    """
+    Read the (non-header) rows of several CSV files as if they were one CSV.
+    :param csv_paths: metadata CSV file paths.
+    :return: iterator of rows (dicts).
+    """
+    for csv_path in csv_paths:
+        with open(csv_path, 'r', newline='', buffering=2 ** 20) as assets_csv:
+            csvreader = csv.DictReader(assets_csv, fieldnames=Const.CSV_FIELDNAMES)
+            # skip the header
+            next(csvreader, None)
+            yield from csvreader
+
+
+def print_progress(rows_read: int, label: str):
+    if rows_read % PROGRESS_ROWS == 0:
+        print(f'  {label}: {rows_read} rows', flush=True)
+
+
+def find_duplicates_sorted(csv_paths: list[str], run_rows: int) -> set[int]:
+    """
+    Find the duplicate rows with an external sort so memory use doesn't grow with the CSV size.
+    The traits digests are sorted in runs of `run_rows` that are written to temporary files and then merged.
+    :param csv_paths: metadata CSV file paths.
+    :param run_rows: number of rows per sorted run.
+    :return: (0-based) row numbers of the duplicate rows (every occurrence after the first one).
+    """
+
+    with tempfile.TemporaryDirectory(prefix='update_csv-') as runs_dir_path:
+        run_paths: list[str] = []
+
+        def write_run(records: list[bytes]):
+            records.sort()
+            run_path = os.path.join(runs_dir_path, f'{len(run_paths)}.run')
+            with open(run_path, 'wb') as run_file:
+                run_file.write(b''.join(records))
+            run_paths.append(run_path)
+            records.clear()
+
+        records: list[bytes] = []
+        rows_read = 0
+        for row in read_rows(csv_paths):
+            records.append(RECORD.pack(traits_digest(row[Const.CSV_FIELD_ATTS]), rows_read))
+            rows_read += 1
+            print_progress(rows_read, 'hashed')
+            if len(records) >= run_rows:
+                write_run(records)
+        if records:
+            write_run(records)
+
+        def read_run(run_path: str):
+            with open(run_path, 'rb', buffering=2 ** 20) as run_file:
+                while record := run_file.read(RECORD.size):
+                    yield record
+
+        duplicates: set[int] = set()
+        last_digest = None
+        for record in heapq.merge(*map(read_run, run_paths)):
+            digest, row_number = RECORD.unpack(record)
+            if digest == last_digest:
+                duplicates.add(row_number)
+            last_digest = digest
+
+    return duplicates
+
 
 def main():
     parser = argparse.ArgumentParser(
@@ -32,6 +127,33 @@ def main():
         description='Checks for duplicates and updates the metadata CSV image links.',
         epilog="Ray Cardillo - Cardillo's Creations - Cardillo's Art")
 
+    parser.add_argument(
+        '-c', '--csv',
+        dest='csv_paths',
+        action='append',
+        help='metadata CSV to read instead of the generated assets.csv (repeat to merge several CSVs in order)'
+    )
+    parser.add_argument(
+        '-d', '--dedupe',
+        dest='dedupe',
+        choices=['memory', 'sorted'],
+        default='memory',
+        help='keep the traits hashes in memory, or find duplicates with sorted runs on disk (for very large CSVs)'
+    )
+    parser.add_argument(
+        '--run-rows',
+        dest='run_rows',
+        type=int,
+        default=1_000_000,
+        help='number of rows per sorted run on disk (with --dedupe sorted)'
+    )
+    parser.add_argument(
+        '-i', '--ipfs',
+        dest='ipfs',
+        action='store_true',
+        help=f'link the images to the root CID of the generated {Const.CAR_FILE_NAME} (see generate_nfts.py --car '
+             f'or ipfs_car.py) with the image URL base as the gateway (default: ipfs://)'
+    )
     parser.add_argument(
         'generated_dir',
         default='./generated',
@@ -39,7 +161,8 @@ def main():
     )
     parser.add_argument(
         'image_url_base',
-        help='CSV metadata image URL base'
+        nargs='?',
+        help='CSV metadata image URL base (optional with --ipfs)'
     )
 
     args = parser.parse_args()
@@ -48,44 +171,62 @@ def main():
     gen_dir_path_str = args.generated_dir
     gen_assets_csv_path = os.path.join(gen_dir_path_str, assets_csv_file_name)
     gen_new_assets_csv_path = os.path.join(gen_dir_path_str, assets_csv_file_name + '.new.csv')
+    csv_paths = args.csv_paths or [gen_assets_csv_path]
 
     image_url_base = args.image_url_base
-
-    unique_rows: set[str] = set()
+    if args.ipfs:
+        car_path = os.path.join(gen_dir_path_str, Const.CAR_FILE_NAME)
+        try:
+            car_root = read_car_root(car_path)
+        except (OSError, ValueError) as e:
+            parser.error(f'cannot read the root CID of {car_path}: {e}')
+        gateway = image_url_base or 'ipfs://'
+        # urljoin doesn't know the ipfs scheme so the URLs are appended instead
+        image_url_base = (gateway if gateway.endswith('/') else gateway + '/') + car_root + '/'
+        print(f'Image URL base from the CAR root CID: {image_url_base}')
+    elif image_url_base is None:
+        parser.error('the image URL base is required (unless using --ipfs)')
+
+    sorted_duplicates = None
+    if args.dedupe == 'sorted':
+        sorted_duplicates = find_duplicates_sorted(csv_paths, args.run_rows)
+
+    unique_digests: set[bytes] = set()
+    num_unique_rows = 0
     duplicate_rows: list[dict] = list()
-    with open(gen_assets_csv_path, 'r', newline='') as assets_csv:
-        csvreader = csv.DictReader(assets_csv, fieldnames=Const.CSV_FIELDNAMES)
-        with open(gen_new_assets_csv_path, 'w', newline='') as new_assets_csv:
-            csvwriter = csv.DictWriter(new_assets_csv, fieldnames=Const.CSV_FIELDNAMES)
-
-            # write the header
-            csvwriter.writerow(next(csvreader))
-
-            # iterate over the remaining rows
-            rows_read = 0
-            for row in csvreader:
-                rows_read += 1
-
-                traits_str = row[Const.CSV_FIELD_ATTS]
-                if traits_str in unique_rows:
-                    duplicate_rows.append(row)
+    with open(gen_new_assets_csv_path, 'w', newline='', buffering=2 ** 20) as new_assets_csv:
+        csvwriter = csv.DictWriter(new_assets_csv, fieldnames=Const.CSV_FIELDNAMES)
+
+        # write the header
+        csvwriter.writeheader()
+
+        # iterate over the rows
+        rows_read = 0
+        for row in read_rows(csv_paths):
+            if sorted_duplicates is not None:
+                is_duplicate = rows_read in sorted_duplicates
+            else:
+                digest = traits_digest(row[Const.CSV_FIELD_ATTS])
+                is_duplicate = digest in unique_digests
+                unique_digests.add(digest)
+            rows_read += 1
+
+            if is_duplicate:
+                duplicate_rows.append(row)
+            else:
+                num_unique_rows += 1
+                if args.ipfs:
+                    row[Const.CSV_FIELD_IMAGE] = image_url_base + row[Const.CSV_FIELD_IMAGE]
                 else:
-                    unique_rows.add(traits_str)
                     row[Const.CSV_FIELD_IMAGE] = urllib.parse.urljoin(image_url_base, row[Const.CSV_FIELD_IMAGE])
-                    csvwriter.writerow(row)
-
-                sys.stdout.write('.')
-                if rows_read % 80 == 0:
-                    sys.stdout.write('\n')
-                    sys.stdout.flush()
+                csvwriter.writerow(row)
 
-    if rows_read % 80 != 0:
-        sys.stdout.write('\n')
+            print_progress(rows_read, 'updated')
 
     print(f'\nUpdated rows and created new CSV:\n   {gen_new_assets_csv_path}\n')
 
     print(f'Total rows read from CSV:  {rows_read:5}')
-    print(f'Unique rows updated:       {len(unique_rows):5}')
+    print(f'Unique rows updated:       {num_unique_rows:5}')
 
     num_duplicate_rows = len(duplicate_rows)
     print(f'Duplicate rows skipped:    {num_duplicate_rows:5}')
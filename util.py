@@ -13,10 +13,12 @@
 #  limitations under the License.
 #
 
+import json
+import os
 from dataclasses import dataclass, field
+from functools import cached_property
 from pathlib import Path
-
-from wand.image import Image
+from typing import Any
 
 
 def join_traits(traits: list[str]):
@@ -37,8 +39,20 @@ class Const:
     DEFAULT_LAYERS_DIR: str = './layers'
     DEFAULT_GEN_DIR: str = './generated'
     GEN_IMAGE_SUBDIR: str = 'images'
+    GEN_METADATA_SUBDIR: str = 'metadata'
 
     DEFAULT_CSV_FILE_NAME: str = 'assets.csv'
+    METADATA_JSONL_FILE_NAME: str = 'metadata.jsonl'
+    JOURNAL_FILE_NAME: str = 'journal.jsonl'
+    METRICS_FILE_NAME: str = 'metrics.json'
+    PIXEL_DUPLICATES_FILE_NAME: str = 'pixel_duplicates.csv'
+    EXIF_MISMATCHES_FILE_NAME: str = 'exif_mismatches.csv'
+    RARITY_CSV_FILE_NAME: str = 'rarity.csv'
+    RARITY_REPORT_FILE_NAME: str = 'rarity.json'
+    CAR_FILE_NAME: str = 'images.car'
+    CAR_CIDS_FILE_NAME: str = 'images.car.csv'
+    TAR_FILE_NAME: str = 'tokens.tar'
+    ZIP_FILE_NAME: str = 'tokens.zip'
 
     TRAIT_TRANS = str.maketrans("_-", "  ")
 
@@ -70,8 +84,13 @@ class Trait:
     value: str
     weight: int
 
-    def csv_json(self):
-        return f'{{"trait_type":"{self.type}","value":"{self.value}"}}'
+    @cached_property
+    def attribute_json(self) -> str:
+        """
+        Compact JSON attribute dict of the trait (computed once per trait and reused for every token with it).
+        """
+        return json.dumps({'trait_type': self.type, 'value': self.value},
+                          ensure_ascii=False, separators=(',', ':'))
 
 
 @dataclass(frozen=True)
@@ -80,10 +99,10 @@ class TraitImageInfo:
     Trait image file info (including the `Trait` data object).
     """
 
-    image: Image
     name: str
     path: str
     trait: Trait
+    index: int
 
 
 @dataclass
@@ -111,3 +130,107 @@ class GeneratedImageInfo:
     file_name: str
     file_path: str
     traits_str: str
+
+
+@dataclass(frozen=True)
+class RenderJob:
+    """
+    Everything needed to render one token (trait indices are per layer so the job can be sent to other processes).
+    """
+    index: int
+    trait_indices: tuple[int, ...]
+    file_name: str
+    image_name: str
+    image_desc: str
+    traits_str: str
+
+
+@dataclass(frozen=True)
+class RenderResult:
+    """
+    Result of rendering one token.
+    """
+    elapsed: float
+    checksum: str
+    stages: dict[str, float] = field(default_factory=dict)
+    pixel_digest: str | None = None
+    # UnixFS DAG of the image file (see :py:class:`ipfs_car.UnixFSDag`) if IPFS CIDs are computed
+    unixfs: Any = None
+    # final image file bytes if the image is written to an archive by the main process (instead of a file)
+    png_bytes: bytes | None = None
+
+
+def load_layers(layers_dir_path: str, verbose: bool = True) -> list[LayerInfo]:
+    """
+    Discover the layer directories and parse the trait image file names (and weights) in each of them.
+    The trait images are not decoded here (see :py:class:`image_cache.TraitImageCache`).
+    :param layers_dir_path: layers input directory.
+    :param verbose: print the layers and traits as they are discovered.
+    :return: the layers in layering order.
+    """
+
+    layers: list[LayerInfo] = []
+    for layer_dir in sorted(os.scandir(layers_dir_path), key=lambda ld: ld.name):
+        if layer_dir.is_dir():
+            layer_dir_name = layer_dir.name
+            if verbose:
+                print(f'\nFinding trait images in: {layer_dir_name}')
+
+            layer_trait_type = layer_dir_name[(layer_dir_name.find('-') + 1):]
+
+            total_trait_weight = 0
+
+            trait_images: list[TraitImageInfo] = []
+            for layer_file in sorted(os.scandir(layer_dir), key=lambda lf: lf.name):
+                layer_file_name = layer_file.name
+                if verbose:
+                    print(f'  {layer_file_name}')
+
+                layer_trait_value_start = layer_file_name.find(layer_trait_type) + len(layer_trait_type) + 1
+                layer_trait_value_period_index = layer_file_name.rfind('.', layer_trait_value_start)
+                layer_trait_value_end = layer_trait_value_period_index
+
+                layer_trait_value_weight_index = \
+                    layer_file_name.rfind('#', layer_trait_value_start, layer_trait_value_end)
+                layer_trait_weight = 1
+                if layer_trait_value_weight_index != -1:
+                    layer_trait_value_end = layer_trait_value_weight_index
+                    try:
+                        layer_trait_weight = \
+                            int(layer_file_name[layer_trait_value_weight_index + 1:layer_trait_value_period_index])
+                    except ValueError:
+                        pass
+
+                total_trait_weight = total_trait_weight + layer_trait_weight
+
+                layer_trait_value = \
+                    layer_file_name[layer_trait_value_start:layer_trait_value_end].translate(Const.TRAIT_TRANS)
+
+                layer_trait = Trait(
+                    type=layer_trait_type,
+                    value=layer_trait_value,
+                    weight=layer_trait_weight
+                )
+                if verbose:
+                    print(f'    {layer_trait}')
+
+                trait_images.append(TraitImageInfo(
+                    name=layer_file_name,
+                    path=layer_file.path,
+                    trait=layer_trait,
+                    index=len(trait_images)
+                ))
+
+            layer_info = LayerInfo(
+                name=layer_dir.name,
+                path=layer_dir.path,
+                trait_type=layer_trait_type,
+                trait_images=trait_images,
+                total_weight=total_trait_weight
+            )
+            if verbose:
+                print(f'  Total layer weight = {layer_info.total_weight}')
+
+            layers.append(layer_info)
+
+    return layers